@@ -0,0 +1,55 @@
+"""Diff two result files of benchmarks.run
+
+    python -m benchmarks.compare base.json bench.json --threshold 0.2
+
+Exits with 1 when an endpoint's p95 grew by more than threshold or it makes more queries.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'bytes_per_response', 'alloc_peak_kib')
+
+
+def compare(base: dict, new: dict, threshold: float) -> tuple[list[str], list[str]]:
+    lines, regressions = [], []
+    header = f"{'endpoint':28}" + ''.join(f'{metric:>28}' for metric in METRICS)
+    lines.append(header)
+    for name, result in new['endpoints'].items():
+        before = base['endpoints'].get(name)
+        if before is None:
+            lines.append(f'{name:28} new')
+            continue
+        cells = []
+        for metric in METRICS:
+            old_value, new_value = before[metric], result[metric]
+            change = f'{(new_value - old_value) / old_value:+.0%}' if old_value else ''
+            cells.append(f'{old_value:>10} -> {new_value:<10}{change:>6}')
+        lines.append(f'{name:28}' + ''.join(f'{cell:>28}' for cell in cells))
+        if before['p95_ms'] and (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] > threshold:
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+        if result['queries_per_request'] > before['queries_per_request']:
+            regressions.append(f"{name}: {before['queries_per_request']} -> {result['queries_per_request']} queries")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative growth of p95')
+    args = parser.parse_args()
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    lines, regressions = compare(base, new, args.threshold)
+    print(f"{base['meta']['commit']} -> {new['meta']['commit']}")
+    print('\n'.join(lines))
+    if regressions:
+        print('\nRegressions:\n' + '\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""What metrics.py adds to a request and a query, measured without the noise of a real request
+
+    python -m benchmarks.metrics_overhead
+
+A request through MetricsMiddleware is timed against the same minimal ASGI app without it, a
+query by calling the engine event handlers with a stand-in connection.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+# imported through metrics -> sql_app.database, which builds an engine without connecting
+os.environ.setdefault('ACCESS_TOKEN_EXPIRE_MINUTES', '60')
+os.environ.setdefault('HASH_SECRET', 'benchmark')
+
+import metrics
+
+ROUTES = 40
+
+
+class _Connection:
+    def __init__(self):
+        self.info = {}
+
+
+class _Route:
+    def __init__(self, path: str):
+        self.path = path
+        self.endpoint = object()
+
+
+class _App:
+    def __init__(self):
+        self.routes = [_Route(f'/route/{i}/{{item_id}}') for i in range(ROUTES)]
+
+
+async def _endpoint(scope, receive, send):
+    # what the router does to the scope, and the smallest response
+    scope['endpoint'] = scope['app'].routes[scope['index']].endpoint
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'{}'})
+
+
+async def _send(message):
+    pass
+
+
+async def _receive():
+    return {'type': 'http.request', 'body': b''}
+
+
+async def _requests(app, n: int) -> float:
+    routes = _App()
+    scopes = [{'type': 'http', 'method': 'GET', 'app': routes, 'index': i} for i in range(ROUTES)]
+    start = time.perf_counter()
+    for i in range(n):
+        await app(dict(scopes[i % ROUTES]), _receive, _send)
+    return (time.perf_counter() - start) / n
+
+
+def _queries(n: int) -> float:
+    conn = _Connection()
+    start = time.perf_counter()
+    for _ in range(n):
+        metrics._before_cursor_execute(conn, None, '', None, None, False)
+        metrics._after_cursor_execute(conn, None, '', None, None, False)
+    return (time.perf_counter() - start) / n
+
+
+def _render(n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        metrics.render()
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200_000)
+    parser.add_argument('--output', help='also write the result as JSON')
+    args = parser.parse_args()
+    # best of three, the first pass also warms up
+    bare = min(asyncio.run(_requests(_endpoint, args.requests)) for _ in range(3))
+    measured = min(asyncio.run(_requests(metrics.MetricsMiddleware(_endpoint), args.requests)) for _ in range(3))
+    query = min(_queries(args.requests) for _ in range(3))
+    # every route has a latency histogram and counters by now
+    render = _render(100)
+    result = {
+        'request_overhead_us': round((measured - bare) * 1e6, 3),
+        'query_overhead_us': round(query * 1e6, 3),
+        'render_ms': round(render * 1000, 3),
+        'routes': ROUTES,
+    }
+    print(json.dumps(result, indent=2), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Wall time per notification with attachments, against a local fake Bot API server
+
+    cd app && python -m benchmarks.notifications --notifications 40 --files 10 --api-ms 50
+
+The fake server answers sendMessage, sendDocument and sendMediaGroup after --api-ms, about a
+round trip to Telegram. Every notification goes to a chat of its own with --files attachments
+of --file-kib each, uploaded every time. one_by_one sends the text and then every document on
+its own as bot.send_files did before; media_groups is bot.send_files, chat after chat;
+parallel is bot.send_files to OUTBOX_CONCURRENCY chats at once, as the delivery worker sends.
+No database is needed.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import socket
+import tempfile
+import time
+
+os.environ.setdefault('BOT_TOKEN', '42:benchmark')
+
+import config
+
+CHAT_ID = 1000
+
+
+class FakeBotApi:
+    """Answers the Bot API methods send_files uses, counting the calls"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.message_id = 0
+
+    def _message(self, chat_id, document: bool) -> dict:
+        self.message_id += 1
+        message = {'message_id': self.message_id, 'date': int(time.time()),
+                   'chat': {'id': int(chat_id), 'type': 'private'}}
+        if document:
+            message['document'] = {'file_id': f'file-{self.message_id}', 'file_unique_id': f'unique-{self.message_id}'}
+        return message
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info['method']
+        self.calls[method] += 1
+        form = await request.post()
+        await asyncio.sleep(self.latency)
+        if method == 'sendMediaGroup':
+            result = [self._message(form['chat_id'], True) for _ in json.loads(form['media'])]
+        else:
+            result = self._message(form['chat_id'], method == 'sendDocument')
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(runner, sock).start()
+        return runner, 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+async def _one_by_one(chat_id: int, text: str, files: list):
+    from aiogram.types import FSInputFile
+    import bot
+
+    await bot.bot.send_message(chat_id, bot.template.format(text))
+    for attachment in files:
+        await bot.bot.send_document(chat_id, document=FSInputFile(attachment.path, filename=attachment.filename))
+
+
+async def _media_groups(chat_id: int, text: str, files: list):
+    import bot
+
+    await bot.send_files(chat_id, text, files)
+
+
+async def _measure(send, files: list, notifications: int, concurrency: int) -> dict:
+    from benchmarks.run import percentiles
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def notify(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await send(CHAT_ID + i, f'Benchmark homework {i}', files)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(notify(i) for i in range(notifications)))
+    seconds = time.perf_counter() - start
+    return {'notifications': notifications, 'concurrency': concurrency,
+            'wall_ms_per_notification': round(seconds / notifications * 1000, 2),
+            'notification': percentiles(latencies)}
+
+
+async def run(args) -> dict:
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import bot
+    import storage
+
+    api = FakeBotApi(args.api_ms / 1000)
+    runner, base = await api.start()
+    bot.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(base))
+    results = {'files': args.files, 'file_kib': args.file_kib, 'api_ms': args.api_ms}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for i in range(args.files):
+                path = os.path.join(directory, f'homework-{i}.pdf')
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(args.file_kib * 1024))
+                files.append(storage.Attachment(path, f'homework-{i}.pdf', None))
+            for name, send, concurrency in (('one_by_one', _one_by_one, 1), ('media_groups', _media_groups, 1),
+                                            ('parallel', _media_groups, config.OUTBOX_CONCURRENCY)):
+                api.calls.clear()
+                results[name] = await _measure(send, files, args.notifications, concurrency)
+                results[name]['api_calls_per_notification'] = round(sum(api.calls.values()) / args.notifications, 2)
+    finally:
+        await bot.bot.session.close()
+        await runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--notifications', type=int, default=40)
+    parser.add_argument('--files', type=int, default=10, help='attachments per notification')
+    parser.add_argument('--file-kib', type=int, default=100)
+    parser.add_argument('--api-ms', type=float, default=50, help='latency of every Bot API call')
+    parser.add_argument('--output', help='also write the result as JSON')
+    args = parser.parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Fill a benchmark database with realistic volumes, one INSERT ... SELECT per table
+
+At scale 1: 10k students with 100 lessons each spread over two years around today, 500k homework
+and 500k notes. Seeded students are named bench-<n> and share the password PASSWORD.
+"""
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import hashing
+
+PASSWORD = 'bench'
+USERS = 10_000
+SCHEDULES = 1_000_000
+HOMEWORK = 500_000
+NOTES = 500_000
+
+
+def counts(scale: float) -> dict[str, int]:
+    return {
+        'users': max(int(USERS * scale), 1),
+        'schedules': int(SCHEDULES * scale),
+        'homework': int(HOMEWORK * scale),
+        'notes': int(NOTES * scale),
+    }
+
+
+async def is_seeded(engine: AsyncEngine) -> bool:
+    async with engine.connect() as conn:
+        return bool(await conn.scalar(text("SELECT count(*) FROM users WHERE username LIKE 'bench-%'")))
+
+
+async def seed(engine: AsyncEngine, scale: float) -> dict[str, float]:
+    """Insert the rows and return seconds spent per table"""
+    n = counts(scale)
+    hashed_password = await hashing.hash_password(PASSWORD)
+    timings = {}
+    statements = {
+        'users': (
+            "INSERT INTO users (username, full_name, hashed_password, tg_id, tg_hash, is_active, is_super, "
+            "balance, lesson_price, created, data_version) "
+            "SELECT 'bench-' || g, 'Student ' || g, :hashed_password, "
+            "CASE WHEN g % 2 = 0 THEN 1000000000 + g END, substr(md5('bench' || g), 1, 12), true, false, "
+            "(g % 50) * 500, 500 + (g % 5) * 100, now() - g * interval '1 minute', 0 "
+            "FROM generate_series(1, :users) g"),
+        # lessons from a year ago to a year ahead, those in the past reminded and charged
+        'schedules': (
+            "INSERT INTO schedule (user_id, note, scheduled_at, tg_notified, charged_at) "
+            "SELECT u.id, CASE WHEN g % 10 = 0 THEN 'note ' || g END, t, t < now(), CASE WHEN t < now() THEN t END "
+            "FROM generate_series(1, :schedules) g "
+            "CROSS JOIN LATERAL (SELECT now() + ((g::bigint * 7919) % 730 - 365) * interval '1 day' "
+            "                           + (g % 10) * interval '1 hour' AS t) times "
+            "JOIN users u ON u.username = 'bench-' || (1 + g % :users)"),
+        'homework': (
+            "INSERT INTO homework (user_id, name, files, created_at, search_vector) "
+            "SELECT u.id, name, files, now() - g * interval '1 minute', search_document(name, files) "
+            "FROM generate_series(1, :homework) g "
+            "CROSS JOIN LATERAL (SELECT 'Homework ' || g || ' ' || (ARRAY['algebra', 'geometry', 'physics', "
+            "'chemistry', 'essay'])[1 + g / :users % 5] AS name, ARRAY['docs/homework-' || g || '.pdf'] AS files) doc "
+            "JOIN users u ON u.username = 'bench-' || (1 + g % :users)"),
+        'notes': (
+            "INSERT INTO notes (user_id, name, files, created_at, search_vector) "
+            "SELECT u.id, name, files, now() - g * interval '1 minute', search_document(name, files) "
+            "FROM generate_series(1, :notes) g "
+            "CROSS JOIN LATERAL (SELECT 'Notes ' || g || ' ' || (ARRAY['lecture', 'summary', 'formulas', "
+            "'exam', 'reading'])[1 + g / :users % 5] AS name, ARRAY['docs/notes-' || g || '.pdf'] AS files) doc "
+            "JOIN users u ON u.username = 'bench-' || (1 + g % :users)"),
+    }
+    params = {**n, 'hashed_password': hashed_password}
+    for table, statement in statements.items():
+        start = time.perf_counter()
+        async with engine.begin() as conn:
+            # the API pool's statement_timeout is far below what a million rows take
+            await conn.execute(text('SET LOCAL statement_timeout = 0'))
+            await conn.execute(text(statement), {name: value for name, value in params.items()
+                                                 if f':{name}' in statement})
+        timings[table] = round(time.perf_counter() - start, 2)
+    async with engine.begin() as conn:
+        await conn.execute(text('SET LOCAL statement_timeout = 0'))
+        await conn.execute(text('ANALYZE users, schedule, homework, notes'))
+    return timings
@@ -0,0 +1,62 @@
+"""Migrate the database and create the default admin, before the API serves requests
+
+    python bootstrap.py
+
+The API does this on startup unless BOOTSTRAP_ON_STARTUP is off, e.g. when a deploy runs the
+command above once before starting the workers. Workers that start together take turns on an
+advisory lock; a database that is up to date costs each of them four small queries.
+"""
+import asyncio
+import json
+import logging
+import sys
+
+from sqlalchemy import select, func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+import config
+import hashing
+from sql_app import migrate, models
+
+logger = logging.getLogger(__name__)
+# pg_advisory_xact_lock key, distinct from settlement.LOCK_KEY
+LOCK_KEY = 0xb0075
+
+
+async def _ensure_admin(conn: AsyncConnection) -> bool:
+    admin = select(models.User.id).filter(models.User.username == config.ADMIN_USERNAME)
+    if await conn.scalar(admin) is not None:
+        return False
+    hashed_password = await hashing.hash_password(config.ADMIN_PASSWORD)
+    await conn.execute(insert(models.User).values(username=config.ADMIN_USERNAME, hashed_password=hashed_password,
+                                                  is_super=True).on_conflict_do_nothing(index_elements=['username']))
+    return True
+
+
+async def bootstrap(engine: AsyncEngine) -> dict[str, bool]:
+    async with engine.begin() as conn:
+        # the API pool's statement_timeout would cancel a worker waiting for the lock below as
+        # well as a migration backfilling a large table
+        await conn.execute(text('SET LOCAL statement_timeout = 0'))
+        # a worker that waited here finds everything done by the one before it
+        await conn.execute(select(func.pg_advisory_xact_lock(LOCK_KEY)))
+        migrated = not await conn.run_sync(migrate.is_up_to_date)
+        if migrated:
+            logger.info('Migrating the database to %s', ', '.join(sorted(migrate.head_revisions())))
+            await conn.run_sync(migrate.upgrade)
+        admin_created = await _ensure_admin(conn)
+    return {'migrated': migrated, 'admin_created': admin_created}
+
+
+async def main():
+    from sql_app.database import engine
+    try:
+        print(json.dumps(await bootstrap(engine)))
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main())
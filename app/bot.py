@@ -1,19 +1,105 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
 from os import getenv
 
 from aiogram import Bot
-from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaDocument
 from dotenv import load_dotenv
 
 load_dotenv()
 bot = Bot(token=getenv('BOT_TOKEN'), parse_mode='HTML')
 template = '🗞 <i>Новое уведомление</i>\n\n{}'
+# Bot API limits
+MEDIA_GROUP_SIZE = 10
+CAPTION_LIMIT = 1024
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FileIds:
+    """Telegram file_id of documents by sha256, and how a send used them"""
+    known: dict[str, str] = field(default_factory=dict)
+    hits: Counter = field(default_factory=Counter)
+    uploaded: dict[str, str] = field(default_factory=dict)
 
 
 async def send_text(chat_id: int, text: str):
     await bot.send_message(chat_id, template.format(text))
 
 
-async def send_files(chat_id: int, text: str, files: list[str]):
-    await bot.send_message(chat_id, template.format(text))
-    for f in files:
-        await bot.send_document(chat_id, document=FSInputFile(f))
+def _media(attachment, file_ids: FileIds, use_known: bool = True):
+    file_id = file_ids.known.get(attachment.sha256) if use_known else None
+    return file_id or FSInputFile(attachment.path, filename=attachment.filename)
+
+
+def _record(attachment, media, message, file_ids: FileIds):
+    if isinstance(media, str):
+        file_ids.hits[attachment.sha256] += 1
+    elif attachment.sha256:
+        file_ids.known[attachment.sha256] = file_ids.uploaded[attachment.sha256] = message.document.file_id
+
+
+async def send_document(chat_id: int, attachment, file_ids: FileIds, caption: str | None = None):
+    """Send by file_id when Telegram already has the file, upload it otherwise"""
+    media = _media(attachment, file_ids)
+    if isinstance(media, str):
+        try:
+            message = await bot.send_document(chat_id, document=media, caption=caption)
+            _record(attachment, media, message, file_ids)
+            return
+        except TelegramBadRequest as e:
+            # e.g. the bot token changed, file_ids belong to one bot
+            logger.warning('file_id of %s was rejected, uploading again: %s', attachment.sha256, e)
+            media = _media(attachment, file_ids, use_known=False)
+    message = await bot.send_document(chat_id, document=media, caption=caption)
+    _record(attachment, media, message, file_ids)
+
+
+async def send_media_group(chat_id: int, group: list, file_ids: FileIds, caption: str | None = None):
+    """Send 2 to 10 documents as one album, the caption goes on the first one"""
+    for use_known in (True, False):
+        media = [_media(attachment, file_ids, use_known) for attachment in group]
+        try:
+            messages = await bot.send_media_group(chat_id, [
+                InputMediaDocument(media=item, caption=caption if i == 0 else None) for i, item in enumerate(media)])
+        except TelegramBadRequest as e:
+            if not any(isinstance(item, str) for item in media):
+                break
+            logger.warning('Album with cached file_ids was rejected, uploading again: %s', e)
+            continue
+        for attachment, item, message in zip(group, media, messages):
+            _record(attachment, item, message, file_ids)
+        return
+    # not something Telegram takes as an album, send the documents one by one
+    for i, attachment in enumerate(group):
+        await send_document(chat_id, attachment, file_ids, caption if i == 0 else None)
+
+
+def api_calls(text: str, files: list) -> int:
+    """Bot API requests send_files makes when nothing has to be retried"""
+    calls = -(-len(files) // MEDIA_GROUP_SIZE)
+    if not files or len(template.format(text)) > CAPTION_LIMIT:
+        calls += 1
+    return calls
+
+
+async def send_files(chat_id: int, text: str, files: list, file_ids: FileIds | None = None):
+    """files are storage.Attachment; file_ids is updated with what was uploaded
+
+    The text becomes the caption of the first document, or a message of its own when there are
+    no files or it is too long for a caption.
+    """
+    file_ids = file_ids if file_ids is not None else FileIds()
+    caption = template.format(text)
+    if not files or len(caption) > CAPTION_LIMIT:
+        await bot.send_message(chat_id, caption)
+        caption = None
+    for start in range(0, len(files), MEDIA_GROUP_SIZE):
+        group = files[start:start + MEDIA_GROUP_SIZE]
+        if len(group) == 1:
+            await send_document(chat_id, group[0], file_ids, caption)
+        else:
+            await send_media_group(chat_id, group, file_ids, caption)
+        caption = None
@@ -0,0 +1,48 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+import metrics
+from sql_app.database import SessionLocal
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Handle at most limit updates at a time, the rest wait for a slot"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Count and time updates by type, including the wait for a concurrency slot"""
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        kind = event.event_type if isinstance(event, Update) else type(event).__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.bot_updates.inc(kind)
+            metrics.bot_update_duration.observe(time.perf_counter() - start, kind)
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Pass handlers a db session that is closed when the update is handled
+
+    The session only takes a connection from the pool once it runs a query.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        async with SessionLocal() as db:
+            data['db'] = db
+            return await handler(event, data)
@@ -1,27 +1,39 @@
 import asyncio
-import datetime
 import logging
 import random
+import secrets
 import string
 import sys
 from os import getenv
 
-import pytz
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, WebAppInfo, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from dotenv import load_dotenv
 
-from sql_app.crud import get_user_by_tg_hash, get_active_schedules_with_tg
-from sql_app.database import SessionLocal
+import config
+import metrics
+import profiler
+from bot_middlewares import ConcurrencyLimitMiddleware, DbSessionMiddleware, MetricsMiddleware
+from reminders import ReminderScheduler
+from sql_app.crud import get_user_by_tg_hash, bump_data_version
+from sql_app.database import use_pool
 
 load_dotenv()
+use_pool(config.BOT_DB_POOL)
 TOKEN = getenv("BOT_TOKEN")
 
 dp = Dispatcher()
+if config.METRICS_ENABLED:
+    dp.update.outer_middleware(MetricsMiddleware())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(config.BOT_UPDATE_CONCURRENCY))
+dp.update.outer_middleware(DbSessionMiddleware())
 
 
 def generate_tg_hash():
@@ -29,41 +41,17 @@ def generate_tg_hash():
     return ''.join(random.choice(letters) for i in range(12))
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-async def check_schedules(bot):
-    db = next(get_db())
-    tzdata = pytz.timezone('Europe/Moscow')
-    while True:
-        await asyncio.sleep(60)
-        cur_date = datetime.datetime.now(tz=pytz.timezone('Europe/Moscow'))
-        schedules = get_active_schedules_with_tg(db, cur_date)
-        for s in schedules:
-            if s.scheduled_at - cur_date < datetime.timedelta(hours=1):
-                await bot.send_message(s.user.tg_id, "⏰ Скоро занятие!\n\n"
-                                                     "На сегодня запланировано занятие в <b>{}</b>"
-                                       .format(s.scheduled_at.astimezone(tzdata).strftime("%H:%M")))
-                s.tg_notified = True
-        db.commit()
-
-
 @dp.message(CommandStart())
-async def command_start_handler(message: Message) -> None:
+async def command_start_handler(message: Message, db: AsyncSession) -> None:
     args = message.text.split(' ')
     if len(args) > 1:
         tg_hash = args[1]
-        db = next(get_db())
-        user = get_user_by_tg_hash(db, tg_hash)
+        user = await get_user_by_tg_hash(db, tg_hash)
         if user:
             user.tg_id = message.from_user.id
             user.tg_hash = generate_tg_hash()
-            db.commit()
+            await bump_data_version(db, [user.id])
+            await db.commit()
             await message.answer(
                 "{} теперь подключен к Telegram. Уведомления о занятиях и заданиях будут приходить сюда\n\n"
                 "<b>Если</b> возникнет необходимость подключить другой Telegram, перейдите по новой ссылке "
@@ -71,10 +59,39 @@ async def command_start_handler(message: Message) -> None:
                 .format(user.full_name))
 
 
+async def run_webhook(bot: Bot) -> None:
+    secret = config.BOT_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    app = web.Application()
+    # Telegram waits for each response and keeps at most max_connections requests open, so a
+    # burst of updates queues up on Telegram's side instead of in this process
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret,
+                         handle_in_background=False).register(app, path=config.BOT_WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.BOT_WEBHOOK_HOST, config.BOT_WEBHOOK_PORT).start()
+    await bot.set_webhook(config.BOT_WEBHOOK_URL.rstrip('/') + config.BOT_WEBHOOK_PATH, secret_token=secret,
+                          max_connections=config.BOT_UPDATE_CONCURRENCY,
+                          allowed_updates=dp.resolve_used_update_types())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main() -> None:
     bot = Bot(TOKEN, parse_mode=ParseMode.HTML)
-    asyncio.create_task(check_schedules(bot))
-    await dp.start_polling(bot)
+    profiler.instrument_engines()
+    if config.METRICS_ENABLED:
+        metrics.instrument_engines()
+    if config.BOT_METRICS_PORT:
+        await metrics.serve(config.BOT_METRICS_PORT)
+    asyncio.create_task(ReminderScheduler().run())
+    if config.BOT_WEBHOOK_URL:
+        await run_webhook(bot)
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
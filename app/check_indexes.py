@@ -0,0 +1,173 @@
+"""Fail if a crud query can only be answered by scanning a whole table
+
+Seeds the tables inside a transaction that is rolled back at the end, runs the queries of
+crud.py and storage.py that requests, the bot and delivery.py run, and EXPLAINs every
+statement they sent with enable_seqscan off, so the planner only falls back to a sequential
+scan when no index can serve the query. That checks that an index is available, not that the
+planner picks it: on real data a query that passes here may still be planned differently, see
+benchmarks/ for timings.
+
+Usage, against the database from config.py migrated to head:
+    python check_indexes.py
+"""
+import asyncio
+import datetime
+import json
+import sys
+from collections import Counter
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import storage
+from sql_app import crud, models, pagination, search
+from sql_app.database import engine
+
+USERS = 200
+ROWS_PER_USER = 20
+# calls that send more than one statement, as many whatever the number of rows
+STATEMENTS = {'claim_reminders': 3}  # the update, the data_version bump and its NOTIFY
+
+
+async def seed(db: AsyncSession) -> models.User:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    users = [models.User(username=f'explain-check-{i}', hashed_password='-', full_name=f'Student {i}',
+                         tg_id=100000 + i if i % 2 else None, is_super=False)
+             for i in range(USERS)]
+    db.add_all(users)
+    await db.flush()
+    for user in users:
+        for j in range(ROWS_PER_USER):
+            moment = now + datetime.timedelta(days=j - ROWS_PER_USER // 2, minutes=user.id)
+            db.add(models.Schedule(user_id=user.id, scheduled_at=moment, tg_notified=j % 3 == 0,
+                                   charged_at=moment if j < ROWS_PER_USER // 3 else None))
+            db.add(models.Homework(user_id=user.id, name=f'homework {j}', files=[],
+                                   search_vector=search.document(f'homework {j}', [])))
+            db.add(models.Notes(user_id=user.id, name=f'note {j}', files=[], search_vector=search.document(f'note {j}', [])))
+            digest = f'{user.id:032x}{j:032x}'
+            db.add(models.Blob(sha256=digest, filename=f'file {j}.pdf', content_type='application/pdf', size=1,
+                               ref_count=j % 2))
+            db.add(models.TelegramFile(sha256=digest, file_id=f'file-{user.id}-{j}'))
+            # mostly sent, as a drained outbox is
+            db.add(models.Outbox(chat_id=user.tg_id or user.id, text=f'message {j}',
+                                 status='pending' if j == 0 else 'sent', sent_at=None if j == 0 else moment))
+    await db.flush()
+    return users[1]
+
+
+async def _all(stream):
+    return await (await stream).all()
+
+
+def queries(user: models.User):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cursor = pagination.encode_cursor(now, 2 ** 31 - 1)
+    digests = [f'{user.id:032x}{j:032x}' for j in range(2)]
+    lease = datetime.timedelta(minutes=5)
+    return [
+        ('get_user', lambda db: crud.get_user(db, user.id)),
+        ('get_password_hash', lambda db: crud.get_password_hash(db, user.id)),
+        ('get_data_version', lambda db: crud.get_data_version(db, user.id)),
+        ('get_user_by_username', lambda db: crud.get_user_by_username(db, user.username)),
+        ('get_user_by_tg_hash', lambda db: crud.get_user_by_tg_hash(db, 'abcdefghijkl')),
+        ('get_users', lambda db: crud.get_users(db)),
+        ('get_users cursor', lambda db: crud.get_users(db, cursor=cursor)),
+        ('get_schedule', lambda db: crud.get_schedule(db, 1)),
+        ('get_schedules', lambda db: crud.get_schedules(db, False, user_id=user.id)),
+        ('get_schedules active', lambda db: crud.get_schedules(db, True, user_id=user.id)),
+        ('get_schedules all', lambda db: crud.get_schedules(db, False)),
+        ('get_schedules cursor', lambda db: crud.get_schedules(db, False, user_id=user.id, cursor=cursor)),
+        ('get_pending_reminders', lambda db: crud.get_pending_reminders(db, now, now + datetime.timedelta(hours=7))),
+        ('get_pending_reminders changed', lambda db: crud.get_pending_reminders(db, now, now + datetime.timedelta(hours=7), [1, 2])),
+        ('claim_reminders', lambda db: crud.claim_reminders(db, [1, 2], now)),
+        ('get_homework', lambda db: crud.get_homework(db, 1)),
+        ('get_homeworks', lambda db: crud.get_homeworks(db, user_id=user.id)),
+        ('get_homeworks all', lambda db: crud.get_homeworks(db)),
+        ('get_homeworks cursor', lambda db: crud.get_homeworks(db, user_id=user.id, cursor=cursor)),
+        ('search_homework', lambda db: crud.search_homework(db, user.id, 'home', 0)),
+        ('search_homework relevance', lambda db: crud.search_homework(db, user.id, 'home 1', 0, files=True, sort='relevance')),
+        ('get_note', lambda db: crud.get_note(db, 1)),
+        ('get_notes', lambda db: crud.get_notes(db, user_id=user.id)),
+        ('get_notes all', lambda db: crud.get_notes(db)),
+        ('get_notes cursor', lambda db: crud.get_notes(db, user_id=user.id, cursor=cursor)),
+        ('search_notes', lambda db: crud.search_notes(db, user.id, 'note', 0)),
+        ('search_notes relevance', lambda db: crud.search_notes(db, user.id, 'note 1', 0, files=True, sort='relevance')),
+        ('preview_settlement', lambda db: crud.preview_settlement(db, now, 5000)),
+        ('get_balance_forecast', lambda db: crud.get_balance_forecast(db, user.id, now + datetime.timedelta(days=30))),
+        ('get_ledger', lambda db: crud.get_ledger(db, user.id)),
+        ('get_feed_owner', lambda db: crud.get_feed_owner(db, 'feed-token')),
+        ('claim_outbox', lambda db: crud.claim_outbox(db, 50, lease)),
+        ('extend_outbox_lease', lambda db: crud.extend_outbox_lease(db, [1, 2], now, lease)),
+        ('next_outbox_attempt', lambda db: crud.next_outbox_attempt(db)),
+        ('purge_outbox', lambda db: crud.purge_outbox(db, now - datetime.timedelta(days=7))),
+        ('get_telegram_file_ids', lambda db: crud.get_telegram_file_ids(db, digests)),
+        ('get_blob', lambda db: storage.get_blob(db, digests[0])),
+        ('attachments', lambda db: storage.attachments(db, [storage.file_ref(d) for d in digests])),
+        ('stream_feed_lessons', lambda db: _all(crud.stream_feed_lessons(db, user.id, now, 100))),
+        ('get_schedules expand', lambda db: crud.get_schedules(db, False, user_id=user.id, expand_user=True)),
+        ('get_schedules all expand', lambda db: crud.get_schedules(db, False, expand_user=True)),
+        ('get_homeworks expand', lambda db: crud.get_homeworks(db, user_id=user.id, expand_user=True)),
+        ('get_homeworks all expand', lambda db: crud.get_homeworks(db, expand_user=True)),
+        ('search_homework expand', lambda db: crud.search_homework(db, user.id, 'home', 0, expand_user=True)),
+        ('get_notes expand', lambda db: crud.get_notes(db, user_id=user.id, expand_user=True)),
+        ('get_notes all expand', lambda db: crud.get_notes(db, expand_user=True)),
+        ('search_notes expand', lambda db: crud.search_notes(db, user.id, 'note', 0, expand_user=True)),
+    ]
+
+
+def full_scans(plan: dict) -> list[str]:
+    found = []
+    node = plan['Node Type']
+    if node == 'Seq Scan':
+        found.append(f"Seq Scan on {plan['Relation Name']}")
+    elif node in ('Index Scan', 'Index Only Scan') and 'Filter' in plan and 'Index Cond' not in plan:
+        # walks the whole index and filters rows one by one, a sequential scan in disguise
+        found.append(f"{node} using {plan['Index Name']} without an index condition")
+    for child in plan.get('Plans', []):
+        found.extend(full_scans(child))
+    return found
+
+
+async def main() -> int:
+    statements = []
+    current = None
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((current, statement, parameters))
+
+    async with engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            db = AsyncSession(bind=conn, autoflush=False, expire_on_commit=False)
+            user = await seed(db)
+            await conn.execute(text('ANALYZE users, schedule, homework, notes'))
+            event.listen(engine.sync_engine, 'before_cursor_execute', capture)
+            try:
+                for current, query in queries(user):
+                    await query(db)
+            finally:
+                event.remove(engine.sync_engine, 'before_cursor_execute', capture)
+            await conn.execute(text('SET LOCAL enable_seqscan = off'))
+            failed = 0
+            # each call is one statement however many rows it returns, so pages can't grow N+1 loads
+            counts = Counter(name for name, _, _ in statements)
+            for name, count in counts.items():
+                if count > STATEMENTS.get(name, 1):
+                    print(f'FAIL {name}: {count} statements')
+                    failed += 1
+            for name, statement, parameters in statements:
+                result = await conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)
+                plan = result.scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                problems = full_scans(plan[0]['Plan'])
+                print(f"{'FAIL' if problems else 'ok  '} {name}: {'; '.join(problems) or plan[0]['Plan']['Node Type']}")
+                failed += bool(problems)
+        finally:
+            await transaction.rollback()
+    await engine.dispose()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,126 @@
+import zlib
+
+import brotli
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Only these are compressed; files are served with ranges and mostly compressed already
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'application/xml')
+
+
+def _choose_encoding(accept_encoding: str) -> str | None:
+    """br or gzip, whichever the client accepts with the higher q (br on a tie)"""
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, *params = item.strip().split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+    wildcard = weights.get('*', 0.0)
+    best, best_q = None, 0.0
+    for coding in ('br', 'gzip'):
+        q = weights.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=brotli_quality)
+            self.compress, self.flush, self.finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self.compress, self.finish = compressor.compress, compressor.flush
+            self.flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """Compresses text and JSON responses of at least minimum_size bytes with br or gzip
+
+    Unlike starlette's GZipMiddleware it negotiates brotli, leaves file responses (they carry
+    Accept-Ranges) and non-text types alone and weakens strong ETags of what it compresses.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = _choose_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _Responder(self, encoding, send)(scope, receive)
+
+
+class _Responder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message: Message | None = None
+        # None until the first body message decides whether this response is compressed
+        self.compressor: _Compressor | None = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive):
+        await self.middleware.app(scope, receive, self.send_compressed)
+
+    def _compressible(self, headers: Headers) -> bool:
+        if self.start_message['status'] in (204, 206, 304) or 'content-encoding' in headers:
+            return False
+        if 'accept-ranges' in headers:
+            return False
+        return headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)
+
+    async def send_compressed(self, message: Message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+        if self.passthrough or message['type'] != 'http.response.body':
+            if self.start_message is not None:
+                await self.send(self.start_message)
+                self.start_message = None
+            await self.send(message)
+            return
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            if not self._compressible(headers) or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self.send_compressed(message)
+                return
+            self.compressor = _Compressor(self.encoding, self.middleware.gzip_level, self.middleware.brotli_quality)
+            headers['content-encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            etag = headers.get('etag')
+            if etag and not etag.startswith('W/'):
+                # the compressed bytes differ from what a strong validator promises
+                headers['etag'] = 'W/' + etag
+            if more_body:
+                del headers['content-length']
+            else:
+                body = self.compressor.compress(body) + self.compressor.finish()
+                headers['content-length'] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+            await self.send(self.start_message)
+            self.start_message = None
+        # a streamed chunk is flushed, or the compressor may hold it back until the response ends
+        body = self.compressor.compress(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+        await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
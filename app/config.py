@@ -1,7 +1,159 @@
+from os import getenv
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
 # POSTGRES_HOST = "172.17.0.1"
-POSTGRES_HOST = 'pgdb'
-POSTGRES_PORT = 5432
-POSTGRES_USER = 'cooluser'
-POSTGRES_PASS = 'coolpass'
-POSTGRES_DB = 'cooldb'
-POSTGRES_URI = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASS}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
\ No newline at end of file
+POSTGRES_HOST = getenv('POSTGRES_HOST', 'pgdb')
+POSTGRES_PORT = int(getenv('POSTGRES_PORT', 5432))
+POSTGRES_USER = getenv('POSTGRES_USER', 'cooluser')
+POSTGRES_PASS = getenv('POSTGRES_PASS', 'coolpass')
+POSTGRES_DB = getenv('POSTGRES_DB', 'cooldb')
+POSTGRES_URI = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASS}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+
+def _getbool(name: str, default: bool) -> bool:
+    value = getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _pool_settings(prefix: str, pool_size: int, max_overflow: int) -> dict:
+    # e.g. API_DB_POOL_SIZE, BOT_DB_STATEMENT_TIMEOUT
+    return {
+        'pool_size': int(getenv(f'{prefix}_DB_POOL_SIZE', pool_size)),
+        'max_overflow': int(getenv(f'{prefix}_DB_MAX_OVERFLOW', max_overflow)),
+        # seconds; connections older than this are replaced on checkout
+        'pool_recycle': int(getenv(f'{prefix}_DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': _getbool(f'{prefix}_DB_POOL_PRE_PING', True),
+        # seconds to wait for a free connection before failing
+        'pool_timeout': float(getenv(f'{prefix}_DB_POOL_TIMEOUT', 10)),
+        # milliseconds, 0 disables
+        'statement_timeout': int(getenv(f'{prefix}_DB_STATEMENT_TIMEOUT', 15000)),
+    }
+
+
+# The API and the bot are separate processes with separate pools
+API_DB_POOL = _pool_settings('API', pool_size=10, max_overflow=10)
+BOT_DB_POOL = _pool_settings('BOT', pool_size=3, max_overflow=2)
+
+# In-process cache of authenticated users, see sql_app/cache.py
+PRINCIPAL_CACHE_SIZE = int(getenv('PRINCIPAL_CACHE_SIZE', 1024))
+PRINCIPAL_CACHE_TTL = float(getenv('PRINCIPAL_CACHE_TTL', 30))
+
+# In-process cache of /schedule/get/, /homework/get/ and /note/get/ responses, see response_cache.py.
+# Entries are checked against users.data_version, the ttl only bounds memory held by idle users
+RESPONSE_CACHE_SIZE = int(getenv('RESPONSE_CACHE_SIZE', 4096))
+RESPONSE_CACHE_TTL = float(getenv('RESPONSE_CACHE_TTL', 3600))
+# users whose data_version is kept in memory, see response_cache.VersionTracker
+DATA_VERSION_CACHE_SIZE = int(getenv('DATA_VERSION_CACHE_SIZE', 16384))
+LISTING_CACHE_CONTROL = getenv('LISTING_CACHE_CONTROL', 'private, no-cache')
+
+# Password hashing, see hashing.py. Changing BCRYPT_ROUNDS rehashes passwords on next login
+BCRYPT_ROUNDS = int(getenv('BCRYPT_ROUNDS', 12))
+HASHING_WORKERS = int(getenv('HASHING_WORKERS', 4))
+# requests allowed to wait for a worker before new ones get 503
+HASHING_QUEUE_LIMIT = int(getenv('HASHING_QUEUE_LIMIT', 64))
+
+# Uploads, see uploads.py. Sizes are in bytes
+UPLOAD_CHUNK_SIZE = int(getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+UPLOAD_MAX_FILE_SIZE = int(getenv('UPLOAD_MAX_FILE_SIZE', 50 * 1024 * 1024))
+UPLOAD_MAX_REQUEST_SIZE = int(getenv('UPLOAD_MAX_REQUEST_SIZE', 200 * 1024 * 1024))
+# files of one request written at the same time
+UPLOAD_CONCURRENCY = int(getenv('UPLOAD_CONCURRENCY', 4))
+# seconds an unreferenced blob is kept before garbage collection deletes it
+BLOB_GC_GRACE = int(getenv('BLOB_GC_GRACE', 600))
+# seconds between garbage collections of the API, 0 turns them off
+BLOB_GC_INTERVAL = int(getenv('BLOB_GC_INTERVAL', 300))
+
+# Cache-Control of /file/ responses. Blobs never change; other files are revalidated with ETags
+BLOB_CACHE_CONTROL = getenv('BLOB_CACHE_CONTROL', 'private, max-age=31536000, immutable')
+FILE_CACHE_CONTROL = getenv('FILE_CACHE_CONTROL', 'private, no-cache')
+
+# Response compression, see compression.py. Smaller bodies are sent as they are
+COMPRESSION_MIN_SIZE = int(getenv('COMPRESSION_MIN_SIZE', 1024))
+GZIP_LEVEL = int(getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(getenv('BROTLI_QUALITY', 4))
+
+# lessons one /schedule/bulk/ request may create
+SCHEDULE_BULK_LIMIT = int(getenv('SCHEDULE_BULK_LIMIT', 20000))
+# days from start_date to end_date of one recurrence rule
+SCHEDULE_RECURRENCE_MAX_DAYS = int(getenv('SCHEDULE_RECURRENCE_MAX_DAYS', 731))
+
+# iCalendar lesson feeds, see ics.py. Lessons that started more than ICS_PAST_DAYS ago are left out
+ICS_PAST_DAYS = int(getenv('ICS_PAST_DAYS', 90))
+ICS_LESSON_MINUTES = int(getenv('ICS_LESSON_MINUTES', 60))
+ICS_CALENDAR_NAME = getenv('ICS_CALENDAR_NAME', 'Занятия')
+ICS_EVENT_SUMMARY = getenv('ICS_EVENT_SUMMARY', 'Занятие')
+# event UIDs are lesson-{id}@ICS_UID_DOMAIN
+ICS_UID_DOMAIN = getenv('ICS_UID_DOMAIN', 'lessons.local')
+# minutes calendar apps are asked to wait between polls; unchanged feeds are answered 304
+ICS_REFRESH_MINUTES = int(getenv('ICS_REFRESH_MINUTES', 15))
+# lessons fetched from the database per batch while a feed is streamed
+ICS_BATCH_SIZE = int(getenv('ICS_BATCH_SIZE', 500))
+FEED_CACHE_CONTROL = getenv('FEED_CACHE_CONTROL', 'private, no-cache')
+
+# Lesson settlement, see settlement.py. Lessons charged per statement and seconds between runs
+SETTLEMENT_BATCH_SIZE = int(getenv('SETTLEMENT_BATCH_SIZE', 5000))
+SETTLEMENT_INTERVAL = int(getenv('SETTLEMENT_INTERVAL', 300))
+
+# Telegram reminders, see reminders.py. Seconds
+REMINDER_LEAD = int(getenv('REMINDER_LEAD', 3600))
+# reminders due this far ahead are kept in memory, the window is reloaded when half of it has passed
+REMINDER_WINDOW = int(getenv('REMINDER_WINDOW', 6 * 3600))
+
+# Telegram delivery, see delivery.py. Rates are API calls per second
+OUTBOX_GLOBAL_RATE = float(getenv('OUTBOX_GLOBAL_RATE', 25))
+OUTBOX_CHAT_RATE = float(getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(getenv('OUTBOX_CHAT_BURST', 3))
+OUTBOX_BATCH_SIZE = int(getenv('OUTBOX_BATCH_SIZE', 50))
+# chats sent to in parallel
+OUTBOX_CONCURRENCY = int(getenv('OUTBOX_CONCURRENCY', 8))
+# pool of delivery.py: a session per chat sent to and one renewing the leases
+DELIVERY_DB_POOL = _pool_settings('DELIVERY', pool_size=OUTBOX_CONCURRENCY + 1, max_overflow=2)
+# seconds a claimed message is hidden from other workers; it is retried if the worker dies meanwhile
+OUTBOX_LEASE = int(getenv('OUTBOX_LEASE', 300))
+# retries wait OUTBOX_BACKOFF_BASE * 2 ** (attempt - 1) seconds, up to OUTBOX_BACKOFF_MAX
+OUTBOX_MAX_ATTEMPTS = int(getenv('OUTBOX_MAX_ATTEMPTS', 8))
+OUTBOX_BACKOFF_BASE = float(getenv('OUTBOX_BACKOFF_BASE', 5))
+OUTBOX_BACKOFF_MAX = float(getenv('OUTBOX_BACKOFF_MAX', 3600))
+# seconds between checks for due retries when no new message arrives
+OUTBOX_POLL_INTERVAL = float(getenv('OUTBOX_POLL_INTERVAL', 30))
+# days sent messages are kept for latency stats
+OUTBOX_RETENTION_DAYS = int(getenv('OUTBOX_RETENTION_DAYS', 7))
+
+# Telegram bot, see bot_polling.py. Updates handled at once, keep it within BOT_DB_POOL
+BOT_UPDATE_CONCURRENCY = int(getenv('BOT_UPDATE_CONCURRENCY', BOT_DB_POOL['pool_size']))
+# Public https URL to receive updates by webhook, long polling is used when empty
+BOT_WEBHOOK_URL = getenv('BOT_WEBHOOK_URL', '')
+BOT_WEBHOOK_PATH = getenv('BOT_WEBHOOK_PATH', '/tg/webhook')
+BOT_WEBHOOK_HOST = getenv('BOT_WEBHOOK_HOST', '0.0.0.0')
+BOT_WEBHOOK_PORT = int(getenv('BOT_WEBHOOK_PORT', 8080))
+# Checked against the X-Telegram-Bot-Api-Secret-Token header; a random one is set on every start if empty
+BOT_WEBHOOK_SECRET = getenv('BOT_WEBHOOK_SECRET', '')
+
+# Prometheus metrics, see metrics.py. /metrics of the API requires "Authorization: Bearer METRICS_TOKEN" if set
+METRICS_ENABLED = _getbool('METRICS_ENABLED', True)
+METRICS_TOKEN = getenv('METRICS_TOKEN', '')
+# /metrics of bot_polling.py and delivery.py, 0 turns it off
+METRICS_HOST = getenv('METRICS_HOST', '0.0.0.0')
+BOT_METRICS_PORT = int(getenv('BOT_METRICS_PORT', 9101))
+DELIVERY_METRICS_PORT = int(getenv('DELIVERY_METRICS_PORT', 9102))
+
+# SQL profiler and slow-query log, see profiler.py. Statements slower than SLOW_QUERY_MS are logged, 0 turns it off
+SLOW_QUERY_MS = float(getenv('SLOW_QUERY_MS', 500))
+# slow queries listed by /stats/slow_queries/
+SLOW_QUERY_KEEP = int(getenv('SLOW_QUERY_KEEP', 100))
+# statements of the same shape run this often in one request are reported as a likely N+1 load
+PROFILE_REPEAT_THRESHOLD = int(getenv('PROFILE_REPEAT_THRESHOLD', 5))
+# statements recorded per profile, further ones are only counted
+PROFILE_MAX_STATEMENTS = int(getenv('PROFILE_MAX_STATEMENTS', 1000))
+# profiles kept for /stats/profiles/
+PROFILE_KEEP = int(getenv('PROFILE_KEEP', 50))
+
+# Migrations and the default admin on API startup, see bootstrap.py. Turn off when a deploy runs bootstrap.py itself
+BOOTSTRAP_ON_STARTUP = _getbool('BOOTSTRAP_ON_STARTUP', True)
+ADMIN_USERNAME = getenv('ADMIN_USERNAME', 'admin')
+ADMIN_PASSWORD = getenv('ADMIN_PASSWORD', '12345678')
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+from aiogram.exceptions import (TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError, TelegramNotFound,
+                                TelegramMigrateToChat)
+
+import config
+import metrics
+import profiler
+import storage
+from bot import FileIds, send_files, api_calls
+from sql_app import crud, database
+from sql_app.database import SessionLocal, use_pool
+
+logger = logging.getLogger(__name__)
+# retrying can't help with these
+PERMANENT_ERRORS = (TelegramBadRequest, TelegramForbiddenError, TelegramNotFound, TelegramMigrateToChat,
+                    FileNotFoundError)
+RETRY_DELAY = 5
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self, tokens: float = 1):
+        # A request for more than the capacity waits for a full bucket and leaves it in debt
+        needed = min(tokens, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= needed:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+
+class DeliveryWorker:
+    """Sends the messages queued in the outbox table by crud.enqueue_message
+
+    Every Bot API call takes a token from a bucket shared by all chats and from a bucket of its
+    chat. A flood wait (retry_after) pauses all sending; other failures are retried with
+    exponential backoff and end in the dead state after OUTBOX_MAX_ATTEMPTS. Delivery is at least
+    once: a worker that dies mid-send leaves the message to be sent again when its lease ends.
+    While a batch is in flight its leases are renewed, so waiting for the buckets or a flood
+    pause doesn't hand the messages to another worker.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(config.OUTBOX_GLOBAL_RATE, max(config.OUTBOX_GLOBAL_RATE, 1))
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.lease = datetime.timedelta(seconds=config.OUTBOX_LEASE)
+        self._wakeup = asyncio.Event()
+        self._chats = asyncio.Semaphore(config.OUTBOX_CONCURRENCY)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._wakeup.set()
+
+    def _on_terminate(self, connection):
+        self._wakeup.set()
+
+    async def _throttle(self, chat_id: int, calls: int):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(config.OUTBOX_CHAT_RATE, config.OUTBOX_CHAT_BURST)
+        await self.chat_buckets[chat_id].acquire(calls)
+        await self.global_bucket.acquire(calls)
+        while (pause := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(config.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), config.OUTBOX_BACKOFF_MAX)
+        return delay * random.uniform(0.5, 1)
+
+    async def _deliver(self, message):
+        try:
+            async with SessionLocal() as db:
+                attachments = await storage.attachments(db, message.files)
+                file_ids = FileIds(await crud.get_telegram_file_ids(db, [a.sha256 for a in attachments]))
+            await self._throttle(message.chat_id, api_calls(message.text, attachments))
+            start = time.perf_counter()
+            try:
+                await send_files(message.chat_id, message.text, attachments, file_ids)
+            finally:
+                metrics.outbox_send_duration.observe(time.perf_counter() - start)
+                if file_ids.hits or file_ids.uploaded:
+                    async with SessionLocal() as db:
+                        await crud.record_telegram_files(db, file_ids.hits, file_ids.uploaded)
+        except TelegramRetryAfter as e:
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            logger.warning('Flood limit hit, pausing delivery for %s s', e.retry_after)
+            metrics.outbox_messages.inc('flood_wait')
+            async with SessionLocal() as db:
+                await crud.retry_outbox(db, message, e.retry_after, str(e), count_attempt=False)
+        except PERMANENT_ERRORS as e:
+            logger.warning('Outbox message %s is undeliverable: %s', message.id, e)
+            metrics.outbox_messages.inc('dead')
+            async with SessionLocal() as db:
+                await crud.mark_outbox_dead(db, message, str(e))
+        except Exception as e:
+            async with SessionLocal() as db:
+                if message.attempts >= config.OUTBOX_MAX_ATTEMPTS:
+                    logger.exception('Outbox message %s failed %s times, giving up', message.id, message.attempts)
+                    await crud.mark_outbox_dead(db, message, str(e))
+                    metrics.outbox_messages.inc('dead')
+                else:
+                    logger.warning('Outbox message %s failed, retrying: %r', message.id, e)
+                    metrics.outbox_messages.inc('retry')
+                    await crud.retry_outbox(db, message, self._backoff(message.attempts), str(e))
+        else:
+            async with SessionLocal() as db:
+                await crud.mark_outbox_sent(db, message)
+            metrics.outbox_messages.inc('sent')
+            metrics.outbox_delivery_lag.observe(
+                (datetime.datetime.now(datetime.timezone.utc) - message.created_at).total_seconds())
+
+    async def _deliver_chat(self, messages, held: set[int]):
+        # messages of one chat go one at a time to keep their order, OUTBOX_CONCURRENCY chats at once
+        async with self._chats:
+            for message in messages:
+                try:
+                    await self._deliver(message)
+                finally:
+                    held.discard(message.id)
+
+    async def _keep_leases(self, held: set[int], leased_until):
+        while leased_until:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            if not held:
+                return
+            try:
+                async with SessionLocal() as db:
+                    leased_until = await crud.extend_outbox_lease(db, list(held), leased_until, self.lease)
+            except Exception:
+                logger.exception('Renewing outbox leases failed')
+
+    async def drain(self) -> int:
+        """Send every message that is due, returns how many were attempted"""
+        attempted = 0
+        while True:
+            async with SessionLocal() as db:
+                messages = await crud.claim_outbox(db, config.OUTBOX_BATCH_SIZE, self.lease)
+            if not messages:
+                return attempted
+            chats = defaultdict(list)
+            for message in messages:
+                chats[message.chat_id].append(message)
+            held = {message.id for message in messages}
+            keeper = asyncio.create_task(self._keep_leases(held, messages[0].next_attempt_at))
+            try:
+                await asyncio.gather(*(self._deliver_chat(chat, held) for chat in chats.values()))
+            finally:
+                keeper.cancel()
+            attempted += len(messages)
+            self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                                 if not bucket.full()}
+
+    async def _serve(self, listener):
+        purged_at = 0.0
+        while not listener.is_closed():
+            self._wakeup.clear()
+            await self.drain()
+            if time.monotonic() - purged_at > 3600:
+                async with SessionLocal() as db:
+                    before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=config.OUTBOX_RETENTION_DAYS)
+                    await crud.purge_outbox(db, before)
+                purged_at = time.monotonic()
+            async with SessionLocal() as db:
+                next_attempt = await crud.next_outbox_attempt(db)
+            timeout = config.OUTBOX_POLL_INTERVAL
+            if next_attempt:
+                wait = (next_attempt - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                timeout = min(timeout, max(wait, 0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        while True:
+            try:
+                async with database.listen_engine().connect() as conn:
+                    listener = (await conn.get_raw_connection()).driver_connection
+                    await listener.add_listener(crud.OUTBOX_CHANNEL, self._on_notify)
+                    listener.add_termination_listener(self._on_terminate)
+                    try:
+                        await self._serve(listener)
+                    finally:
+                        listener.remove_termination_listener(self._on_terminate)
+                        if not listener.is_closed():
+                            await listener.remove_listener(crud.OUTBOX_CHANNEL, self._on_notify)
+            except Exception:
+                logger.exception('Delivery worker failed, restarting in %s s', RETRY_DELAY)
+            await asyncio.sleep(RETRY_DELAY)
+
+
+async def main():
+    use_pool(config.DELIVERY_DB_POOL)
+    profiler.instrument_engines()
+    if config.METRICS_ENABLED:
+        metrics.instrument_engines()
+    if config.DELIVERY_METRICS_PORT:
+        await metrics.serve(config.DELIVERY_METRICS_PORT)
+    await DeliveryWorker().run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main())
@@ -0,0 +1,59 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+import config
+
+# min == max == default: hashes made with any other cost are reported by verify_and_update
+# and get rehashed on the next successful login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=config.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=config.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=config.BCRYPT_ROUNDS,
+)
+
+# bcrypt releases the GIL while hashing, so threads are enough to keep it off the event loop
+_executor = ThreadPoolExecutor(max_workers=config.HASHING_WORKERS, thread_name_prefix='bcrypt')
+_pending = 0
+
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= config.HASHING_WORKERS + config.HASHING_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password operations, try again later",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await _run(pwd_context.verify, password, hashed_password)
+
+
+async def verify_and_update(password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Verify a password; the second item is a new hash when the stored one uses outdated settings"""
+    return await _run(pwd_context.verify_and_update, password, hashed_password)
+
+
+def stats() -> dict:
+    return {
+        'workers': config.HASHING_WORKERS,
+        'queue_limit': config.HASHING_QUEUE_LIMIT,
+        'pending': _pending,
+        'rounds': config.BCRYPT_ROUNDS,
+    }
@@ -0,0 +1,87 @@
+"""iCalendar (RFC 5545) text of the lesson feeds served by /schedule/feed/{feed_token}.ics
+
+The text is produced a few lessons at a time as rows arrive from the database, so a feed is
+never held in memory whole. Besides the lessons it only depends on the ICS_ settings and the
+DTSTAMP passed in, which lets the route derive its ETag without rendering anything.
+"""
+import datetime
+import functools
+import hashlib
+
+import config
+
+# change when the generated text changes, so the ETags of existing feeds do too
+FORMAT_VERSION = 1
+# longest content line in octets, longer ones are folded
+LINE_OCTETS = 75
+CALENDAR_END = 'END:VCALENDAR\r\n'
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def escape(text: str) -> str:
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\r', '\\n').replace('\n', '\\n'))
+
+
+def fold(line: str) -> str:
+    """The content line ending in CRLF, folded without splitting a UTF-8 character"""
+    data = line.encode()
+    if len(data) <= LINE_OCTETS:
+        return line + '\r\n'
+    parts = []
+    start, limit = 0, LINE_OCTETS
+    while len(data) - start > limit:
+        end = start + limit
+        # continuation bytes of a multi-byte character are 0b10xxxxxx
+        while data[end] & 0xc0 == 0x80:
+            end -= 1
+        parts.append(data[start:end])
+        # the leading space of a continuation line counts too
+        start, limit = end, LINE_OCTETS - 1
+    parts.append(data[start:])
+    return b'\r\n '.join(parts).decode() + '\r\n'
+
+
+def timestamp(moment: datetime.datetime) -> str:
+    return moment.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def calendar_start() -> str:
+    return ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//lessons//schedule feed//RU',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape(config.ICS_CALENDAR_NAME)}',
+        f'REFRESH-INTERVAL;VALUE=DURATION:PT{config.ICS_REFRESH_MINUTES}M',
+        f'X-PUBLISHED-TTL:PT{config.ICS_REFRESH_MINUTES}M',
+    ))
+
+
+def lessons(rows, stamp: datetime.datetime) -> str:
+    """VEVENTs of (id, scheduled_at, note) rows; stamp is the DTSTAMP of all of them"""
+    duration = datetime.timedelta(minutes=config.ICS_LESSON_MINUTES)
+    dtstamp = f'DTSTAMP:{timestamp(stamp)}\r\n'
+    summary = fold(f'SUMMARY:{escape(config.ICS_EVENT_SUMMARY)}')
+    events = []
+    for lesson_id, scheduled_at, note in rows:
+        events.append(f'BEGIN:VEVENT\r\n{fold(f"UID:lesson-{lesson_id}@{config.ICS_UID_DOMAIN}")}{dtstamp}'
+                      f'DTSTART:{timestamp(scheduled_at)}\r\nDTEND:{timestamp(scheduled_at + duration)}\r\n{summary}')
+        if note:
+            events.append(fold(f'DESCRIPTION:{escape(note)}'))
+        events.append('END:VEVENT\r\n')
+    return ''.join(events)
+
+
+@functools.cache
+def _variant() -> str:
+    # everything besides the lessons and DTSTAMP that the text depends on
+    return hashlib.blake2b(repr((FORMAT_VERSION, config.ICS_PAST_DAYS, config.ICS_LESSON_MINUTES, config.ICS_CALENDAR_NAME,
+                                 config.ICS_EVENT_SUMMARY, config.ICS_UID_DOMAIN, config.ICS_REFRESH_MINUTES))
+                           .encode(), digest_size=4).hexdigest()
+
+
+def etag(user_id: int, stamp: datetime.datetime) -> str:
+    micros = (stamp - EPOCH) // datetime.timedelta(microseconds=1)
+    return f'"{user_id:x}-{micros:x}-{_variant()}"'
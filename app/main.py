@@ -1,14 +1,44 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import schedule, users, note, homework, files, token
+from fastapi.responses import ORJSONResponse
+
+import bootstrap
+import config
+from compression import CompressionMiddleware
+import profiler
+import storage
+from metrics import MetricsMiddleware, instrument_engines
+from response_cache import data_versions
+from routers import schedule, users, note, homework, files, token, stats, metrics
+
+from sql_app.database import engine
+from sql_app.pagination import NEXT_CURSOR_HEADER
 
-from sql_app import models, crud, schemas
-from sql_app.database import engine, SessionLocal
 
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if config.BOOTSTRAP_ON_STARTUP:
+        await bootstrap.bootstrap(engine)
+    # keeps the listing cache's view of users.data_version current
+    tasks = [asyncio.create_task(data_versions.run())]
+    if config.BLOB_GC_INTERVAL:
+        # blobs released by deletes, updates and sent Telegram messages
+        tasks.append(asyncio.create_task(storage.run_garbage_collection()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        await engine.dispose()
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 # Routers on every path
 app.include_router(schedule.router)
 app.include_router(files.router)
@@ -16,6 +46,8 @@ app.include_router(homework.router)
 app.include_router(note.router)
 app.include_router(token.router)
 app.include_router(users.router)
+app.include_router(stats.router)
+app.include_router(metrics.router)
 origins = [
     "*",
 ]
@@ -26,19 +58,18 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, profiler.PROFILE_HEADER],
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MIN_SIZE,
+    gzip_level=config.GZIP_LEVEL,
+    brotli_quality=config.BROTLI_QUALITY,
+)
+app.add_middleware(profiler.ProfilerMiddleware)
+profiler.instrument_engines()
+if config.METRICS_ENABLED:
+    # outermost, so the latency includes compression
+    app.add_middleware(MetricsMiddleware)
+    instrument_engines()
 
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-# Create default user
-try:
-    crud.create_user(next(get_db()), schemas.UserCreate(username="admin", password="12345678"), is_super=True)
-except HTTPException:
-    pass
@@ -0,0 +1,240 @@
+"""Prometheus metrics of this process in the text exposition format
+
+Metrics are plain numbers updated on the event loop, recording one is a dict lookup and an
+addition. The API serves them on /metrics, bot_polling.py and delivery.py with serve(). DB queries
+are timed by engine events and, inside a request, added up and counted under its route.
+"""
+import contextvars
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import config
+from sql_app import database
+
+# starlette adds the charset to text/ types by itself
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+# route label of queries run outside a request
+BACKGROUND = 'background'
+
+_registry: list['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = {} if labelnames else {(): 0}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+                for labels, value in self.values.items()]
+
+
+class Gauge(_Metric):
+    """Read from read() when rendered"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, read):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def samples(self) -> list[str]:
+        return [f'{self.name} {_number(self.read())}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # per label values: observations per bucket, the last one for +Inf, and their sum
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(self.sums[labels])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+http_requests = Counter('http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status'))
+http_request_duration = Histogram('http_request_duration_seconds', 'HTTP request latency', ('method', 'route'))
+db_queries = Counter('db_queries_total', 'DB queries by the route of the request that ran them', ('route',))
+db_query_seconds = Counter('db_query_seconds_total', 'Time spent in DB queries by route', ('route',))
+db_query_duration = Histogram('db_query_duration_seconds', 'DB query latency', buckets=QUERY_BUCKETS)
+db_pool_checked_out = Gauge('db_pool_checked_out', 'DB connections in use',
+                            lambda: database.engine.pool.checkedout())
+upload_files = Counter('upload_files_total', 'Files uploaded')
+upload_bytes = Counter('upload_bytes_total', 'Bytes of uploaded files')
+file_sent_bytes = Counter('file_sent_bytes_total', 'Bytes of files sent by /file/')
+notifications_queued = Counter('notifications_queued_total', 'Telegram messages queued in the outbox')
+bot_updates = Counter('bot_updates_total', 'Telegram updates handled by type', ('type',))
+bot_update_duration = Histogram('bot_update_duration_seconds', 'Telegram update handling time', ('type',))
+reminders_queued = Counter('reminders_queued_total', 'Lesson reminders queued')
+reminder_lag = Histogram('reminder_lag_seconds', 'Delay between a reminder being due and it being queued',
+                         buckets=LAG_BUCKETS)
+outbox_messages = Counter('outbox_messages_total', 'Outbox messages by delivery result', ('result',))
+outbox_send_duration = Histogram('outbox_send_duration_seconds', 'Time to send one outbox message')
+outbox_delivery_lag = Histogram('outbox_delivery_lag_seconds', 'Delay between queueing and sending a message',
+                                buckets=LAG_BUCKETS)
+
+
+class _Queries:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+_request_queries: contextvars.ContextVar[_Queries | None] = contextvars.ContextVar('request_queries', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    db_query_duration.observe(elapsed)
+    queries = _request_queries.get()
+    if queries is None:
+        db_queries.inc(BACKGROUND)
+        db_query_seconds.inc(BACKGROUND, amount=elapsed)
+    else:
+        queries.count += 1
+        queries.seconds += elapsed
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def instrument_engines():
+    """Time the queries of every engine, including ones created later by database.use_pool"""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+class MetricsMiddleware:
+    """Counts and times requests by route template, e.g. /homework/{homework_id}"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes: dict | None = None
+
+    def _route(self, scope: Scope) -> str:
+        if self._routes is None:
+            self._routes = {route.endpoint: route.path for route in scope['app'].routes
+                            if hasattr(route, 'endpoint')}
+        return self._routes.get(scope.get('endpoint'), 'unmatched')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        queries = _Queries()
+        token = _request_queries.set(queries)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_queries.reset(token)
+            route = self._route(scope)
+            http_requests.inc(scope['method'], route, status)
+            http_request_duration.observe(elapsed, scope['method'], route)
+            if queries.count:
+                db_queries.inc(route, amount=queries.count)
+                db_query_seconds.inc(route, amount=queries.seconds)
+
+
+async def serve(port: int):
+    """Serve /metrics on port with aiohttp, for the processes without the API"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode(), headers={'Content-Type': f'{CONTENT_TYPE}; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, config.METRICS_HOST, port).start()
+    return runner
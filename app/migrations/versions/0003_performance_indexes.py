@@ -0,0 +1,51 @@
+"""indexes for the queries in crud.py
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 12:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # get_user_by_tg_hash, get_active_schedules_with_tg
+    op.create_index('ix_users_tg_hash', 'users', ['tg_hash'])
+    op.create_index('ix_users_tg_id', 'users', ['tg_id'])
+    # get_users
+    op.create_index('ix_users_students_created', 'users', ['created', 'id'],
+                    postgresql_where=sa.text('is_super = false'))
+    # get_schedules for one user / for everyone
+    op.create_index('ix_schedule_user_id_scheduled_at', 'schedule', ['user_id', 'scheduled_at', 'id'])
+    op.create_index('ix_schedule_scheduled_at', 'schedule', ['scheduled_at', 'id'])
+    # get_active_schedules_with_tg: only unsent reminders
+    op.create_index('ix_schedule_pending_reminders', 'schedule', ['scheduled_at'],
+                    postgresql_where=sa.text('tg_notified = false'))
+    # get_homeworks / search_homework, get_notes / search_notes
+    op.create_index('ix_homework_user_id_created_at', 'homework', ['user_id', 'created_at', 'id'])
+    op.create_index('ix_homework_created_at', 'homework', ['created_at', 'id'])
+    op.create_index('ix_notes_user_id_created_at', 'notes', ['user_id', 'created_at', 'id'])
+    op.create_index('ix_notes_created_at', 'notes', ['created_at', 'id'])
+    # storage.collect_garbage
+    op.create_index('ix_blobs_orphaned_at', 'blobs', ['orphaned_at'], postgresql_where=sa.text('ref_count <= 0'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_blobs_orphaned_at', table_name='blobs')
+    op.drop_index('ix_notes_created_at', table_name='notes')
+    op.drop_index('ix_notes_user_id_created_at', table_name='notes')
+    op.drop_index('ix_homework_created_at', table_name='homework')
+    op.drop_index('ix_homework_user_id_created_at', table_name='homework')
+    op.drop_index('ix_schedule_pending_reminders', table_name='schedule')
+    op.drop_index('ix_schedule_scheduled_at', table_name='schedule')
+    op.drop_index('ix_schedule_user_id_scheduled_at', table_name='schedule')
+    op.drop_index('ix_users_students_created', table_name='users')
+    op.drop_index('ix_users_tg_id', table_name='users')
+    op.drop_index('ix_users_tg_hash', table_name='users')
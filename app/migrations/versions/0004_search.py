@@ -0,0 +1,45 @@
+"""full-text search over homework and notes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 13:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+# The name is weighted A and the attached file names B, so a search can be limited to
+# names by asking for weight A only. Blob refs are resolved to their original file name,
+# older refs ("docs/name.pdf") are used as they are.
+SEARCH_DOCUMENT = """
+CREATE OR REPLACE FUNCTION search_document(name text, files text[]) RETURNS tsvector
+LANGUAGE sql STABLE AS $$
+    SELECT setweight(to_tsvector('simple', regexp_replace(coalesce(name, ''), '[[:punct:]]+', ' ', 'g')), 'A')
+        || setweight(to_tsvector('simple', regexp_replace(coalesce(
+            (SELECT string_agg(coalesce(b.filename, substr(f, 6)), ' ')
+             FROM unnest(files) AS f LEFT JOIN blobs AS b ON b.sha256 = substr(f, 6)), ''),
+            '[[:punct:]]+', ' ', 'g')), 'B')
+$$
+"""
+
+
+def upgrade() -> None:
+    op.execute(SEARCH_DOCUMENT)
+    for table in ('homework', 'notes'):
+        op.add_column(table, sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+        op.execute(f'UPDATE {table} SET search_vector = search_document(name, files)')
+        op.create_index(f'ix_{table}_search_vector', table, ['search_vector'], postgresql_using='gin')
+
+
+def downgrade() -> None:
+    for table in ('homework', 'notes'):
+        op.drop_index(f'ix_{table}_search_vector', table_name=table)
+        op.drop_column(table, 'search_vector')
+    op.execute('DROP FUNCTION search_document(text, text[])')
@@ -0,0 +1,31 @@
+"""telegram file_id cache
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 15:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'telegram_files',
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('file_id', sa.String(), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.Column('uploads', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('sha256'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('telegram_files')
@@ -0,0 +1,45 @@
+"""lesson settlement: schedule.charged_at and the ledger
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 17:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('schedule', sa.Column('charged_at', sa.DateTime(timezone=True), nullable=True))
+    # Lessons held before settlement existed were paid for by hand, so they are not charged again
+    op.execute('UPDATE schedule SET charged_at = scheduled_at WHERE scheduled_at <= now()')
+    op.create_index('ix_schedule_uncharged', 'schedule', ['scheduled_at', 'id'],
+                    postgresql_where=sa.text('charged_at IS NULL'))
+    op.create_table(
+        'ledger',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('schedule_id', sa.Integer(), nullable=True),
+        sa.Column('amount', sa.DECIMAL(), nullable=False),
+        sa.Column('balance_after', sa.DECIMAL(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['schedule_id'], ['schedule.id'], ondelete='set null'),
+        sa.PrimaryKeyConstraint('id'),
+        # one charge per lesson, whatever runs the settlement
+        sa.UniqueConstraint('schedule_id', name='uq_ledger_schedule_id'),
+    )
+    op.create_index('ix_ledger_user_id_created_at', 'ledger', ['user_id', 'created_at', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_ledger_user_id_created_at', table_name='ledger')
+    op.drop_table('ledger')
+    op.drop_index('ix_schedule_uncharged', table_name='schedule')
+    op.drop_column('schedule', 'charged_at')
@@ -0,0 +1,27 @@
+"""users.feed_token and users.schedule_changed_at for iCalendar feeds
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 22:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('feed_token', sa.String(), nullable=True))
+    op.add_column('users', sa.Column('schedule_changed_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_unique_constraint('uq_users_feed_token', 'users', ['feed_token'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_users_feed_token', 'users', type_='unique')
+    op.drop_column('users', 'schedule_changed_at')
+    op.drop_column('users', 'feed_token')
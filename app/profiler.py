@@ -0,0 +1,237 @@
+"""Per-request SQL profiles and the slow-query log
+
+A super user's request sent with the X-Profile: 1 header or ?profile=1 records every statement it
+runs with its time and the app code that ran it. Statement shapes run PROFILE_REPEAT_THRESHOLD
+times or more are reported as likely N+1 loads. The X-Profile response header has a summary and
+the id of the full profile at /stats/profiles/{profile_id}.
+
+Statements slower than SLOW_QUERY_MS are logged by every process, with their call site.
+"""
+import collections
+import contextvars
+import datetime
+import logging
+import os
+import re
+import sys
+import time
+import uuid
+
+import greenlet
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import config
+
+logger = logging.getLogger(__name__)
+PROFILE_HEADER = 'X-Profile'
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# app frames kept per call site, innermost first
+SITE_DEPTH = 3
+STATEMENT_LOG_LENGTH = 2000
+# middleware frames say nothing about where a statement comes from
+_SKIP_FILES = tuple(os.path.join(APP_DIR, name) for name in ('profiler.py', 'metrics.py', 'compression.py'))
+# asyncpg placeholders; IN lists of different lengths are one shape
+_PLACEHOLDER_RE = re.compile(r'\$\d+')
+_LIST_RE = re.compile(r'\?(?:::\w+)?(?:\s*,\s*\?(?:::\w+)?)+')
+
+
+def shape(statement: str) -> str:
+    return _LIST_RE.sub('?, ...', _PLACEHOLDER_RE.sub('?', ' '.join(statement.split())))
+
+
+def call_site() -> list[str]:
+    """The innermost app frames that ran the statement, e.g. sql_app/crud.py:120 get_schedules
+
+    The statement runs in a greenlet started by the async session, so the awaiting coroutines
+    are found in the frames of its parent greenlet.
+    """
+    site = []
+    current = greenlet.getcurrent()
+    frame = sys._getframe(1)
+    while len(site) < SITE_DEPTH:
+        if frame is None:
+            current = current.parent
+            if current is None:
+                break
+            frame = current.gr_frame
+            continue
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and 'site-packages' not in filename and filename not in _SKIP_FILES:
+            site.append(f'{os.path.relpath(filename, APP_DIR)}:{frame.f_lineno} {frame.f_code.co_name}')
+        frame = frame.f_back
+    return site
+
+
+class Profile:
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.status = None
+        # only a super user's profile is kept and reported, see authorize()
+        self.authorized = False
+        self.statements: list[dict] = []
+        self.queries = 0
+        self.db_seconds = 0.0
+
+    def record(self, statement: str, started: float, elapsed: float):
+        self.queries += 1
+        self.db_seconds += elapsed
+        if len(self.statements) < config.PROFILE_MAX_STATEMENTS:
+            self.statements.append({
+                'statement': statement,
+                'offset_ms': round((started - self.start) * 1000, 3),
+                'ms': round(elapsed * 1000, 3),
+                'site': call_site(),
+            })
+
+    def repeated(self) -> list[dict]:
+        groups = collections.defaultdict(list)
+        for statement in self.statements:
+            groups[shape(statement['statement'])].append(statement)
+        return sorted(({
+            'shape': statement_shape,
+            'count': len(statements),
+            'ms': round(sum(s['ms'] for s in statements), 3),
+            'sites': sorted({' <- '.join(s['site']) for s in statements}),
+        } for statement_shape, statements in groups.items() if len(statements) >= config.PROFILE_REPEAT_THRESHOLD),
+            key=lambda group: -group['count'])
+
+    def summary(self) -> dict:
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': self.status,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'queries': self.queries,
+            'db_ms': round(self.db_seconds * 1000, 3),
+            'repeated': len(self.repeated()),
+        }
+
+    def report(self) -> dict:
+        return {**self.summary(), 'truncated': self.queries > len(self.statements),
+                'repeated': self.repeated(), 'statements': self.statements}
+
+    def header(self) -> str:
+        summary = self.summary()
+        return '; '.join(f'{name}={summary[name]}' for name in ('id', 'queries', 'db_ms', 'repeated'))
+
+
+class _Request:
+    __slots__ = ('method', 'path', 'profile')
+
+    def __init__(self, method: str, path: str, profile: Profile | None):
+        self.method = method
+        self.path = path
+        self.profile = profile
+
+
+_request: contextvars.ContextVar[_Request | None] = contextvars.ContextVar('profiled_request', default=None)
+# the latest profiles of super users by id, oldest first
+profiles: collections.OrderedDict[str, Profile] = collections.OrderedDict()
+slow_queries: collections.deque[dict] = collections.deque(maxlen=config.SLOW_QUERY_KEEP)
+
+
+def authorize(user):
+    """Called with the authenticated user; a profile is only kept for a super user"""
+    request = _request.get()
+    if request is not None and request.profile is not None:
+        request.profile.authorized = user.is_super
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['profiler_start'].pop()
+    elapsed = time.perf_counter() - started
+    request = _request.get()
+    if request is not None and request.profile is not None:
+        request.profile.record(statement, started, elapsed)
+    if config.SLOW_QUERY_MS and elapsed * 1000 >= config.SLOW_QUERY_MS:
+        site = call_site()
+        where = f'{request.method} {request.path}' if request is not None else 'background'
+        logger.warning('Slow query %.1f ms in %s at %s: %s', elapsed * 1000, where, ' <- '.join(site),
+                       statement[:STATEMENT_LOG_LENGTH])
+        slow_queries.append({
+            'at': datetime.datetime.now(datetime.timezone.utc),
+            'ms': round(elapsed * 1000, 3),
+            'request': where,
+            'site': site,
+            'statement': statement[:STATEMENT_LOG_LENGTH],
+        })
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('profiler_start'):
+        context.connection.info['profiler_start'].pop()
+
+
+def instrument_engines():
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+class QueryCounter:
+    """Statements sent through the engine since count was last reset, for tests and benchmarks"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def _requested(scope: Scope) -> bool:
+    for name, value in scope['headers']:
+        if name == b'x-profile':
+            return value in (b'1', b'true')
+    return b'profile=1' in scope.get('query_string', b'').split(b'&')
+
+
+class ProfilerMiddleware:
+    """Starts a profile when one is requested and adds its X-Profile header to the response"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        profile = Profile(scope['method'], scope['path']) if _requested(scope) else None
+        token = _request.set(_Request(scope['method'], scope['path'], profile))
+        if profile is None:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                _request.reset(token)
+            return
+
+        async def send_with_profile(message: Message):
+            # background tasks run after the response and aren't part of the profile
+            if message['type'] == 'http.response.start' and profile.authorized:
+                profile.status = message['status']
+                profile.duration = time.perf_counter() - profile.start
+                profiles[profile.id] = profile
+                while len(profiles) > config.PROFILE_KEEP:
+                    profiles.popitem(last=False)
+                MutableHeaders(scope=message).append(PROFILE_HEADER, profile.header())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            _request.reset(token)
@@ -0,0 +1,72 @@
+import datetime
+
+import pytz
+from fastapi import HTTPException
+from starlette import status
+
+import config
+from sql_app import schemas
+
+
+def _too_many():
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"At most {config.SCHEDULE_BULK_LIMIT} lessons per request",
+    )
+
+
+def expand(rule: schemas.ScheduleRecurrence) -> list[datetime.datetime]:
+    """Start time of every lesson of the rule, in order"""
+    try:
+        tz = pytz.timezone(rule.timezone)
+    except pytz.UnknownTimeZoneError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unknown timezone",
+        )
+    if rule.end_date < rule.start_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="end_date is before start_date",
+        )
+    if (rule.end_date - rule.start_date).days >= config.SCHEDULE_RECURRENCE_MAX_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {config.SCHEDULE_RECURRENCE_MAX_DAYS} days per rule",
+        )
+    # every lesson is created for every user, stop as soon as the request is over the limit
+    max_times = config.SCHEDULE_BULK_LIMIT // max(len(set(rule.user_ids)), 1)
+    weekdays = set(rule.weekdays)
+    exceptions = set(rule.exceptions)
+    times = []
+    day = rule.start_date
+    while day <= rule.end_date:
+        if day.weekday() in weekdays and day not in exceptions:
+            if len(times) == max_times:
+                _too_many()
+            times.append(tz.localize(datetime.datetime.combine(day, rule.time.replace(tzinfo=None))))
+        day += datetime.timedelta(days=1)
+    return times
+
+
+def rows(bulk: schemas.ScheduleBulkCreate) -> list[dict]:
+    """The schedule rows a bulk request creates"""
+    if (bulk.schedules is None) == (bulk.recurrence is None):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Pass either schedules or recurrence",
+        )
+    if bulk.schedules is not None:
+        # naive times are UTC, as Postgres would store them; mixed with aware ones they can't be compared
+        result = [{'user_id': s.user_id, 'note': s.note,
+                   'scheduled_at': s.scheduled_at if s.scheduled_at.tzinfo else
+                   s.scheduled_at.replace(tzinfo=datetime.timezone.utc)}
+                  for s in bulk.schedules]
+    else:
+        rule = bulk.recurrence
+        times = expand(rule)
+        result = [{'user_id': user_id, 'scheduled_at': scheduled_at, 'note': rule.note}
+                  for user_id in dict.fromkeys(rule.user_ids) for scheduled_at in times]
+    if len(result) > config.SCHEDULE_BULK_LIMIT:
+        _too_many()
+    return result
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import heapq
+import logging
+
+import pytz
+
+import config
+import metrics
+from sql_app import crud, database
+from sql_app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+TIMEZONE = pytz.timezone('Europe/Moscow')
+# seconds to wait before reconnecting after the scheduler failed
+RETRY_DELAY = 5
+TEXT = "⏰ Скоро занятие!\n\nНа сегодня запланировано занятие в <b>{}</b>"
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ReminderScheduler:
+    """Queues the "lesson soon" message REMINDER_LEAD seconds before each lesson
+
+    Reminders due within the next REMINDER_WINDOW seconds are kept in a min-heap and the loop
+    sleeps until the first of them is due. Changes made through /schedule/* arrive by LISTEN on
+    crud.SCHEDULE_CHANNEL, so only the changed rows are read again. Whether a reminder is still
+    owed is decided by the database when it fires, so stale heap entries or a restart can't
+    queue a reminder twice or for a lesson that was deleted. delivery.py sends the messages.
+    """
+
+    def __init__(self):
+        self.lead = datetime.timedelta(seconds=config.REMINDER_LEAD)
+        self.window = datetime.timedelta(seconds=config.REMINDER_WINDOW)
+        self._heap: list[tuple[datetime.datetime, int]] = []
+        # due time of every schedule in the heap; heap entries that don't match are stale
+        self._due: dict[int, datetime.datetime] = {}
+        self._changed: set[int] = set()
+        self._reload_requested = False
+        self._wakeup = asyncio.Event()
+        self._window_end = _now()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        if payload:
+            self._changed.add(int(payload))
+        else:
+            self._reload_requested = True
+        self._wakeup.set()
+
+    def _on_terminate(self, connection):
+        self._wakeup.set()
+
+    def _push(self, schedule_id: int, scheduled_at: datetime.datetime):
+        due = scheduled_at - self.lead
+        self._due[schedule_id] = due
+        heapq.heappush(self._heap, (due, schedule_id))
+
+    async def _reload(self, now: datetime.datetime):
+        self._changed.clear()
+        self._reload_requested = False
+        self._window_end = now + self.window
+        async with SessionLocal() as db:
+            rows = await crud.get_pending_reminders(db, now, self._window_end + self.lead)
+        self._heap.clear()
+        self._due.clear()
+        for row in rows:
+            self._push(row.id, row.scheduled_at)
+
+    async def _refresh(self, now: datetime.datetime):
+        changed, self._changed = self._changed, set()
+        async with SessionLocal() as db:
+            rows = await crud.get_pending_reminders(db, now, self._window_end + self.lead, changed)
+        for schedule_id in changed:
+            self._due.pop(schedule_id, None)
+        for row in rows:
+            self._push(row.id, row.scheduled_at)
+
+    async def _fire(self, now: datetime.datetime):
+        schedule_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, schedule_id = heapq.heappop(self._heap)
+            if self._due.get(schedule_id) == due:
+                del self._due[schedule_id]
+                schedule_ids.append(schedule_id)
+        if not schedule_ids:
+            return
+        async with SessionLocal() as db:
+            for reminder in await crud.claim_reminders(db, schedule_ids, now):
+                metrics.reminders_queued.inc()
+                metrics.reminder_lag.observe((_now() - reminder.scheduled_at + self.lead).total_seconds())
+                await crud.queue_message(db, reminder.tg_id, TEXT.format(
+                    reminder.scheduled_at.astimezone(TIMEZONE).strftime("%H:%M")))
+            await db.commit()
+
+    async def _serve(self, listener):
+        await self._reload(_now())
+        while not listener.is_closed():
+            now = _now()
+            if self._reload_requested or now >= self._window_end - self.window / 2:
+                await self._reload(now)
+            elif self._changed:
+                await self._refresh(now)
+            await self._fire(now)
+            self._wakeup.clear()
+            if self._changed or self._reload_requested:
+                continue
+            wake_at = self._window_end - self.window / 2
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max((wake_at - _now()).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        while True:
+            try:
+                async with database.listen_engine().connect() as conn:
+                    listener = (await conn.get_raw_connection()).driver_connection
+                    await listener.add_listener(crud.SCHEDULE_CHANNEL, self._on_notify)
+                    listener.add_termination_listener(self._on_terminate)
+                    try:
+                        await self._serve(listener)
+                    finally:
+                        listener.remove_termination_listener(self._on_terminate)
+                        if not listener.is_closed():
+                            await listener.remove_listener(crud.SCHEDULE_CHANNEL, self._on_notify)
+            except Exception:
+                logger.exception('Reminder scheduler failed, restarting in %s s', RETRY_DELAY)
+            await asyncio.sleep(RETRY_DELAY)
@@ -0,0 +1,158 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from fastapi import Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import Response
+
+import config
+from responses import etag_matches
+from sql_app import crud, database
+from sql_app.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+# seconds to wait before listening again after the connection was lost
+RETRY_DELAY = 5
+# headers that belong to one response rather than to the listing
+_OWN_HEADERS = ('content-length', 'content-type', 'etag', 'cache-control')
+
+
+class VersionTracker:
+    """users.data_version of the users seen by this process, kept current by LISTEN
+
+    crud.bump_data_version announces every change on crud.DATA_VERSION_CHANNEL. The versions are
+    only trusted while the listener is connected, otherwise every lookup reads the database.
+    The listener has a connection of its own, outside the pool of database.engine.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        # a user that dropped out is read from the database again
+        self.versions = TTLCache(maxsize, ttl)
+        # changes whenever versions may have missed notifications
+        self.generation = 0
+        self.listening = False
+        self._terminated: asyncio.Event | None = None
+
+    def _observe(self, user_id: int, version: int):
+        # reads and notifications can arrive in any order, a version only grows
+        known = self.versions.get(user_id)
+        if known is None or version > known:
+            self.versions.set(user_id, version)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        for pair in payload.split(','):
+            user_id, version = pair.split(':')
+            self._observe(int(user_id), int(version))
+
+    def _on_terminate(self, connection):
+        self.listening = False
+        self._terminated.set()
+
+    async def get(self, db: AsyncSession, user_id: int) -> int | None:
+        if self.listening:
+            version = self.versions.get(user_id)
+            if version is not None:
+                return version
+        generation, listening = self.generation, self.listening
+        version = await crud.get_data_version(db, user_id)
+        # a read that started before LISTEN may have missed a bump, so it isn't kept
+        if version is not None and listening and self.listening and generation == self.generation:
+            self._observe(user_id, version)
+        return version
+
+    async def run(self):
+        # bound to the running loop, which differs between runs of the app's lifespan in tests
+        self._terminated = asyncio.Event()
+        while True:
+            try:
+                async with database.listen_engine().connect() as conn:
+                    listener = (await conn.get_raw_connection()).driver_connection
+                    await listener.add_listener(crud.DATA_VERSION_CHANNEL, self._on_notify)
+                    listener.add_termination_listener(self._on_terminate)
+                    self._terminated.clear()
+                    self.versions.clear()
+                    self.generation += 1
+                    self.listening = True
+                    try:
+                        while not listener.is_closed():
+                            try:
+                                await asyncio.wait_for(self._terminated.wait(), RETRY_DELAY * 12)
+                            except asyncio.TimeoutError:
+                                pass
+                    finally:
+                        self.listening = False
+                        self.generation += 1
+                        listener.remove_termination_listener(self._on_terminate)
+                        if not listener.is_closed():
+                            await listener.remove_listener(crud.DATA_VERSION_CHANNEL, self._on_notify)
+            except Exception:
+                logger.exception('Data version listener failed, restarting in %s s', RETRY_DELAY)
+            await asyncio.sleep(RETRY_DELAY)
+
+
+@dataclass
+class _Entry:
+    version: int
+    etag: str
+    body: bytes
+    headers: dict[str, str]
+    # the listing changes by itself at this time, e.g. when a lesson stops being upcoming
+    valid_until: datetime.datetime | None
+
+
+class ResponseCache:
+    """Listing responses by path, user and query string, valid while the user's data_version holds
+
+    A poll whose If-None-Match matches is answered 304 without touching the database.
+    """
+
+    def __init__(self, versions: VersionTracker, maxsize: int, ttl: float):
+        self.versions = versions
+        self.entries = TTLCache(maxsize, ttl)
+
+    @staticmethod
+    def _etag(key, version: int, valid_until: datetime.datetime | None) -> str:
+        digest = hashlib.blake2b(repr((key, valid_until)).encode(), digest_size=8).hexdigest()
+        return f'"{version}-{digest}"'
+
+    async def respond(self, request: Request, db: AsyncSession, user_id: int | None,
+                      load: Callable[[], Awaitable[tuple[Response, datetime.datetime | None]]]) -> Response:
+        """Cached response for the listing of user_id, or load()'s if there is none
+
+        load returns the response and the time it stops being valid by itself, if any.
+        """
+        if user_id is None:
+            return (await load())[0]
+        version = await self.versions.get(db, user_id)
+        if version is None:
+            return (await load())[0]
+        key = (request.url.path, user_id, tuple(sorted(request.query_params.multi_items())))
+        if_none_match = request.headers.get('if-none-match')
+        entry = self.entries.get(key)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if entry is not None and entry.version == version and (entry.valid_until is None or entry.valid_until > now):
+            headers = {**entry.headers, 'etag': entry.etag, 'cache-control': config.LISTING_CACHE_CONTROL}
+            if if_none_match is not None and etag_matches(if_none_match, entry.etag):
+                return Response(status_code=304, headers=headers)
+            return Response(entry.body, media_type='application/json', headers=headers)
+        response, valid_until = await load()
+        if response.status_code != 200:
+            return response
+        etag = self._etag(key, version, valid_until)
+        headers = {name: value for name, value in response.headers.items() if name not in _OWN_HEADERS}
+        self.entries.set(key, _Entry(version, etag, response.body, headers, valid_until))
+        response.headers['etag'] = etag
+        response.headers['cache-control'] = config.LISTING_CACHE_CONTROL
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            # the entry was evicted but the client has this very listing
+            return Response(status_code=304, headers={**headers, 'etag': etag,
+                                                      'cache-control': config.LISTING_CACHE_CONTROL})
+        return response
+
+
+data_versions = VersionTracker(config.DATA_VERSION_CACHE_SIZE, config.RESPONSE_CACHE_TTL)
+listings = ResponseCache(data_versions, config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL)
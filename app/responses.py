@@ -0,0 +1,198 @@
+import os
+import stat
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+import aiofiles
+from pydantic import TypeAdapter
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+import metrics
+
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+
+
+def _parse_ranges(header: str, size: int) -> list[tuple[int, int]] | None:
+    """Inclusive (start, end) pairs of a Range header, [] if none is satisfiable, None if it's unusable"""
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if start:
+                first, last = int(start), int(end) if end else size - 1
+                if end and first > last:
+                    return None
+            else:
+                suffix = int(end)
+                first, last = max(size - suffix, 0), size - 1
+                if suffix == 0:
+                    continue
+        except ValueError:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == '*':
+        return True
+    # weak comparison, as If-None-Match requires
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+def not_modified(request_headers: Headers, etag: str, mtime: int) -> bool:
+    """Whether a conditional GET is answered 304; If-Modified-Since only counts without If-None-Match"""
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    header = request_headers.get('if-modified-since')
+    if header is None:
+        return False
+    try:
+        return mtime <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class SchemaResponse(Response):
+    """JSON of content validated and serialized in one pass by a TypeAdapter compiled at import
+
+    For large listings. FastAPI's own path builds a dict per row before encoding it.
+    """
+    media_type = 'application/json'
+
+    def __init__(self, adapter: TypeAdapter, content, status_code: int = 200, headers=None):
+        super().__init__(adapter.dump_json(adapter.validate_python(content, from_attributes=True)),
+                         status_code, headers)
+
+
+class RangeFileResponse(Response):
+    """File response with validators, conditional GET (304) and byte ranges (206)
+
+    Uses the ASGI zero-copy send extension when the server offers it.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, request_headers: Headers, media_type: str = 'application/octet-stream',
+                 filename: str | None = None, etag: str | None = None, cache_control: str | None = None,
+                 content_disposition_type: str = 'inline'):
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        stat_result = os.stat(path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise FileNotFoundError(path)
+        self.size = stat_result.st_size
+        self.etag = etag or f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+        self.mtime = int(stat_result.st_mtime)
+        headers = {
+            'etag': self.etag,
+            'last-modified': formatdate(self.mtime, usegmt=True),
+            'accept-ranges': 'bytes',
+        }
+        if cache_control:
+            headers['cache-control'] = cache_control
+        if filename:
+            quoted = quote(filename)
+            if quoted != filename:
+                headers['content-disposition'] = f"{content_disposition_type}; filename*=utf-8''{quoted}"
+            else:
+                headers['content-disposition'] = f'{content_disposition_type}; filename="{filename}"'
+        self.status_code, self.ranges, self.boundary = self._evaluate(request_headers)
+        if self.status_code == 304:
+            self.init_headers(headers)
+            return
+        if self.status_code == 416:
+            headers['content-range'] = f'bytes */{self.size}'
+            self.init_headers(headers)
+            return
+        if self.status_code == 206 and len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            headers['content-range'] = f'bytes {start}-{end}/{self.size}'
+            headers['content-length'] = str(end - start + 1)
+            headers['content-type'] = media_type
+        elif self.status_code == 206:
+            self.parts = [(self._part_header(start, end), start, end) for start, end in self.ranges]
+            closing = f'\r\n--{self.boundary}--\r\n'.encode()
+            length = sum(len(head) + end - start + 1 for head, start, end in self.parts) + len(closing)
+            headers['content-length'] = str(length)
+            headers['content-type'] = f'multipart/byteranges; boundary={self.boundary}'
+        else:
+            headers['content-length'] = str(self.size)
+            headers['content-type'] = media_type
+        self.init_headers(headers)
+
+    def _evaluate(self, request_headers: Headers):
+        if not_modified(request_headers, self.etag, self.mtime):
+            return 304, [], None
+        range_header = request_headers.get('range')
+        if range_header is None or not self._if_range_holds(request_headers.get('if-range')):
+            return 200, [], None
+        ranges = _parse_ranges(range_header, self.size)
+        if ranges is None:
+            return 200, [], None
+        if not ranges:
+            return 416, [], None
+        return 206, ranges, uuid.uuid4().hex if len(ranges) > 1 else None
+
+    def _if_range_holds(self, header: str | None) -> bool:
+        if header is None:
+            return True
+        if header.startswith('"') or header.startswith('W/'):
+            # strong comparison only
+            return header == self.etag
+        try:
+            return self.mtime == int(parsedate_to_datetime(header).timestamp())
+        except (TypeError, ValueError):
+            return False
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (f'\r\n--{self.boundary}\r\n'
+                f'Content-Type: {self.media_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n').encode()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if self.status_code in (304, 416) or scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if self.status_code == 206 and self.boundary:
+            async with aiofiles.open(self.path, 'rb') as file:
+                for head, start, end in self.parts:
+                    await send({'type': 'http.response.body', 'body': head, 'more_body': True})
+                    await self._send_range(file, start, end, send)
+            await send({'type': 'http.response.body', 'body': f'\r\n--{self.boundary}--\r\n'.encode()})
+            return
+        start, end = self.ranges[0] if self.ranges else (0, self.size - 1)
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as file:
+                await send({'type': 'http.response.zerocopysend', 'file': file.fileno(),
+                            'offset': start, 'count': end - start + 1})
+            metrics.file_sent_bytes.inc(amount=end - start + 1)
+            return
+        async with aiofiles.open(self.path, 'rb') as file:
+            await self._send_range(file, start, end, send)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _send_range(self, file, start: int, end: int, send: Send):
+        await file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await file.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            metrics.file_sent_bytes.inc(amount=len(chunk))
@@ -1,7 +1,13 @@
-from fastapi import APIRouter, Depends
-from starlette.responses import FileResponse
+import mimetypes
 
-from dependencies import get_current_active_user
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+import config
+import storage
+from dependencies import get_current_active_user, get_db
+from responses import RangeFileResponse
 
 router = APIRouter(
     prefix="/file",
@@ -10,6 +16,22 @@ router = APIRouter(
 )
 
 
-@router.get("/{file_name}", response_class=FileResponse)
-async def get_file(file_name: str):
-    return f'docs/{file_name}'
+@router.get("/{file_name}", response_class=RangeFileResponse)
+async def get_file(file_name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    try:
+        if storage.is_digest(file_name):
+            blob = await storage.get_blob(db, file_name)
+            if blob is None:
+                raise FileNotFoundError(file_name)
+            # The digest is a strong validator by itself
+            return RangeFileResponse(storage.blob_path(blob.sha256), request.headers, media_type=blob.content_type,
+                                     filename=blob.filename, etag=f'"{blob.sha256}"',
+                                     cache_control=config.BLOB_CACHE_CONTROL)
+        return RangeFileResponse(f'docs/{file_name}', request.headers,
+                                 media_type=mimetypes.guess_type(file_name)[0] or 'text/plain',
+                                 cache_control=config.FILE_CACHE_CONTROL)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found",
+        )
@@ -1,14 +1,15 @@
-import asyncio
-from typing import Annotated, Optional
+from typing import Annotated, Optional, Literal
 
-import aiofiles
-from fastapi import Form, UploadFile, Depends, HTTPException, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import Form, UploadFile, Depends, HTTPException, APIRouter, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from bot import send_files
+from response_cache import listings
+from responses import SchemaResponse
+from uploads import save_uploads
 from dependencies import get_current_active_user, get_db
 from sql_app import schemas, crud
+from sql_app.pagination import set_next_cursor
 from sql_app.schemas import User
 
 
@@ -22,34 +23,27 @@ router = APIRouter(
 async def create_homework(name: Annotated[str, Form()], files: list[UploadFile],
                           user_id: Annotated[int, Form()],
                           current_user: Annotated[User, Depends(get_current_active_user)],
-                          db: Session = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db)):
     if not current_user.is_super:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    filepaths = []
-    for file in files:
-        filepath = f'docs/{file.filename}'
-        async with aiofiles.open(filepath, 'wb') as out_file:
-            content = await file.read()
-            await out_file.write(content)
-            filepaths.append(filepath)
-    homework = crud.create_homework(db, name, user_id, filepaths)
-    if homework.user.tg_id:
-        asyncio.create_task(send_files(homework.user.tg_id, 'Было добавлено новое домашнее задание:\n{}'
-                                       .format(homework.name), homework.files))
+    filepaths = await save_uploads(db, files)
+    homework = await crud.create_homework(db, name, user_id, filepaths,
+                                          notification='Было добавлено новое домашнее задание:\n{}'.format(name))
     return homework
 
 
-@router.get("/get/", response_model=list[schemas.Homework])
-async def get_homeworks(current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db), user_id: int | None = None, offset: int = 0):
+@router.get("/get/", response_model=list[schemas.Homework] | list[schemas.HomeworkSlim])
+async def get_homeworks(current_user: Annotated[User, Depends(get_current_active_user)], request: Request,
+                        response: Response, db: AsyncSession = Depends(get_db), user_id: int | None = None,
+                        offset: int = 0, cursor: str | None = None, expand: Literal['user'] | None = None):
     if current_user.is_super or current_user.id == user_id:
-        return crud.get_homeworks(db, user_id=user_id, skip=offset)
+        owner_id = user_id
     elif not user_id:
-        return crud.get_homeworks(db, user_id=current_user.id, skip=offset)
+        owner_id = current_user.id
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -57,19 +51,38 @@ async def get_homeworks(current_user: Annotated[User, Depends(get_current_active
             headers={"WWW-Authenticate": "Bearer"}
         )
 
+    async def load():
+        homeworks = await crud.get_homeworks(db, user_id=owner_id, skip=offset, cursor=cursor, expand_user=expand == 'user')
+        set_next_cursor(response, homeworks, 'created_at')
+        return SchemaResponse(schemas.HOMEWORK_LIST if expand == 'user' else schemas.HOMEWORK_SLIM_LIST, homeworks,
+                              headers=response.headers), None
+    return await listings.respond(request, db, owner_id, load)
+
 
-@router.get('/search/', response_model=list[schemas.Homework])
-async def search_homework(q: str, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db), offset: int = 0):
-    return crud.search_homework(db, current_user.id, q, offset)
+@router.get('/search/', response_model=list[schemas.Homework] | list[schemas.HomeworkSlim])
+async def search_homework(q: str, current_user: Annotated[User, Depends(get_current_active_user)], response: Response,
+                        db: AsyncSession = Depends(get_db), offset: int = 0, cursor: str | None = None,
+                        files: bool = False, sort: Literal['recent', 'relevance'] = 'recent',
+                        expand: Literal['user'] | None = None):
+    homeworks = await crud.search_homework(db, current_user.id, q, offset, cursor=cursor, files=files, sort=sort,
+                                           expand_user=expand == 'user')
+    if sort == 'recent':
+        set_next_cursor(response, homeworks, 'created_at')
+    return SchemaResponse(schemas.HOMEWORK_LIST if expand == 'user' else schemas.HOMEWORK_SLIM_LIST, homeworks,
+                          headers=response.headers)
 
 
 @router.get("/delete/{homework_id}")
 async def delete_homework(homework_id: int, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     if current_user.is_super:
-        crud.delete_homework(db, homework_id)
-        return {"status": "success"}
+        if await crud.delete_homework(db, homework_id):
+            return {"status": "success"}
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Error while deleting",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -84,7 +97,7 @@ async def update_homework(
         current_user: Annotated[User, Depends(get_current_active_user)],
         name: Optional[str] = Form(None),
         files: Optional[list[UploadFile]] = Form(None),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_super:
         raise HTTPException(
@@ -94,13 +107,8 @@ async def update_homework(
         )
     filepaths = []
     if files:
-        for file in files:
-            filepath = f'docs/{file.filename}'
-            async with aiofiles.open(filepath, 'wb') as out_file:
-                content = await file.read()
-                await out_file.write(content)
-                filepaths.append(filepath)
-    homework = crud.update_homework(db, name, homework_id, filepaths)
+        filepaths = await save_uploads(db, files)
+    homework = await crud.update_homework(db, name, homework_id, filepaths)
     if homework:
         return homework
     else:
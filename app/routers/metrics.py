@@ -0,0 +1,20 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from starlette import status
+
+import config
+import metrics
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    # scraped by Prometheus, which authenticates with a static token rather than a user
+    if config.METRICS_TOKEN and request.headers.get('authorization') != f'Bearer {config.METRICS_TOKEN}':
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
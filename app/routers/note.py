@@ -1,13 +1,14 @@
-import asyncio
-from typing import Annotated, Optional
+from typing import Annotated, Optional, Literal
 
-import aiofiles
-from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Form, UploadFile, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from bot import send_files
+from response_cache import listings
+from responses import SchemaResponse
+from uploads import save_uploads
 from sql_app import crud, schemas
+from sql_app.pagination import set_next_cursor
 from dependencies import get_db, get_current_active_user
 from sql_app.models import User
 
@@ -21,34 +22,27 @@ router = APIRouter(
 async def create_note(name: Annotated[str, Form()], files: list[UploadFile],
                           user_id: Annotated[int, Form()],
                           current_user: Annotated[User, Depends(get_current_active_user)],
-                          db: Session = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db)):
     if not current_user.is_super:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    filepaths = []
-    for file in files:
-        filepath = f'docs/{file.filename}'
-        async with aiofiles.open(filepath, 'wb') as out_file:
-            content = await file.read()
-            await out_file.write(content)
-            filepaths.append(filepath)
-    note = crud.create_note(db, name, user_id, filepaths)
-    if note.user.tg_id:
-        asyncio.create_task(send_files(note.user.tg_id, 'Был добавлен новый конспект:\n{}'
-                                       .format(note.name), note.files))
+    filepaths = await save_uploads(db, files)
+    note = await crud.create_note(db, name, user_id, filepaths,
+                                  notification='Был добавлен новый конспект:\n{}'.format(name))
     return note
 
 
-@router.get("/get/", response_model=list[schemas.Notes])
-async def get_notes(current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db), user_id: int | None = None, offset: int = 0):
+@router.get("/get/", response_model=list[schemas.Notes] | list[schemas.NotesSlim])
+async def get_notes(current_user: Annotated[User, Depends(get_current_active_user)], request: Request,
+                    response: Response, db: AsyncSession = Depends(get_db), user_id: int | None = None,
+                    offset: int = 0, cursor: str | None = None, expand: Literal['user'] | None = None):
     if current_user.is_super or current_user.id == user_id:
-        return crud.get_notes(db, user_id, offset)
+        owner_id = user_id
     elif not user_id:
-        return crud.get_notes(db, current_user.id, offset)
+        owner_id = current_user.id
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -56,19 +50,38 @@ async def get_notes(current_user: Annotated[User, Depends(get_current_active_use
             headers={"WWW-Authenticate": "Bearer"}
         )
 
+    async def load():
+        notes = await crud.get_notes(db, owner_id, offset, cursor=cursor, expand_user=expand == 'user')
+        set_next_cursor(response, notes, 'created_at')
+        return SchemaResponse(schemas.NOTES_LIST if expand == 'user' else schemas.NOTES_SLIM_LIST, notes,
+                              headers=response.headers), None
+    return await listings.respond(request, db, owner_id, load)
+
 
-@router.get('/search/', response_model=list[schemas.Notes])
-async def search_note(q: str, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db), offset: int = 0):
-    return crud.search_notes(db, current_user.id, q, offset)
+@router.get('/search/', response_model=list[schemas.Notes] | list[schemas.NotesSlim])
+async def search_note(q: str, current_user: Annotated[User, Depends(get_current_active_user)], response: Response,
+                        db: AsyncSession = Depends(get_db), offset: int = 0, cursor: str | None = None,
+                        files: bool = False, sort: Literal['recent', 'relevance'] = 'recent',
+                        expand: Literal['user'] | None = None):
+    notes = await crud.search_notes(db, current_user.id, q, offset, cursor=cursor, files=files, sort=sort,
+                                    expand_user=expand == 'user')
+    if sort == 'recent':
+        set_next_cursor(response, notes, 'created_at')
+    return SchemaResponse(schemas.NOTES_LIST if expand == 'user' else schemas.NOTES_SLIM_LIST, notes,
+                          headers=response.headers)
 
 
 @router.get("/delete/{note_id}")
 async def delete_note(note_id: int, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     if current_user.is_super:
-        crud.delete_note(db, note_id)
-        return {"status": "success"}
+        if await crud.delete_note(db, note_id):
+            return {"status": "success"}
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Error while deleting",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -83,7 +96,7 @@ async def update_note(
         current_user: Annotated[User, Depends(get_current_active_user)],
         name: Optional[str] = Form(None),
         files: Optional[list[UploadFile]] = Form(None),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_super:
         raise HTTPException(
@@ -93,13 +106,8 @@ async def update_note(
         )
     filepaths = []
     if files:
-        for file in files:
-            filepath = f'docs/{file.filename}'
-            async with aiofiles.open(filepath, 'wb') as out_file:
-                content = await file.read()
-                await out_file.write(content)
-                filepaths.append(filepath)
-    homework = crud.update_note(db, name, note_id, filepaths)
+        filepaths = await save_uploads(db, files)
+    homework = await crud.update_note(db, name, note_id, filepaths)
     if homework:
         return homework
     else:
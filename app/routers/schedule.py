@@ -1,15 +1,23 @@
-import asyncio
+import datetime
 import logging
-from typing import Annotated
+from email.utils import formatdate
+from typing import Annotated, Literal
 
 import pytz as pytz
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from bot import send_text
+import config
+import ics
+import recurrence
 from sql_app import crud, schemas
+from sql_app.pagination import set_next_cursor
 from dependencies import get_db, get_current_active_user
+from response_cache import listings
+from responses import SchemaResponse, not_modified
+from sql_app.database import SessionLocal
 from sql_app.models import User
 
 router = APIRouter(
@@ -21,28 +29,57 @@ router = APIRouter(
 @router.post("/create/")
 async def create_schedule(schedule: schemas.ScheduleCreate,
                           current_user: Annotated[User, Depends(get_current_active_user)],
-                          db: Session = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db)):
     if not current_user.is_super:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    db_schedule = crud.create_schedule(db, schedule)
-    if db_schedule.user.tg_id:
-        tzdata = pytz.timezone('Europe/Moscow')
-        asyncio.create_task(send_text(db_schedule.user.tg_id, "Запланировано новое занятие на {}"
-                                      .format(schedule.scheduled_at.astimezone(tzdata).strftime("%d.%m.%Y, %H:%M:%S"))))
+    tzdata = pytz.timezone('Europe/Moscow')
+    db_schedule = await crud.create_schedule(db, schedule, notification="Запланировано новое занятие на {}"
+                                             .format(schedule.scheduled_at.astimezone(tzdata).strftime("%d.%m.%Y, %H:%M:%S")))
     return db_schedule
 
 
-@router.get("/get/", response_model=list[schemas.Schedule])
-async def get_schedules(current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db), user_id: int | None = None, active: bool = False):
+@router.post("/bulk/", response_model=schemas.ScheduleBulkResult)
+async def create_schedules(bulk: schemas.ScheduleBulkCreate,
+                           current_user: Annotated[User, Depends(get_current_active_user)],
+                           db: AsyncSession = Depends(get_db)):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    rows = recurrence.rows(bulk)
+    if not rows:
+        return {"created": 0, "schedules": []}
+    # one message per student instead of one per lesson
+    tzdata = pytz.timezone('Europe/Moscow')
+    lessons = {}
+    for row in rows:
+        lessons.setdefault(row['user_id'], []).append(row['scheduled_at'])
+    notifications = {}
+    for user_id, times in lessons.items():
+        first, last = min(times).astimezone(tzdata), max(times).astimezone(tzdata)
+        notifications[user_id] = ("Запланировано новое занятие на {}".format(first.strftime("%d.%m.%Y, %H:%M:%S"))
+                                  if len(times) == 1 else
+                                  "Запланированы новые занятия ({}) с {} по {}".format(
+                                      len(times), first.strftime("%d.%m.%Y"), last.strftime("%d.%m.%Y")))
+    created = await crud.create_schedules(db, rows, notifications)
+    return {"created": len(created), "schedules": created}
+
+
+@router.get("/get/", response_model=list[schemas.Schedule] | list[schemas.ScheduleSlim])
+async def get_schedules(current_user: Annotated[User, Depends(get_current_active_user)], request: Request,
+                        response: Response, db: AsyncSession = Depends(get_db), user_id: int | None = None,
+                        active: bool = False, offset: int = 0, cursor: str | None = None,
+                        expand: Literal['user'] | None = None):
     if current_user.is_super or current_user.id == user_id:
-        return crud.get_schedules(db, user_id=user_id, active=active)
+        owner_id = user_id
     elif not user_id:
-        return crud.get_schedules(db, user_id=current_user.id, active=active)
+        owner_id = current_user.id
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -50,13 +87,28 @@ async def get_schedules(current_user: Annotated[User, Depends(get_current_active
             headers={"WWW-Authenticate": "Bearer"}
         )
 
+    async def load():
+        schedules = await crud.get_schedules(db, user_id=owner_id, active=active, skip=offset, cursor=cursor,
+                                             expand_user=expand == 'user')
+        set_next_cursor(response, schedules, 'scheduled_at')
+        # an upcoming lesson drops out of the active listing once it starts
+        valid_until = min((s.scheduled_at for s in schedules), default=None) if active else None
+        return SchemaResponse(schemas.SCHEDULE_LIST if expand == 'user' else schemas.SCHEDULE_SLIM_LIST, schedules,
+                              headers=response.headers), valid_until
+    return await listings.respond(request, db, owner_id, load)
+
 
 @router.get("/delete/{schedule_id}")
 async def delete_schedule(schedule_id: int, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     if current_user.is_super:
-        crud.delete_schedule(db, schedule_id=schedule_id)
-        return {"status": "success"}
+        if await crud.delete_schedule(db, schedule_id=schedule_id):
+            return {"status": "success"}
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Error while deleting",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -67,9 +119,9 @@ async def delete_schedule(schedule_id: int, current_user: Annotated[User, Depend
 
 @router.post("/update/", response_model=schemas.Schedule)
 async def update_schedule(schedule: schemas.ScheduleUpdate, current_user: Annotated[User, Depends(get_current_active_user)],
-                        db: Session = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db)):
     if current_user.is_super:
-        return crud.update_schedule(db, schedule)
+        return await crud.update_schedule(db, schedule)
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -78,4 +130,35 @@ async def update_schedule(schedule: schemas.ScheduleUpdate, current_user: Annota
         )
 
 
+@router.get("/feed/{feed_token}.ics")
+async def get_schedule_feed(feed_token: str, request: Request, db: AsyncSession = Depends(get_db)):
+    """iCalendar feed of the token owner's lessons for calendar apps, the token is the only credential"""
+    owner = await crud.get_feed_owner(db, feed_token)
+    # the lessons are streamed by a session of their own, don't hold this connection meanwhile
+    await db.close()
+    if owner is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Feed not found",
+        )
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - datetime.timedelta(days=config.ICS_PAST_DAYS)
+    # the feed changes with the owner's lessons and once a day, when the oldest leave the window
+    modified = max(owner.schedule_changed_at or today, today)
+    headers = {
+        'etag': ics.etag(owner.id, modified),
+        'last-modified': formatdate(modified.timestamp(), usegmt=True),
+        'cache-control': config.FEED_CACHE_CONTROL,
+    }
+    if not_modified(request.headers, headers['etag'], int(modified.timestamp())):
+        return Response(status_code=304, headers=headers)
+
+    async def body():
+        yield ics.calendar_start()
+        async with SessionLocal() as session:
+            lessons = await crud.stream_feed_lessons(session, owner.id, since, config.ICS_BATCH_SIZE)
+            async for rows in lessons.partitions():
+                yield ics.lessons(rows, modified)
+        yield ics.CALENDAR_END
 
+    return StreamingResponse(body(), media_type='text/calendar', headers=headers)
@@ -0,0 +1,145 @@
+import datetime
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+import config
+import hashing
+import profiler
+from dependencies import get_current_active_user, get_db
+from sql_app import crud, database
+from response_cache import listings, data_versions
+from sql_app.cache import principals
+from sql_app.models import User
+
+router = APIRouter(
+    prefix="/stats",
+    tags=["stats"],
+)
+
+
+@router.get("/pool/")
+async def get_pool_stats(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return database.pool_stats()
+
+
+@router.get("/principals/")
+async def get_principal_cache_stats(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return principals.stats()
+
+
+@router.get("/response_cache/")
+async def get_response_cache_stats(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return {**listings.entries.stats(), 'listening': data_versions.listening,
+            'tracked_users': data_versions.versions.stats()['size']}
+
+
+@router.get("/hashing/")
+async def get_hashing_stats(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return hashing.stats()
+
+
+@router.get("/outbox/")
+async def get_outbox_stats(current_user: Annotated[User, Depends(get_current_active_user)],
+                           db: AsyncSession = Depends(get_db)):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    depth, sent = await crud.get_outbox_stats(db, now - datetime.timedelta(hours=1))
+    queue = {state: {'count': count, 'oldest_age_s': round((now - oldest).total_seconds(), 3)}
+             for state, count, oldest in depth}
+    sent_count, p50, p95, worst = sent
+    return {
+        'queue': queue,
+        'sent_last_hour': sent_count,
+        'latency_p50_s': p50.total_seconds() if p50 else None,
+        'latency_p95_s': p95.total_seconds() if p95 else None,
+        'latency_max_s': worst.total_seconds() if worst else None,
+    }
+
+
+@router.get("/telegram_files/")
+async def get_telegram_file_stats(current_user: Annotated[User, Depends(get_current_active_user)],
+                                  db: AsyncSession = Depends(get_db)):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    files, hits, uploads = await crud.get_telegram_file_stats(db)
+    return {
+        'files': files,
+        'hits': hits,
+        'uploads': uploads,
+        'hit_rate': round(hits / (hits + uploads), 4) if hits + uploads else None,
+    }
+
+
+@router.get("/slow_queries/")
+async def get_slow_queries(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return {'threshold_ms': config.SLOW_QUERY_MS, 'queries': list(reversed(profiler.slow_queries))}
+
+
+@router.get("/profiles/")
+async def get_profiles(current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return [profile.summary() for profile in reversed(profiler.profiles.values())]
+
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, current_user: Annotated[User, Depends(get_current_active_user)]):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    profile = profiler.profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found",
+        )
+    return profile.report()
@@ -4,11 +4,11 @@ from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, HTTPException, Body
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
+import hashing
 from dependencies import get_db, ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM, get_current_active_user
 from sql_app import models, crud
 from sql_app.models import User
@@ -18,8 +18,6 @@ router = APIRouter(
     tags=["auth"],
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
 class Token(BaseModel):
     access_token: str
@@ -30,20 +28,15 @@ class TokenData(BaseModel):
     username: str | None = None
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-
-def authenticate_user(username: str, password: str, db: Session = Depends(get_db)) -> models.User | bool:
-    user = crud.get_user_by_username(db, username)
+async def authenticate_user(username: str, password: str, db: AsyncSession = Depends(get_db)) -> models.User | bool:
+    user = await crud.get_user_by_username(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await hashing.verify_and_update(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        await crud.update_password_hash(db, user, new_hash)
     return user
 
 
@@ -59,22 +52,23 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 @router.post("/changepassword")
-def change_password(old_password: Annotated[str, Body()], new_password: Annotated[str, Body()],
+async def change_password(old_password: Annotated[str, Body()], new_password: Annotated[str, Body()],
                     current_user: Annotated[User, Depends(get_current_active_user)],
-                    db: Session = Depends(get_db)):
+                    db: AsyncSession = Depends(get_db)):
     if old_password == new_password:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="New password is same as old",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not verify_password(old_password, current_user.hashed_password):
+    hashed_password = await crud.get_password_hash(db, current_user.id)
+    if hashed_password is None or not await hashing.verify_password(old_password, hashed_password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Old password mismatch",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if crud.change_user_password(db, current_user.id, new_password):
+    if await crud.change_user_password(db, current_user.id, new_password):
         return {'status': 'success'}
     else:
         raise HTTPException(
@@ -87,8 +81,8 @@ def change_password(old_password: Annotated[str, Body()], new_password: Annotate
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
         form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-        db: Session = Depends(get_db)):
-    user = authenticate_user(form_data.username, form_data.password, db)
+        db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
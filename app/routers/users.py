@@ -1,11 +1,15 @@
+import datetime
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import Depends, HTTPException, APIRouter, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
+import settlement
 from dependencies import get_current_active_user, get_db
+from responses import SchemaResponse
 from sql_app import crud, schemas
+from sql_app.pagination import set_next_cursor
 from sql_app.schemas import User
 
 
@@ -23,22 +27,23 @@ async def read_users_me(
 
 
 @router.get("/get/", response_model=list[User])
-async def read_users(current_user: Annotated[User, Depends(get_current_active_user)], db: Session = Depends(get_db), offset: int | None = None, limit: int | None = None):
+async def read_users(current_user: Annotated[User, Depends(get_current_active_user)], response: Response, db: AsyncSession = Depends(get_db), offset: int | None = None, limit: int | None = None, cursor: str | None = None):
     if not current_user.is_super:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    users = crud.get_users(db, skip=offset, limit=limit)
-    return users
+    users = await crud.get_users(db, skip=offset, limit=limit, cursor=cursor)
+    set_next_cursor(response, users, 'created', limit)
+    return SchemaResponse(schemas.USER_LIST, users, headers=response.headers)
 
 
 @router.post("/create/", response_model=User)
 async def create_user(
         user: schemas.UserCreate,
         current_user: Annotated[User, Depends(get_current_active_user)],
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
 ):
     if not current_user.is_super:
         raise HTTPException(
@@ -46,7 +51,7 @@ async def create_user(
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    user = crud.create_user(db, user)
+    user = await crud.create_user(db, user)
     return user
 
 
@@ -54,7 +59,7 @@ async def create_user(
 async def delete_user(
         user: schemas.UserDelete,
         current_user: Annotated[User, Depends(get_current_active_user)],
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_super:
         raise HTTPException(
@@ -62,7 +67,7 @@ async def delete_user(
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    user = crud.delete_user(db, user)
+    user = await crud.delete_user(db, user)
     if user:
         return {"status": "success"}
     else:
@@ -77,7 +82,7 @@ async def delete_user(
 async def update_user(
         user: schemas.UserUpdate,
         current_user: Annotated[User, Depends(get_current_active_user)],
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     if not current_user.is_super:
         raise HTTPException(
@@ -85,7 +90,7 @@ async def update_user(
             detail="You have no rights",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    client = crud.update_user(db, user)
+    client = await crud.update_user(db, user)
     if client:
         return client
     else:
@@ -93,4 +98,111 @@ async def update_user(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Client not found",
             headers={"WWW-Authenticate": "Bearer"}
-        )
\ No newline at end of file
+        )
+
+
+@router.post("/settle/", response_model=schemas.SettlementResult)
+async def settle_lessons(current_user: Annotated[User, Depends(get_current_active_user)], dry_run: bool = True):
+    if not current_user.is_super:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return await settlement.settle(dry_run=dry_run)
+
+
+@router.get("/forecast/", response_model=schemas.BalanceForecast)
+async def get_balance_forecast(current_user: Annotated[User, Depends(get_current_active_user)],
+                               db: AsyncSession = Depends(get_db), user_id: int | None = None,
+                               days: Annotated[int, Query(ge=1, le=366)] = 30):
+    if user_id is None:
+        user_id = current_user.id
+    elif not current_user.is_super and current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    until = now + datetime.timedelta(days=days)
+    forecast = await crud.get_balance_forecast(db, user_id, until)
+    if forecast is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Client not found",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    balance, price, lessons = forecast
+    # the same arithmetic settlement applies, one lesson_price per lesson in order
+    covered = len(lessons) if price <= 0 else min(max(int(balance // price), 0), len(lessons))
+    return schemas.BalanceForecast(
+        user_id=user_id, balance=balance, lesson_price=price,
+        pending_lessons=sum(1 for scheduled_at in lessons if scheduled_at <= now),
+        upcoming_lessons=sum(1 for scheduled_at in lessons if scheduled_at > now),
+        until=until, projected_balance=balance - price * len(lessons), lessons_covered=covered,
+        negative_from=lessons[covered] if covered < len(lessons) else None,
+    )
+
+
+@router.get("/ledger/", response_model=list[schemas.LedgerEntry])
+async def get_ledger(current_user: Annotated[User, Depends(get_current_active_user)], response: Response,
+                     db: AsyncSession = Depends(get_db), user_id: int | None = None, cursor: str | None = None):
+    if user_id is None:
+        user_id = current_user.id
+    elif not current_user.is_super and current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    entries = await crud.get_ledger(db, user_id, cursor=cursor)
+    set_next_cursor(response, entries, 'created_at')
+    return entries
+
+
+def _feed_owner(current_user: User, user_id: int | None) -> int:
+    if user_id is None:
+        return current_user.id
+    if not current_user.is_super and current_user.id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You have no rights",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return user_id
+
+
+def _feed(request: Request, user_id: int, feed_token: str | None) -> schemas.CalendarFeed:
+    if feed_token is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Client not found",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    return schemas.CalendarFeed(user_id=user_id, url=str(request.url_for('get_schedule_feed', feed_token=feed_token)))
+
+
+@router.get("/feed/", response_model=schemas.CalendarFeed)
+async def get_calendar_feed(current_user: Annotated[User, Depends(get_current_active_user)], request: Request,
+                            db: AsyncSession = Depends(get_db), user_id: int | None = None):
+    """iCalendar URL of the user's lessons, created on first use; anyone who has it can read them"""
+    user_id = _feed_owner(current_user, user_id)
+    return _feed(request, user_id, await crud.issue_feed_token(db, user_id))
+
+
+@router.post("/feed/reset/", response_model=schemas.CalendarFeed)
+async def reset_calendar_feed(current_user: Annotated[User, Depends(get_current_active_user)], request: Request,
+                              db: AsyncSession = Depends(get_db), user_id: int | None = None):
+    """A new feed URL; the old one stops working"""
+    user_id = _feed_owner(current_user, user_id)
+    return _feed(request, user_id, await crud.issue_feed_token(db, user_id, replace=True))
+
+
+@router.post("/feed/revoke/", response_model=schemas.CalendarFeed)
+async def revoke_calendar_feed(current_user: Annotated[User, Depends(get_current_active_user)],
+                               db: AsyncSession = Depends(get_db), user_id: int | None = None):
+    """Turn the feed off until /users/feed/ is asked for a new URL"""
+    user_id = _feed_owner(current_user, user_id)
+    await crud.revoke_feed_token(db, user_id)
+    return schemas.CalendarFeed(user_id=user_id, url=None)
@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import datetime
+import decimal
+import logging
+import sys
+
+from sqlalchemy import select, func
+
+import config
+import profiler
+from sql_app import crud, schemas
+from sql_app.cache import principals
+from sql_app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+# pg_advisory_xact_lock key; one settlement at a time keeps the users rows locked in one order
+LOCK_KEY = 0x5e771e
+
+
+async def settle(dry_run: bool = False, now: datetime.datetime | None = None,
+                 batch_size: int | None = None) -> schemas.SettlementResult:
+    """Charge every lesson held by now that isn't charged yet, SETTLEMENT_BATCH_SIZE per transaction"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    batch_size = batch_size or config.SETTLEMENT_BATCH_SIZE
+    lessons, users, amount = 0, set(), decimal.Decimal(0)
+    async with SessionLocal() as db:
+        if dry_run:
+            for row in await crud.preview_settlement(db, now, None):
+                lessons += row.lessons
+                users.add(row.user_id)
+                amount += row.amount
+            return schemas.SettlementResult(dry_run=True, lessons=lessons, users=len(users), amount=amount)
+        while True:
+            if not await db.scalar(select(func.pg_try_advisory_xact_lock(LOCK_KEY))):
+                logger.info('Another settlement is running')
+                break
+            settled = await crud.settle_lessons(db, now, batch_size)
+            await db.commit()
+            for row in settled:
+                principals.invalidate(row.username)
+            charged = sum(row.lessons for row in settled)
+            lessons += charged
+            users.update(row.user_id for row in settled)
+            amount += sum((row.amount for row in settled), decimal.Decimal(0))
+            if charged < batch_size:
+                break
+    return schemas.SettlementResult(dry_run=False, lessons=lessons, users=len(users), amount=amount)
+
+
+async def run():
+    while True:
+        try:
+            result = await settle()
+            if result.lessons:
+                logger.info('Charged %s lessons of %s users, %s in total', result.lessons, result.users, result.amount)
+        except Exception:
+            logger.exception('Settlement failed')
+        await asyncio.sleep(config.SETTLEMENT_INTERVAL)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Charge lesson_price for every lesson that has been held')
+    parser.add_argument('--dry-run', action='store_true', help='print what would be charged and change nothing')
+    parser.add_argument('--once', action='store_true', help='settle once instead of every SETTLEMENT_INTERVAL')
+    args = parser.parse_args()
+    profiler.instrument_engines()
+    if args.dry_run or args.once:
+        print((await settle(dry_run=args.dry_run)).model_dump_json())
+    else:
+        await run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    asyncio.run(main())
@@ -1,51 +1,88 @@
 import datetime
+import logging
 import random
+import secrets
 import string
 
 from fastapi import HTTPException
-from passlib.context import CryptContext
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy import select, delete, update, func, bindparam, false, literal, ARRAY, Integer, DateTime, String
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, noload
 from starlette import status
 
-from . import models, schemas
+import hashing
+import metrics
+import storage
+from . import models, schemas, pagination
+from . import search as search_index
+from .cache import principals
 
+logger = logging.getLogger(__name__)
+SCHEDULE_CHANNEL = 'schedule_changed'
+OUTBOX_CHANNEL = 'outbox'
+DATA_VERSION_CHANNEL = 'data_version'
+# "user_id:version" pairs per notification, well below the 8000 byte payload limit
+DATA_VERSION_BATCH = 500
+# random bytes of a calendar feed token, 43 URL-safe characters
+FEED_TOKEN_BYTES = 32
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
 
+def _load_user(relationship, expand: bool):
+    # List responses carry the owner only with ?expand=user; a many-to-one join keeps that to one query
+    return joinedload(relationship) if expand else noload(relationship)
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
 
+async def get_user(db: AsyncSession, user_id: int):
+    return await db.scalar(select(models.User).filter(models.User.id == user_id))
 
-def get_user_by_tg_hash(db: Session, hash: str):
-    return db.query(models.User).filter(models.User.tg_hash == hash).first()
 
+async def get_user_by_username(db: AsyncSession, username: str):
+    return await db.scalar(select(models.User).filter(models.User.username == username))
 
-def get_users(db: Session, skip: int = 0, limit: int = 20):
-    return db.query(models.User).filter(models.User.is_super == False).order_by(models.User.created.desc()).offset(skip).limit(limit).all()
 
+async def get_password_hash(db: AsyncSession, user_id: int):
+    # read past the principal cache, which may hold a hash another worker has since replaced
+    return await db.scalar(select(models.User.hashed_password).filter(models.User.id == user_id))
 
-def delete_user(db: Session, user: schemas.UserDelete):
+
+async def get_user_by_tg_hash(db: AsyncSession, hash: str):
+    return await db.scalar(select(models.User).filter(models.User.tg_hash == hash))
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 20, cursor: str | None = None):
+    query = pagination.keyset(select(models.User).filter(models.User.is_super == False), models.User.created, models.User.id, cursor)
+    if not cursor:
+        query = query.offset(skip)
+    result = await db.scalars(query.limit(limit))
+    return result.all()
+
+
+async def delete_user(db: AsyncSession, user: schemas.UserDelete):
     try:
-        db.query(models.User).filter(models.User.id == user.id).delete()
-        db.commit()
+        for model in (models.Homework, models.Notes):
+            for files in await db.scalars(select(model.files).filter(model.user_id == user.id)):
+                await storage.release(db, files or [])
+        username = await db.scalar(delete(models.User).filter(models.User.id == user.id)
+                                   .returning(models.User.username))
+        await db.commit()
+        principals.invalidate(username)
         return True
-    except Exception as e:
-        print(e)
+    except SQLAlchemyError:
+        logger.exception('Deleting user %s failed', user.id)
+        await db.rollback()
         return False
 
 
-def create_user(db: Session, user: schemas.UserCreate, is_super=False):
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    hashed_password = pwd_context.hash(user.password)
+async def create_user(db: AsyncSession, user: schemas.UserCreate, is_super=False):
+    hashed_password = await hashing.hash_password(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed_password, is_super=is_super,
                           full_name=user.full_name)
     db.add(db_user)
     try:
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         return db_user
     except IntegrityError:
         credentials_exception = HTTPException(
@@ -56,9 +93,10 @@ def create_user(db: Session, user: schemas.UserCreate, is_super=False):
         raise credentials_exception
 
 
-def update_user(db: Session, user: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.id == user.id).first()
+async def update_user(db: AsyncSession, user: schemas.UserUpdate):
+    db_user = await db.scalar(select(models.User).filter(models.User.id == user.id))
     if db_user:
+        old_username = db_user.username
         if user.full_name:
             db_user.full_name = user.full_name
         if user.username:
@@ -68,35 +106,89 @@ def update_user(db: Session, user: schemas.UserUpdate):
         if user.lesson_price:
             db_user.lesson_price = user.lesson_price
         if user.password:
-            pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-            hashed_password = pwd_context.hash(user.password)
+            hashed_password = await hashing.hash_password(user.password)
             db_user.hashed_password = hashed_password
-        db.commit()
-        db.refresh(db_user)
+        # the user is embedded in ?expand=user listings
+        await bump_data_version(db, [db_user.id])
+        await db.commit()
+        principals.invalidate(old_username)
+        principals.invalidate(db_user.username)
+        await db.refresh(db_user)
         return db_user
     else:
         return None
 
 
-def change_user_password(db: Session, user_id: int, new_password: str):
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+async def change_user_password(db: AsyncSession, user_id: int, new_password: str):
+    db_user = await db.scalar(select(models.User).filter(models.User.id == user_id))
     if db_user:
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        hashed_password = pwd_context.hash(new_password)
+        hashed_password = await hashing.hash_password(new_password)
         db_user.hashed_password = hashed_password
-        db.commit()
+        await db.commit()
+        principals.invalidate(db_user.username)
         return True
     else:
         return False
 
 
-def create_schedule(db: Session, schedule: schemas.ScheduleCreate):
+async def update_password_hash(db: AsyncSession, user: models.User, hashed_password: str):
+    user.hashed_password = hashed_password
+    await db.commit()
+    principals.invalidate(user.username)
+
+
+async def get_schedule(db: AsyncSession, schedule_id: int):
+    # populate_existing: reload rows already in the identity map, e.g. right after commit
+    return await db.scalar(select(models.Schedule).options(joinedload(models.Schedule.user))
+                           .filter(models.Schedule.id == schedule_id).execution_options(populate_existing=True))
+
+
+async def create_schedule(db: AsyncSession, schedule: schemas.ScheduleCreate, notification: str | None = None):
     db_schedule = models.Schedule(user_id=schedule.user_id, note=schedule.note, scheduled_at=schedule.scheduled_at)
     db.add(db_schedule)
     try:
-        db.commit()
-        db.refresh(db_schedule)
-        return db_schedule
+        await db.flush()
+        await notify_schedule_changed(db, db_schedule.id)
+        await bump_data_version(db, [schedule.user_id], schedule_changed=True)
+        if notification:
+            await enqueue_message(db, schedule.user_id, notification)
+        await db.commit()
+        return await get_schedule(db, db_schedule.id)
+    except IntegrityError as e:
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="IntegrityError",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+        raise credentials_exception
+
+
+async def create_schedules(db: AsyncSession, rows: list[dict], notifications: dict[int, str] | None = None):
+    """Insert rows of user_id, scheduled_at and note with one statement, returns (id, user_id, scheduled_at)
+
+    The rows are passed as three arrays and unnested by Postgres, so the statement has three
+    parameters however many rows there are. notifications maps user_id to the message they get.
+    """
+    source = func.unnest(
+        bindparam('user_ids', [r['user_id'] for r in rows], ARRAY(Integer)),
+        bindparam('times', [r['scheduled_at'] for r in rows], ARRAY(DateTime(timezone=True))),
+        bindparam('notes', [r['note'] for r in rows], ARRAY(String)),
+    ).table_valued('user_id', 'scheduled_at', 'note').render_derived()
+    query = (insert(models.Schedule)
+             .from_select(['user_id', 'scheduled_at', 'note', 'tg_notified'],
+                          select(source.c.user_id, source.c.scheduled_at, source.c.note, false()))
+             .returning(models.Schedule.id, models.Schedule.user_id, models.Schedule.scheduled_at))
+    try:
+        created = (await db.execute(query)).all()
+        await notify_schedule_changed(db, None)
+        await bump_data_version(db, [row.user_id for row in created], schedule_changed=True)
+        if notifications:
+            tg_ids = await db.execute(select(models.User.id, models.User.tg_id)
+                                      .filter(models.User.id.in_(notifications) & (models.User.tg_id != None)))
+            for user_id, tg_id in tg_ids:
+                await queue_message(db, tg_id, notifications[user_id])
+        await db.commit()
+        return created
     except IntegrityError as e:
         credentials_exception = HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -106,101 +198,264 @@ def create_schedule(db: Session, schedule: schemas.ScheduleCreate):
         raise credentials_exception
 
 
-def get_schedules(db: Session, active, user_id: int = -1, skip: int = 0, limit: int = 20):
+async def get_schedules(db: AsyncSession, active, user_id: int = -1, skip: int = 0, limit: int = 20, cursor: str | None = None,
+                        expand_user: bool = False):
     filter_query = datetime.datetime.now()
     if not active:
         filter_query = filter_query.replace(1970)
-    if user_id == -1:
-        return db.query(models.Schedule).join(models.Schedule.user).filter(models.Schedule.scheduled_at > filter_query).order_by(models.Schedule.scheduled_at.desc()).offset(skip).limit(limit).all()
-    else:
-        return db.query(models.Schedule).filter((models.Schedule.user_id == user_id) & (models.Schedule.scheduled_at > filter_query)).order_by(models.Schedule.scheduled_at.desc()).offset(skip).limit(limit).all()
-
-
-def get_active_schedules_with_tg(db: Session, cur_date):
-    return db.query(models.Schedule).join(models.User).filter((models.Schedule.tg_notified == False) & (models.Schedule.scheduled_at > cur_date) & (models.User.tg_id != None)).all()
-
-
-def delete_schedule(db: Session, schedule_id: int):
+    query = select(models.Schedule).options(_load_user(models.Schedule.user, expand_user)).filter(models.Schedule.scheduled_at > filter_query)
+    if user_id != -1:
+        query = query.filter(models.Schedule.user_id == user_id)
+    query = pagination.keyset(query, models.Schedule.scheduled_at, models.Schedule.id, cursor)
+    if not cursor:
+        query = query.offset(skip)
+    result = await db.scalars(query.limit(limit))
+    return result.all()
+
+
+async def notify_schedule_changed(db: AsyncSession, schedule_id: int | None):
+    # Delivered to LISTEN sessions when the transaction commits, see reminders.py.
+    # No id means many rows changed and listeners should reload
+    await db.execute(select(func.pg_notify(SCHEDULE_CHANNEL, '' if schedule_id is None else str(schedule_id))))
+
+
+async def bump_data_version(db: AsyncSession, user_ids, schedule_changed: bool = False):
+    """Invalidate the cached listings of these users, see response_cache.py; announced on commit
+
+    schedule_changed also moves their schedule_changed_at, which invalidates their calendar feeds.
+    """
+    user_ids = sorted({user_id for user_id in user_ids if user_id is not None})
+    if not user_ids:
+        return
+    values = {'data_version': models.User.data_version + 1}
+    if schedule_changed:
+        # strictly later than the last change even within one transaction, so the feed's ETag moves
+        values['schedule_changed_at'] = func.greatest(
+            func.now(), models.User.schedule_changed_at + datetime.timedelta(microseconds=1))
+    versions = (await db.execute(
+        update(models.User).where(models.User.id.in_(user_ids))
+        .values(values)
+        .returning(models.User.id, models.User.data_version)
+        .execution_options(synchronize_session=False))).all()
+    await announce_data_versions(db, versions)
+
+
+async def announce_data_versions(db: AsyncSession, versions):
+    """NOTIFY (user_id, data_version) pairs already written in this transaction"""
+    for i in range(0, len(versions), DATA_VERSION_BATCH):
+        payload = ','.join(f'{user_id}:{version}' for user_id, version in versions[i:i + DATA_VERSION_BATCH])
+        await db.execute(select(func.pg_notify(DATA_VERSION_CHANNEL, payload)))
+
+
+async def get_data_version(db: AsyncSession, user_id: int):
+    return await db.scalar(select(models.User.data_version).filter(models.User.id == user_id))
+
+
+async def get_feed_owner(db: AsyncSession, feed_token: str):
+    """(id, schedule_changed_at) of the active user this feed token belongs to"""
+    return (await db.execute(select(models.User.id, models.User.schedule_changed_at)
+                             .filter(models.User.feed_token == feed_token, models.User.is_active == True))).first()
+
+
+async def issue_feed_token(db: AsyncSession, user_id: int, replace: bool = False):
+    """The user's feed token, created if there is none; replace revokes the old one and makes another"""
+    token = secrets.token_urlsafe(FEED_TOKEN_BYTES)
+    result = await db.scalar(update(models.User).where(models.User.id == user_id)
+                             .values(feed_token=token if replace else func.coalesce(models.User.feed_token, token))
+                             .returning(models.User.feed_token)
+                             .execution_options(synchronize_session=False))
+    await db.commit()
+    return result
+
+
+async def revoke_feed_token(db: AsyncSession, user_id: int):
+    await db.execute(update(models.User).where(models.User.id == user_id).values(feed_token=None)
+                     .execution_options(synchronize_session=False))
+    await db.commit()
+
+
+async def stream_feed_lessons(db: AsyncSession, user_id: int, since, batch_size: int):
+    """(id, scheduled_at, note) of the user's lessons from since on, fetched batch_size rows at a time"""
+    return await db.stream(select(models.Schedule.id, models.Schedule.scheduled_at, models.Schedule.note)
+                           .filter(models.Schedule.user_id == user_id, models.Schedule.scheduled_at >= since)
+                           .order_by(models.Schedule.scheduled_at, models.Schedule.id)
+                           .execution_options(yield_per=batch_size))
+
+
+async def get_pending_reminders(db: AsyncSession, after, until, schedule_ids=None):
+    """(id, scheduled_at) of unnotified lessons starting in (after, until]"""
+    query = select(models.Schedule.id, models.Schedule.scheduled_at).filter(
+        (models.Schedule.tg_notified == False) & (models.Schedule.scheduled_at > after) & (models.Schedule.scheduled_at <= until))
+    if schedule_ids is not None:
+        query = query.filter(models.Schedule.id.in_(schedule_ids))
+    result = await db.execute(query)
+    return result.all()
+
+
+async def claim_reminders(db: AsyncSession, schedule_ids, after):
+    """Mark the reminders sent and return (id, user_id, tg_id, scheduled_at) of those that are still owed
+
+    Doesn't commit, the caller queues the messages in the same transaction.
+    """
+    schedule, users = models.Schedule.__table__, models.User.__table__
+    # UPDATE ... FROM users on the tables, an ORM update can't return columns of another entity
+    result = await db.execute(
+        update(schedule)
+        .where(schedule.c.user_id == users.c.id)
+        .where(schedule.c.id.in_(schedule_ids), schedule.c.tg_notified == False,
+               schedule.c.scheduled_at > after, users.c.tg_id != None)
+        .values(tg_notified=True)
+        .returning(schedule.c.id, users.c.id.label('user_id'), users.c.tg_id, schedule.c.scheduled_at))
+    reminders = result.all()
+    # tg_notified is part of the listing
+    await bump_data_version(db, [reminder.user_id for reminder in reminders])
+    return reminders
+
+
+async def delete_schedule(db: AsyncSession, schedule_id: int):
     try:
-        db.query(models.Schedule).filter(models.Schedule.id == schedule_id).delete()
-        db.commit()
+        user_id = await db.scalar(delete(models.Schedule).filter(models.Schedule.id == schedule_id)
+                                  .returning(models.Schedule.user_id))
+        await notify_schedule_changed(db, schedule_id)
+        await bump_data_version(db, [user_id], schedule_changed=True)
+        await db.commit()
         return True
-    except Exception as e:
+    except SQLAlchemyError:
+        logger.exception('Deleting schedule %s failed', schedule_id)
+        await db.rollback()
         return False
 
 
-def update_schedule(db: Session, schedule: schemas.ScheduleUpdate):
-    db_schedule = db.query(models.Schedule).filter(models.Schedule.id == schedule.id).first()
+async def update_schedule(db: AsyncSession, schedule: schemas.ScheduleUpdate):
+    db_schedule = await db.scalar(select(models.Schedule).filter(models.Schedule.id == schedule.id))
     if db_schedule:
+        if db_schedule.scheduled_at != schedule.scheduled_at:
+            # the lesson moved, so its reminder is owed again
+            db_schedule.tg_notified = False
         db_schedule.scheduled_at = schedule.scheduled_at
-        db.commit()
-        db.refresh(db_schedule)
-        return db_schedule
+        await notify_schedule_changed(db, db_schedule.id)
+        await bump_data_version(db, [db_schedule.user_id], schedule_changed=True)
+        await db.commit()
+        return await get_schedule(db, db_schedule.id)
     else:
         return None
 
 
-def get_homeworks(db: Session, user_id: int = -1, skip: int = 0, limit: int = 20):
-    if user_id == -1:
-        return db.query(models.Homework).join(models.Homework.user).order_by(models.Homework.created_at.desc()).offset(skip).limit(limit).all()
-    else:
-        return db.query(models.Homework).filter(models.Homework.user_id == user_id).order_by(models.Homework.created_at.desc()).offset(skip).limit(limit).all()
+async def get_homework(db: AsyncSession, homework_id: int):
+    return await db.scalar(select(models.Homework).options(joinedload(models.Homework.user))
+                           .filter(models.Homework.id == homework_id).execution_options(populate_existing=True))
+
 
+async def get_homeworks(db: AsyncSession, user_id: int = -1, skip: int = 0, limit: int = 20, cursor: str | None = None,
+                        expand_user: bool = False):
+    query = select(models.Homework).options(_load_user(models.Homework.user, expand_user))
+    if user_id != -1:
+        query = query.filter(models.Homework.user_id == user_id)
+    query = pagination.keyset(query, models.Homework.created_at, models.Homework.id, cursor)
+    if not cursor:
+        query = query.offset(skip)
+    result = await db.scalars(query.limit(limit))
+    return result.all()
 
-def search_homework(db: Session, user_id: int, query: str, offset):
-    return db.query(models.Homework).filter((models.Homework.user_id == user_id) & (models.Homework.name.ilike(f"%{query}%"))).order_by(models.Homework.created_at.desc()).offset(offset).limit(20).all()
 
+async def search_homework(db: AsyncSession, user_id: int, query: str, offset, cursor: str | None = None,
+                          files: bool = False, sort: str = 'recent', expand_user: bool = False):
+    search = select(models.Homework).options(_load_user(models.Homework.user, expand_user)).filter(models.Homework.user_id == user_id)
+    search = search_index.apply(search, models.Homework, query, files, sort, cursor)
+    if search is None:
+        return []
+    if not cursor:
+        search = search.offset(offset)
+    result = await db.scalars(search.limit(pagination.PAGE_SIZE))
+    return result.all()
 
-def delete_homework(db: Session, homework_id: int):
+
+async def delete_homework(db: AsyncSession, homework_id: int):
     try:
-        db.query(models.Homework).filter(models.Homework.id == homework_id).delete()
-        db.commit()
+        deleted = (await db.execute(delete(models.Homework).filter(models.Homework.id == homework_id)
+                                    .returning(models.Homework.user_id, models.Homework.files))).first()
+        if deleted:
+            await storage.release(db, deleted.files or [])
+            await bump_data_version(db, [deleted.user_id])
+        await db.commit()
         return True
-    except Exception as e:
+    except SQLAlchemyError:
+        logger.exception('Deleting homework %s failed', homework_id)
+        await db.rollback()
         return False
 
 
-def get_notes(db: Session, user_id: int = -1, skip: int = 0, limit: int = 20):
-    if user_id == -1:
-        return db.query(models.Notes).join(models.Notes.user).order_by(models.Notes.created_at.desc()).offset(skip).limit(limit).all()
-    else:
-        return db.query(models.Notes).filter(models.Notes.user_id == user_id).order_by(models.Notes.created_at.desc()).offset(skip).limit(limit).all()
+async def get_note(db: AsyncSession, note_id: int):
+    return await db.scalar(select(models.Notes).options(joinedload(models.Notes.user))
+                           .filter(models.Notes.id == note_id).execution_options(populate_existing=True))
 
 
-def search_notes(db: Session, user_id: int, query: str, offset):
-    return db.query(models.Notes).filter((models.Notes.user_id == user_id) & (models.Notes.name.ilike(f"%{query}%"))).order_by(models.Notes.created_at.desc()).offset(offset).limit(20).all()
+async def get_notes(db: AsyncSession, user_id: int = -1, skip: int = 0, limit: int = 20, cursor: str | None = None,
+                    expand_user: bool = False):
+    query = select(models.Notes).options(_load_user(models.Notes.user, expand_user))
+    if user_id != -1:
+        query = query.filter(models.Notes.user_id == user_id)
+    query = pagination.keyset(query, models.Notes.created_at, models.Notes.id, cursor)
+    if not cursor:
+        query = query.offset(skip)
+    result = await db.scalars(query.limit(limit))
+    return result.all()
 
 
-def delete_note(db: Session, note_id: int):
+async def search_notes(db: AsyncSession, user_id: int, query: str, offset, cursor: str | None = None,
+                       files: bool = False, sort: str = 'recent', expand_user: bool = False):
+    search = select(models.Notes).options(_load_user(models.Notes.user, expand_user)).filter(models.Notes.user_id == user_id)
+    search = search_index.apply(search, models.Notes, query, files, sort, cursor)
+    if search is None:
+        return []
+    if not cursor:
+        search = search.offset(offset)
+    result = await db.scalars(search.limit(pagination.PAGE_SIZE))
+    return result.all()
+
+
+async def delete_note(db: AsyncSession, note_id: int):
     try:
-        db.query(models.Notes).filter(models.Notes.id == note_id).delete()
-        db.commit()
+        deleted = (await db.execute(delete(models.Notes).filter(models.Notes.id == note_id)
+                                    .returning(models.Notes.user_id, models.Notes.files))).first()
+        if deleted:
+            await storage.release(db, deleted.files or [])
+            await bump_data_version(db, [deleted.user_id])
+        await db.commit()
         return True
-    except Exception as e:
+    except SQLAlchemyError:
+        logger.exception('Deleting note %s failed', note_id)
+        await db.rollback()
         return False
 
 
-def update_homework(db: Session, name, homework_id: int, files):
-    db_homework = db.query(models.Homework).filter(models.Homework.id == homework_id).first()
+async def update_homework(db: AsyncSession, name, homework_id: int, files):
+    db_homework = await db.scalar(select(models.Homework).filter(models.Homework.id == homework_id))
     if db_homework:
         if name:
             db_homework.name = name
         if len(files) > 0:
+            await storage.release(db, db_homework.files or [])
+            await storage.acquire(db, files)
             db_homework.files = files
-        db.commit()
-        db.refresh(db_homework)
-        return db_homework
+        db_homework.search_vector = search_index.document(db_homework.name, db_homework.files)
+        await bump_data_version(db, [db_homework.user_id])
+        await db.commit()
+        return await get_homework(db, db_homework.id)
     else:
         return None
 
 
-def create_homework(db: Session, name, user_id, files):
-    db_homework = models.Homework(user_id=user_id, name=name, files=files)
+async def create_homework(db: AsyncSession, name, user_id, files, notification: str | None = None):
+    db_homework = models.Homework(user_id=user_id, name=name, files=files, search_vector=search_index.document(name, files))
     db.add(db_homework)
+    await storage.acquire(db, files)
+    await bump_data_version(db, [user_id])
+    if notification:
+        await enqueue_message(db, user_id, notification, files)
     try:
-        db.commit()
-        db.refresh(db_homework)
-        return db_homework
+        await db.commit()
+        return await get_homework(db, db_homework.id)
     except IntegrityError:
         credentials_exception = HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -210,13 +465,16 @@ def create_homework(db: Session, name, user_id, files):
         raise credentials_exception
 
 
-def create_note(db: Session, name, user_id, files):
-    db_note = models.Notes(user_id=user_id, name=name, files=files)
+async def create_note(db: AsyncSession, name, user_id, files, notification: str | None = None):
+    db_note = models.Notes(user_id=user_id, name=name, files=files, search_vector=search_index.document(name, files))
     db.add(db_note)
+    await storage.acquire(db, files)
+    await bump_data_version(db, [user_id])
+    if notification:
+        await enqueue_message(db, user_id, notification, files)
     try:
-        db.commit()
-        db.refresh(db_note)
-        return db_note
+        await db.commit()
+        return await get_note(db, db_note.id)
     except IntegrityError:
         credentials_exception = HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -226,15 +484,219 @@ def create_note(db: Session, name, user_id, files):
         raise credentials_exception
 
 
-def update_note(db: Session, name, note_id: int, files):
-    db_note = db.query(models.Notes).filter(models.Notes.id == note_id).first()
+async def update_note(db: AsyncSession, name, note_id: int, files):
+    db_note = await db.scalar(select(models.Notes).filter(models.Notes.id == note_id))
     if db_note:
         if name:
             db_note.name = name
         if len(files) > 0:
+            await storage.release(db, db_note.files or [])
+            await storage.acquire(db, files)
             db_note.files = files
-        db.commit()
-        db.refresh(db_note)
-        return db_note
+        db_note.search_vector = search_index.document(db_note.name, db_note.files)
+        await bump_data_version(db, [db_note.user_id])
+        await db.commit()
+        return await get_note(db, db_note.id)
     else:
-        return None
\ No newline at end of file
+        return None
+
+
+async def enqueue_message(db: AsyncSession, user_id: int, text: str, files: list[str] | None = None):
+    """Queue a Telegram message to the user, if they linked Telegram; sent by delivery.py after commit"""
+    tg_id = await db.scalar(select(models.User.tg_id).filter(models.User.id == user_id))
+    if not tg_id:
+        return None
+    return await queue_message(db, tg_id, text, files)
+
+
+async def queue_message(db: AsyncSession, chat_id: int, text: str, files: list[str] | None = None):
+    message = models.Outbox(chat_id=chat_id, text=text, files=files or [])
+    db.add(message)
+    # the outbox keeps its own references so the blobs outlive a deleted homework or note
+    await storage.acquire(db, message.files)
+    await db.execute(select(func.pg_notify(OUTBOX_CHANNEL, '')))
+    metrics.notifications_queued.inc()
+    return message
+
+
+async def claim_outbox(db: AsyncSession, limit: int, lease: datetime.timedelta):
+    """Take up to limit due messages and hide them from other workers for lease"""
+    due = (select(models.Outbox.id)
+           .filter((models.Outbox.status == 'pending') & (models.Outbox.next_attempt_at <= func.now()))
+           .order_by(models.Outbox.next_attempt_at).limit(limit).with_for_update(skip_locked=True))
+    result = await db.scalars(
+        update(models.Outbox).where(models.Outbox.id.in_(due.scalar_subquery()))
+        .values(next_attempt_at=func.now() + lease, attempts=models.Outbox.attempts + 1)
+        .returning(models.Outbox)
+        .execution_options(synchronize_session=False))
+    messages = sorted(result.all(), key=lambda m: m.id)
+    await db.commit()
+    return messages
+
+
+async def extend_outbox_lease(db: AsyncSession, ids: list[int], leased_until, lease: datetime.timedelta):
+    """Renew the lease of claimed messages that nothing else has touched since leased_until"""
+    result = await db.scalars(
+        update(models.Outbox)
+        .where(models.Outbox.id.in_(ids) & (models.Outbox.status == 'pending')
+               & (models.Outbox.next_attempt_at == leased_until))
+        .values(next_attempt_at=func.now() + lease)
+        .returning(models.Outbox.next_attempt_at)
+        .execution_options(synchronize_session=False))
+    renewed = result.first()
+    await db.commit()
+    return renewed
+
+
+async def next_outbox_attempt(db: AsyncSession):
+    return await db.scalar(select(func.min(models.Outbox.next_attempt_at)).filter(models.Outbox.status == 'pending'))
+
+
+async def mark_outbox_sent(db: AsyncSession, message: models.Outbox):
+    await db.execute(update(models.Outbox).where(models.Outbox.id == message.id)
+                     .values(status='sent', sent_at=func.now(), last_error=None)
+                     .execution_options(synchronize_session=False))
+    await storage.release(db, message.files)
+    await db.commit()
+
+
+async def retry_outbox(db: AsyncSession, message: models.Outbox, delay: float, error: str, count_attempt: bool = True):
+    values = {'next_attempt_at': func.now() + datetime.timedelta(seconds=delay), 'last_error': error}
+    if not count_attempt:
+        values['attempts'] = models.Outbox.attempts - 1
+    await db.execute(update(models.Outbox).where(models.Outbox.id == message.id).values(**values)
+                     .execution_options(synchronize_session=False))
+    await db.commit()
+
+
+async def mark_outbox_dead(db: AsyncSession, message: models.Outbox, error: str):
+    await db.execute(update(models.Outbox).where(models.Outbox.id == message.id)
+                     .values(status='dead', last_error=error)
+                     .execution_options(synchronize_session=False))
+    await storage.release(db, message.files)
+    await db.commit()
+
+
+async def purge_outbox(db: AsyncSession, before):
+    """Delete messages sent before the given time, returns how many"""
+    result = await db.execute(delete(models.Outbox).filter((models.Outbox.status == 'sent') & (models.Outbox.sent_at < before)))
+    await db.commit()
+    return result.rowcount
+
+
+async def get_outbox_stats(db: AsyncSession, since):
+    depth = (await db.execute(
+        select(models.Outbox.status, func.count(), func.min(models.Outbox.created_at))
+        .group_by(models.Outbox.status))).all()
+    latency = models.Outbox.sent_at - models.Outbox.created_at
+    sent = (await db.execute(
+        select(func.count(),
+               func.percentile_cont(0.5).within_group(latency),
+               func.percentile_cont(0.95).within_group(latency),
+               func.max(latency))
+        .filter((models.Outbox.status == 'sent') & (models.Outbox.sent_at >= since)))).one()
+    return depth, sent
+
+
+async def get_telegram_file_ids(db: AsyncSession, digests) -> dict[str, str]:
+    result = await db.execute(select(models.TelegramFile.sha256, models.TelegramFile.file_id)
+                              .filter(models.TelegramFile.sha256.in_([d for d in digests if d])))
+    return dict(result.all())
+
+
+async def record_telegram_files(db: AsyncSession, hits: dict[str, int], uploaded: dict[str, str]):
+    for digest, count in hits.items():
+        await db.execute(update(models.TelegramFile).where(models.TelegramFile.sha256 == digest)
+                         .values(hits=models.TelegramFile.hits + count)
+                         .execution_options(synchronize_session=False))
+    for digest, file_id in uploaded.items():
+        query = insert(models.TelegramFile).values(sha256=digest, file_id=file_id, hits=0, uploads=1)
+        await db.execute(query.on_conflict_do_update(
+            index_elements=[models.TelegramFile.sha256],
+            set_={'file_id': query.excluded.file_id, 'uploads': models.TelegramFile.uploads + 1,
+                  'updated_at': func.now()}))
+    await db.commit()
+
+
+async def get_telegram_file_stats(db: AsyncSession):
+    return (await db.execute(select(func.count(), func.coalesce(func.sum(models.TelegramFile.hits), 0),
+                                    func.coalesce(func.sum(models.TelegramFile.uploads), 0)))).one()
+
+
+def _due_lessons(now, limit: int):
+    return (select(models.Schedule.id, models.Schedule.user_id, models.Schedule.scheduled_at)
+            .filter((models.Schedule.charged_at == None) & (models.Schedule.scheduled_at <= now))
+            .order_by(models.Schedule.scheduled_at, models.Schedule.id).limit(limit))
+
+
+async def settle_lessons(db: AsyncSession, now, limit: int):
+    """Charge up to limit held lessons in one statement, returns a row per debited user
+
+    Marks the lessons charged, debits lesson_price per lesson from the balance and writes a ledger
+    row per lesson. Lessons already charged or locked by a concurrent run are skipped, so running
+    it twice charges nothing twice. Doesn't commit.
+    """
+    schedule, users, ledger = models.Schedule.__table__, models.User.__table__, models.Ledger.__table__
+    due = _due_lessons(now, limit).with_for_update(of=schedule, skip_locked=True).cte('due')
+    charged = (update(schedule).where(schedule.c.id == due.c.id).values(charged_at=now)
+               .returning(schedule.c.id, schedule.c.user_id, schedule.c.scheduled_at).cte('charged'))
+    per_user = (select(charged.c.user_id, func.count().label('lessons'))
+                .group_by(charged.c.user_id).cte('per_user'))
+    price = func.coalesce(users.c.lesson_price, 0)
+    debited = (update(users).where(users.c.id == per_user.c.user_id)
+               .values(balance=func.coalesce(users.c.balance, 0) - price * per_user.c.lessons,
+                       data_version=users.c.data_version + 1)
+               .returning(users.c.id, users.c.username, users.c.data_version, price.label('price'),
+                          users.c.balance, per_user.c.lessons)
+               .cte('debited'))
+    # the balance right after each lesson; the latest lesson leaves the final balance
+    later = func.row_number().over(partition_by=charged.c.user_id,
+                                   order_by=(charged.c.scheduled_at.desc(), charged.c.id.desc())) - 1
+    entries = insert(ledger).from_select(
+        ['user_id', 'schedule_id', 'amount', 'balance_after', 'created_at'],
+        select(charged.c.user_id, charged.c.id, debited.c.price, debited.c.balance + debited.c.price * later,
+               literal(now, DateTime(timezone=True)))
+        .join(debited, debited.c.id == charged.c.user_id)
+    ).cte('entries')
+    result = await db.execute(
+        select(debited.c.id.label('user_id'), debited.c.username, debited.c.data_version, debited.c.lessons,
+               (debited.c.price * debited.c.lessons).label('amount'), debited.c.balance)
+        .add_cte(entries))
+    settled = result.all()
+    await announce_data_versions(db, [(row.user_id, row.data_version) for row in settled])
+    return settled
+
+
+async def preview_settlement(db: AsyncSession, now, limit: int):
+    """What settle_lessons would charge for the same batch, without changing anything"""
+    due = _due_lessons(now, limit).cte('due')
+    per_user = (select(due.c.user_id, func.count().label('lessons'))
+                .group_by(due.c.user_id).cte('per_user'))
+    price = func.coalesce(models.User.lesson_price, 0)
+    result = await db.execute(
+        select(models.User.id.label('user_id'), per_user.c.lessons, (price * per_user.c.lessons).label('amount'),
+               (func.coalesce(models.User.balance, 0) - price * per_user.c.lessons).label('balance'))
+        .join(per_user, per_user.c.user_id == models.User.id))
+    return result.all()
+
+
+async def get_balance_forecast(db: AsyncSession, user_id: int, until):
+    """(balance, lesson_price, scheduled_at of every uncharged lesson up to until, oldest first), None if there's no such user"""
+    result = await db.execute(
+        select(models.User.balance, models.User.lesson_price, models.Schedule.scheduled_at)
+        .outerjoin(models.Schedule, (models.Schedule.user_id == models.User.id) & (models.Schedule.charged_at == None)
+                   & (models.Schedule.scheduled_at <= until))
+        .filter(models.User.id == user_id)
+        .order_by(models.Schedule.scheduled_at, models.Schedule.id))
+    rows = result.all()
+    if not rows:
+        return None
+    lessons = [row.scheduled_at for row in rows if row.scheduled_at is not None]
+    return rows[0].balance or 0, rows[0].lesson_price or 0, lessons
+
+
+async def get_ledger(db: AsyncSession, user_id: int, limit: int = 20, cursor: str | None = None):
+    query = pagination.keyset(select(models.Ledger).filter(models.Ledger.user_id == user_id),
+                              models.Ledger.created_at, models.Ledger.id, cursor)
+    result = await db.scalars(query.limit(limit))
+    return result.all()
@@ -1,18 +1,96 @@
-from sqlalchemy import create_engine
+import time
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
 
-# SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+# SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./sql_app.db"
 import config
 
-engine = create_engine(
-    config.POSTGRES_URI,
-    echo=False
-)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a free connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+
+def build_engine(pool: dict):
+    connect_args = {}
+    if pool['statement_timeout']:
+        connect_args['server_settings'] = {'statement_timeout': str(pool['statement_timeout'])}
+    return create_async_engine(
+        config.POSTGRES_URI,
+        echo=False,
+        poolclass=TimedQueuePool,
+        pool_size=pool['pool_size'],
+        max_overflow=pool['max_overflow'],
+        pool_recycle=pool['pool_recycle'],
+        pool_pre_ping=pool['pool_pre_ping'],
+        pool_timeout=pool['pool_timeout'],
+        connect_args=connect_args,
+    )
+
+
+engine = build_engine(config.API_DB_POOL)
 # sqlite
-# engine = create_engine(
+# engine = create_async_engine(
 #     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 # )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: objects are serialized after commit, and an expired
+# attribute can't be lazily reloaded on an AsyncSession
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
+
+
+def use_pool(pool: dict):
+    """Rebind SessionLocal to an engine with other pool settings, e.g. config.BOT_DB_POOL"""
+    global engine
+    engine = build_engine(pool)
+    SessionLocal.configure(bind=engine)
+    return engine
+
+
+_listen_engine = None
+
+
+def listen_engine():
+    """Engine for connections a LISTEN loop holds for good; NullPool, so no pool is one short meanwhile"""
+    global _listen_engine
+    if _listen_engine is None:
+        _listen_engine = create_async_engine(config.POSTGRES_URI, poolclass=NullPool)
+    return _listen_engine
+
 
-Base = declarative_base()
\ No newline at end of file
+def pool_stats() -> dict:
+    pool = engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': pool._max_overflow,
+        'checkouts': pool.checkouts,
+        'timeouts': pool.timeouts,
+        'wait_avg_ms': round(pool.wait_total / pool.checkouts * 1000, 3) if pool.checkouts else 0.0,
+        'wait_max_ms': round(pool.wait_max * 1000, 3),
+    }
@@ -0,0 +1,63 @@
+import ast
+import functools
+import os
+import re
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VERSIONS_DIR = os.path.join(APP_DIR, 'migrations', 'versions')
+# Schema that create_all used to produce, see migrations/versions/0001_initial.py
+BASELINE_REVISION = '0001'
+_REVISION_RE = re.compile(r'^(revision|down_revision)\s*(?::[^=]*)?=\s*(.+)$', re.MULTILINE)
+
+
+def alembic_config(connection=None):
+    # alembic is imported only when a migration has to run, it's a noticeable part of startup
+    from alembic.config import Config
+    cfg = Config(os.path.join(APP_DIR, 'alembic.ini'))
+    cfg.set_main_option('script_location', os.path.join(APP_DIR, 'migrations'))
+    cfg.attributes['configure_logger'] = False
+    cfg.attributes['connection'] = connection
+    return cfg
+
+
+@functools.cache
+def head_revisions() -> frozenset[str]:
+    """Heads of migrations/versions, read from the files without loading them"""
+    revisions, parents = set(), set()
+    for name in os.listdir(VERSIONS_DIR):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(VERSIONS_DIR, name)) as f:
+            for field, value in _REVISION_RE.findall(f.read()):
+                value = ast.literal_eval(value.strip())
+                if field == 'revision':
+                    revisions.add(value)
+                elif isinstance(value, str):
+                    parents.add(value)
+                elif value:
+                    parents.update(value)
+    return frozenset(revisions - parents)
+
+
+def is_up_to_date(connection) -> bool:
+    if connection.scalar(text("SELECT to_regclass('alembic_version')")) is None:
+        return False
+    return set(connection.scalars(text('SELECT version_num FROM alembic_version'))) == head_revisions()
+
+
+def upgrade(connection):
+    from alembic import command
+    cfg = alembic_config(connection)
+    tables = inspect(connection).get_table_names()
+    if 'users' in tables and 'alembic_version' not in tables:
+        # Database created by create_all before migrations existed
+        command.stamp(cfg, BASELINE_REVISION)
+    command.upgrade(cfg, 'head')
+
+
+async def upgrade_database(engine: AsyncEngine):
+    async with engine.begin() as connection:
+        await connection.run_sync(upgrade)
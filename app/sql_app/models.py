@@ -2,8 +2,10 @@ import random
 import string
 from typing import List
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, func, ARRAY, BigInteger, DECIMAL
-from sqlalchemy.orm import relationship, Mapped, mapped_column, backref
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, func, ARRAY, BigInteger, DECIMAL, Index, text, \
+    UniqueConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, Mapped, mapped_column, backref, deferred
 
 from .database import Base
 
@@ -15,22 +17,41 @@ def generate_tg_hash():
 
 class User(Base):
     __tablename__ = "users"
+    # Indexes mirror the queries in crud.py and are created by migrations/versions/
+    __table_args__ = (
+        Index('ix_users_students_created', 'created', 'id', postgresql_where=text('is_super = false')),
+        UniqueConstraint('feed_token', name='uq_users_feed_token'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    tg_id = Column(BigInteger, nullable=True)
+    tg_id = Column(BigInteger, nullable=True, index=True)
     username = Column(String, unique=True, index=True)
     full_name = Column(String, nullable=True)
     hashed_password = Column(String)
-    tg_hash = Column(String, default=generate_tg_hash)
+    tg_hash = Column(String, default=generate_tg_hash, index=True)
     is_active = Column(Boolean, default=True)
     created = Column(DateTime(timezone=True), server_default=func.now())
     is_super = Column(Boolean, default=False)
     balance = Column(DECIMAL(), default=0)
     lesson_price = Column(DECIMAL(), default=500)
+    # bumped by crud whenever this user's schedule, homework or notes change, see response_cache.py
+    data_version = Column(BigInteger, nullable=False, server_default='0')
+    # secret part of the iCalendar feed URL, NULL until the user asks for one or after it's revoked
+    feed_token = Column(String, nullable=True)
+    # last create, update or delete of this user's lessons; the feed's Last-Modified
+    schedule_changed_at = Column(DateTime(timezone=True), nullable=True)
 
 
 class Schedule(Base):
     __tablename__ = 'schedule'
+    __table_args__ = (
+        Index('ix_schedule_user_id_scheduled_at', 'user_id', 'scheduled_at', 'id'),
+        Index('ix_schedule_scheduled_at', 'scheduled_at', 'id'),
+        # reminders the bot still has to send
+        Index('ix_schedule_pending_reminders', 'scheduled_at', postgresql_where=text('tg_notified = false')),
+        # lessons settlement.py still has to charge
+        Index('ix_schedule_uncharged', 'scheduled_at', 'id', postgresql_where=text('charged_at IS NULL')),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = mapped_column(ForeignKey('users.id', ondelete="cascade"))
@@ -38,10 +59,17 @@ class Schedule(Base):
     note = Column(String, nullable=True)
     scheduled_at = Column(DateTime(timezone=True), nullable=False)
     tg_notified = Column(Boolean, default=False)
+    # set when settlement debited lesson_price for this lesson
+    charged_at = Column(DateTime(timezone=True), nullable=True)
 
 
 class Homework(Base):
     __tablename__ = 'homework'
+    __table_args__ = (
+        Index('ix_homework_user_id_created_at', 'user_id', 'created_at', 'id'),
+        Index('ix_homework_created_at', 'created_at', 'id'),
+        Index('ix_homework_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -49,10 +77,17 @@ class Homework(Base):
     user: Mapped["User"] = relationship(backref=backref('homeworks', passive_deletes=True))
     files = Column(ARRAY(String))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # search_document(name, files), kept up to date by crud
+    search_vector = deferred(Column(TSVECTOR))
 
 
 class Notes(Base):
     __tablename__ = 'notes'
+    __table_args__ = (
+        Index('ix_notes_user_id_created_at', 'user_id', 'created_at', 'id'),
+        Index('ix_notes_created_at', 'created_at', 'id'),
+        Index('ix_notes_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -60,3 +95,73 @@ class Notes(Base):
     user: Mapped["User"] = relationship(backref=backref('notes', passive_deletes=True))
     files = Column(ARRAY(String))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # search_document(name, files), kept up to date by crud
+    search_vector = deferred(Column(TSVECTOR))
+
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+    __table_args__ = (
+        # garbage collection candidates
+        Index('ix_blobs_orphaned_at', 'orphaned_at', postgresql_where=text('ref_count <= 0')),
+    )
+
+    sha256 = Column(String(64), primary_key=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    # references from homework.files, notes.files and outbox.files
+    ref_count = Column(Integer, nullable=False, default=0)
+    # set while ref_count is 0; garbage collection removes blobs orphaned for long enough
+    orphaned_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Outbox(Base):
+    """Telegram messages waiting for delivery.py, written in the transaction that caused them"""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_pending', 'next_attempt_at', postgresql_where=text("status = 'pending'")),
+        Index('ix_outbox_sent_at', 'sent_at', postgresql_where=text("status = 'sent'")),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    files = Column(ARRAY(String), nullable=False, default=list)
+    # pending -> sent, or dead after OUTBOX_MAX_ATTEMPTS or a permanent error
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class Ledger(Base):
+    """One row per lesson charged by settlement.py"""
+    __tablename__ = 'ledger'
+    __table_args__ = (
+        Index('ix_ledger_user_id_created_at', 'user_id', 'created_at', 'id'),
+        # one charge per lesson, whatever runs the settlement
+        UniqueConstraint('schedule_id', name='uq_ledger_schedule_id'),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    user_id = Column(ForeignKey('users.id', ondelete="cascade"), nullable=False)
+    schedule_id = Column(ForeignKey('schedule.id', ondelete="set null"), nullable=True)
+    amount = Column(DECIMAL(), nullable=False)
+    balance_after = Column(DECIMAL(), nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class TelegramFile(Base):
+    """file_id Telegram gave a document, by content, so it is uploaded only once"""
+    __tablename__ = 'telegram_files'
+
+    sha256 = Column(String(64), primary_key=True)
+    file_id = Column(String, nullable=False)
+    # sends by file_id and uploads, for the hit rate
+    hits = Column(Integer, nullable=False, default=0)
+    uploads = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
@@ -0,0 +1,46 @@
+import base64
+import binascii
+import datetime
+import json
+
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_
+from starlette import status
+
+PAGE_SIZE = 20
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def encode_cursor(value: datetime.datetime, row_id: int) -> str:
+    raw = json.dumps([value.isoformat(), row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, row_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(value), int(row_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+
+
+def keyset(query, sort_column, id_column, cursor: str | None):
+    """Newest first by (sort_column, id_column), starting after cursor when one is given
+
+    Unlike OFFSET the database seeks straight to the cursor, so every page costs the same
+    and rows inserted between requests don't shift the pages.
+    """
+    if cursor:
+        query = query.filter(tuple_(sort_column, id_column) < tuple_(*decode_cursor(cursor)))
+    return query.order_by(sort_column.desc(), id_column.desc())
+
+
+def set_next_cursor(response: Response, rows: list, sort_attr: str, limit: int | None = PAGE_SIZE):
+    """Expose the cursor of the page after rows, if there can be one"""
+    if limit and len(rows) == limit:
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(last, sort_attr), last.id)
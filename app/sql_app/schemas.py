@@ -1,7 +1,8 @@
 import decimal
-from datetime import datetime
+from datetime import datetime, date, time
+from typing import Annotated
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, TypeAdapter
 
 
 class UserBase(BaseModel):
@@ -44,10 +45,9 @@ class User(UserBase):
         orm_mode = True
 
 
-class Schedule(BaseModel):
+class ScheduleSlim(BaseModel):
     id: int
     user_id: int
-    user: User
     note: str | None
     tg_notified: bool
     scheduled_at: datetime
@@ -56,6 +56,10 @@ class Schedule(BaseModel):
         orm_mode = True
 
 
+class Schedule(ScheduleSlim):
+    user: User
+
+
 class ScheduleUpdate(BaseModel):
     id: int
     scheduled_at: datetime
@@ -67,10 +71,83 @@ class ScheduleCreate(BaseModel):
     note: str = None
 
 
-class Homework(BaseModel):
+class ScheduleRecurrence(BaseModel):
+    """Weekly lessons for every user from start_date to end_date inclusive"""
+    user_ids: list[int]
+    # 0 is Monday
+    weekdays: list[Annotated[int, Field(ge=0, le=6)]]
+    time: time
+    start_date: date
+    end_date: date
+    # dates without a lesson, e.g. holidays
+    exceptions: list[date] = []
+    timezone: str = 'Europe/Moscow'
+    note: str = None
+
+
+class ScheduleBulkCreate(BaseModel):
+    """Either schedules or recurrence"""
+    schedules: list[ScheduleCreate] = None
+    recurrence: ScheduleRecurrence = None
+
+
+class ScheduleCreated(BaseModel):
+    id: int
+    user_id: int
+    scheduled_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class ScheduleBulkResult(BaseModel):
+    created: int
+    schedules: list[ScheduleCreated]
+
+
+class SettlementResult(BaseModel):
+    dry_run: bool
+    lessons: int
+    users: int
+    amount: decimal.Decimal
+
+
+class BalanceForecast(BaseModel):
+    user_id: int
+    balance: decimal.Decimal
+    lesson_price: decimal.Decimal
+    # held but not charged yet
+    pending_lessons: int
+    # scheduled up to until
+    upcoming_lessons: int
+    until: datetime
+    projected_balance: decimal.Decimal
+    # uncharged lessons, oldest first, the balance pays for, and the first one it doesn't
+    lessons_covered: int
+    negative_from: datetime | None
+
+
+class CalendarFeed(BaseModel):
+    user_id: int
+    # iCalendar URL to subscribe to, None once revoked
+    url: str | None
+
+
+class LedgerEntry(BaseModel):
+    id: int
+    user_id: int
+    schedule_id: int | None
+    amount: decimal.Decimal
+    balance_after: decimal.Decimal
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class HomeworkSlim(BaseModel):
     id: int
     user_id: int
-    user: User
     files: list[str]
     name: str
     created_at: datetime
@@ -79,6 +156,10 @@ class Homework(BaseModel):
         orm_mode = True
 
 
+class Homework(HomeworkSlim):
+    user: User
+
+
 class HomeworkCreate(BaseModel):
     user_id: int
     name: str
@@ -90,10 +171,9 @@ class HomeworkUpdate(UserBase):
     files: list[str] = None
 
 
-class Notes(BaseModel):
+class NotesSlim(BaseModel):
     id: int
     user_id: int
-    user: User
     files: list[str]
     name: str
     created_at: datetime
@@ -102,6 +182,20 @@ class Notes(BaseModel):
         orm_mode = True
 
 
+class Notes(NotesSlim):
+    user: User
+
+
 class NotesCreate(BaseModel):
     user_id: int
     name: str
+
+
+# Serializers of the list endpoints, compiled once, see responses.SchemaResponse
+USER_LIST = TypeAdapter(list[User])
+SCHEDULE_LIST = TypeAdapter(list[Schedule])
+SCHEDULE_SLIM_LIST = TypeAdapter(list[ScheduleSlim])
+HOMEWORK_LIST = TypeAdapter(list[Homework])
+HOMEWORK_SLIM_LIST = TypeAdapter(list[HomeworkSlim])
+NOTES_LIST = TypeAdapter(list[Notes])
+NOTES_SLIM_LIST = TypeAdapter(list[NotesSlim])
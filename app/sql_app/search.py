@@ -0,0 +1,51 @@
+import re
+
+from fastapi import HTTPException
+from sqlalchemy import func, bindparam, String, ARRAY
+from starlette import status
+
+from . import pagination
+
+# Same split as the [[:punct:]] replacement in search_document, see migrations/versions/0004_search.py
+_WORD_RE = re.compile(r'[^\W_]+')
+
+
+def document(name: str, files: list[str] | None):
+    """The search_vector value for a row with this name and files"""
+    return func.search_document(bindparam(None, name, String), bindparam(None, files or [], ARRAY(String)))
+
+
+def ts_query(text: str, files: bool = False) -> str | None:
+    """Every word of text as a prefix, in the name only or in the name and file names"""
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    weights = 'AB' if files else 'A'
+    return ' & '.join(f'{word}:*{weights}' for word in words)
+
+
+def apply(query, model, text: str, files: bool, sort: str, cursor: str | None, use_index: bool = False):
+    """Filter query to rows matching text, ordered by sort; None when text has nothing to search for
+
+    The match goes through the search_vector GIN index only with use_index. A query already
+    narrowed to one user is faster through the user_id index with the match as a filter: ANDed
+    with the GIN index the planner reads every row of the whole table matching a common prefix.
+    """
+    terms = ts_query(text, files)
+    if terms is None:
+        return None
+    tsquery = func.to_tsquery('simple', terms)
+    if use_index:
+        query = query.filter(model.search_vector.op('@@')(tsquery))
+    else:
+        # the function behind @@, which no index can answer
+        query = query.filter(func.ts_match_vq(model.search_vector, tsquery))
+    if sort == 'relevance':
+        if cursor:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Cursor is only supported with sort=recent",
+            )
+        rank = func.ts_rank(model.search_vector, tsquery)
+        return query.order_by(rank.desc(), model.created_at.desc(), model.id.desc())
+    return pagination.keyset(query, model.created_at, model.id, cursor)
@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import re
+from collections import Counter
+from contextlib import suppress
+from dataclasses import dataclass
+
+from sqlalchemy import select, update, delete, func, case, event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import config
+from sql_app import models
+from sql_app.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+BLOB_DIR = 'docs/blobs'
+# Session.info key of the uploads waiting for their transaction to commit
+_STAGED = 'staged_blobs'
+# Homework.files / Notes.files hold "docs/<sha256>" for stored blobs, so the name after
+# "docs/" is what /file/ expects. Older rows hold real paths like "docs/name.pdf"
+_REF_RE = re.compile(r'^docs/([0-9a-f]{64})$')
+
+
+@dataclass
+class Attachment:
+    path: str
+    filename: str
+    # content hash, also for files outside the blob store; None if the file is missing
+    sha256: str | None
+
+
+@dataclass
+class StagedBlob:
+    tmp_path: str
+    sha256: str
+    size: int
+    filename: str
+    content_type: str
+
+
+def blob_path(digest: str) -> str:
+    return f'{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def file_ref(digest: str) -> str:
+    return f'docs/{digest}'
+
+
+def parse_ref(ref: str) -> str | None:
+    match = _REF_RE.match(ref)
+    return match.group(1) if match else None
+
+
+def is_digest(name: str) -> bool:
+    return parse_ref(file_ref(name)) is not None
+
+
+async def add_blobs(db: AsyncSession, staged: list[StagedBlob]) -> list[str]:
+    """Write the rows of staged uploads in the caller's transaction and return their refs
+
+    The files are moved into the store when that transaction commits and deleted if it doesn't,
+    so an upload that is rolled back leaves no file without a row behind.
+    """
+    if not staged:
+        return []
+    rows = {}
+    for s in staged:
+        rows.setdefault(s.sha256, {'sha256': s.sha256, 'filename': s.filename, 'content_type': s.content_type,
+                                   'size': s.size, 'ref_count': 0})
+    query = insert(models.Blob).values(list(rows.values()))
+    # Touching orphaned_at of an existing blob both locks the row against a running garbage
+    # collection and restarts its grace period, so its file is safe to reuse on commit
+    query = query.on_conflict_do_update(
+        index_elements=[models.Blob.sha256],
+        set_={'orphaned_at': func.now()},
+        where=models.Blob.ref_count <= 0,
+    )
+    await db.execute(query)
+    db.sync_session.info.setdefault(_STAGED, []).extend(staged)
+    return [file_ref(s.sha256) for s in staged]
+
+
+def _place_staged(session: Session):
+    for s in session.info.pop(_STAGED, []):
+        path = blob_path(s.sha256)
+        try:
+            # the same content uploaded at the same time is placed by whichever commits first
+            if os.path.exists(path):
+                os.remove(s.tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(s.tmp_path, path)
+        except OSError:
+            logger.exception('Could not move %s to %s', s.tmp_path, path)
+
+
+def _drop_staged(session: Session, transaction):
+    # after a commit _place_staged has taken them, so these were rolled back or never committed
+    if transaction.parent is None:
+        for s in session.info.pop(_STAGED, []):
+            with suppress(FileNotFoundError):
+                os.remove(s.tmp_path)
+
+
+event.listen(Session, 'after_commit', _place_staged)
+event.listen(Session, 'after_transaction_end', _drop_staged)
+
+
+async def _change_refs(db: AsyncSession, refs: list[str], delta: int):
+    counts = Counter(digest for digest in map(parse_ref, refs) if digest)
+    for digest, n in counts.items():
+        ref_count = models.Blob.ref_count + delta * n
+        await db.execute(update(models.Blob).where(models.Blob.sha256 == digest).values(
+            ref_count=ref_count,
+            orphaned_at=case((ref_count <= 0, func.coalesce(models.Blob.orphaned_at, func.now())), else_=None),
+        ).execution_options(synchronize_session=False))
+
+
+async def acquire(db: AsyncSession, refs: list[str]):
+    await _change_refs(db, refs, 1)
+
+
+async def release(db: AsyncSession, refs: list[str]):
+    await _change_refs(db, refs, -1)
+
+
+async def get_blob(db: AsyncSession, digest: str):
+    return await db.scalar(select(models.Blob).filter(models.Blob.sha256 == digest))
+
+
+async def attachments(db: AsyncSession, refs: list[str]) -> list[Attachment]:
+    digests = [parse_ref(ref) for ref in refs]
+    result = await db.scalars(select(models.Blob).filter(models.Blob.sha256.in_([d for d in digests if d])))
+    blobs = {blob.sha256: blob for blob in result}
+    files = []
+    for ref, digest in zip(refs, digests):
+        if digest in blobs:
+            files.append(Attachment(blob_path(digest), blobs[digest].filename, digest))
+        elif digest is None:
+            files.append(Attachment(ref, os.path.basename(ref), await file_digest(ref)))
+    return files
+
+
+# (path, size, mtime) -> sha256 of files outside the blob store
+_file_digests: dict[tuple[str, int, int], str] = {}
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(config.UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def file_digest(path: str) -> str | None:
+    """sha256 of a file by path, hashed again only when its size or mtime changes"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        _file_digests[key] = await asyncio.to_thread(_hash_file, path)
+    return _file_digests[key]
+
+
+async def collect_garbage(batch_size: int = 500) -> int:
+    """Delete blobs nothing has referenced for BLOB_GC_GRACE seconds, returns how many were removed"""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=config.BLOB_GC_GRACE)
+    removed = 0
+    async with SessionLocal() as db:
+        while True:
+            # Rows stay locked until commit, so a concurrent upload of the same content waits
+            # in add_blobs and then inserts a fresh row after the file is gone
+            digests = (await db.scalars(
+                select(models.Blob.sha256)
+                .filter((models.Blob.ref_count <= 0) & (models.Blob.orphaned_at < cutoff))
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )).all()
+            if not digests:
+                break
+            for digest in digests:
+                try:
+                    os.remove(blob_path(digest))
+                except FileNotFoundError:
+                    pass
+            await db.execute(delete(models.Blob).filter(models.Blob.sha256.in_(digests)))
+            await db.commit()
+            removed += len(digests)
+    return removed
+
+
+async def run_garbage_collection():
+    """collect_garbage every BLOB_GC_INTERVAL seconds; workers that run it at once share the work"""
+    while True:
+        await asyncio.sleep(config.BLOB_GC_INTERVAL)
+        try:
+            removed = await collect_garbage()
+            if removed:
+                logger.info('Removed %s unreferenced blobs', removed)
+        except Exception:
+            logger.exception('Blob garbage collection failed')
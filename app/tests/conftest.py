@@ -0,0 +1,59 @@
+"""Tests run from app/ with `python -m pytest`
+
+Tests that need a database run against TEST_POSTGRES_URI and are skipped without it. Its public
+schema is dropped and migrated again for each of them, so never point it at real data.
+"""
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault('ACCESS_TOKEN_EXPIRE_MINUTES', '30')
+os.environ.setdefault('HASH_SECRET', 'tests')
+os.environ.setdefault('BOT_TOKEN', '42:tests')
+TEST_POSTGRES_URI = os.environ.get('TEST_POSTGRES_URI')
+
+import config
+
+if TEST_POSTGRES_URI:
+    config.POSTGRES_URI = TEST_POSTGRES_URI
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+async def client(tmp_path, monkeypatch):
+    """httpx client of the app on an empty database migrated by the lifespan, with the default admin"""
+    if not TEST_POSTGRES_URI:
+        pytest.skip('TEST_POSTGRES_URI is not set')
+    import httpx
+    from sqlalchemy import text
+    import main
+    from sql_app.cache import principals
+    from sql_app.database import engine
+    # uploads go to docs/ under the working directory
+    monkeypatch.chdir(tmp_path)
+    principals.clear()
+    async with engine.begin() as conn:
+        await conn.execute(text('DROP SCHEMA public CASCADE'))
+        await conn.execute(text('CREATE SCHEMA public'))
+    await engine.dispose()
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url='http://test') as c:
+            yield c
+
+
+async def login(client, username: str, password: str) -> dict:
+    response = await client.post('/auth/token', data={'username': username, 'password': password})
+    assert response.status_code == 200, response.text
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture
+async def admin(client):
+    return await login(client, config.ADMIN_USERNAME, config.ADMIN_PASSWORD)
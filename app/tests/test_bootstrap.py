@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select, func
+
+import bootstrap
+import config
+from sql_app import database
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_waiting_worker_outlasts_statement_timeout(client):
+    engine = database.build_engine({**config.API_DB_POOL, 'statement_timeout': 200})
+    try:
+        # the worker that is migrating, for longer than the timeout
+        async with database.engine.begin() as conn:
+            await conn.execute(select(func.pg_advisory_xact_lock(bootstrap.LOCK_KEY)))
+            waiting = asyncio.create_task(bootstrap.bootstrap(engine))
+            await asyncio.sleep(0.6)
+            assert not waiting.done()
+        assert await waiting == {'migrated': False, 'admin_created': False}
+    finally:
+        await engine.dispose()
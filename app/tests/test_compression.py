@@ -0,0 +1,35 @@
+import zlib
+
+import brotli
+import pytest
+
+from compression import CompressionMiddleware
+
+pytestmark = pytest.mark.anyio
+
+
+async def _streamed(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'first chunk ' * 10, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'last chunk'})
+
+
+@pytest.mark.parametrize('encoding, decompressor', [
+    ('gzip', lambda: zlib.decompressobj(31)),
+    ('br', brotli.Decompressor),
+])
+async def test_streamed_chunks_are_flushed(encoding, decompressor):
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'headers': [(b'accept-encoding', encoding.encode())]}
+    await CompressionMiddleware(_streamed)(scope, None, send)
+    start, first, last = sent
+    assert (b'content-encoding', encoding.encode()) in start['headers']
+    decoder = decompressor()
+    decode = decoder.process if encoding == 'br' else decoder.decompress
+    # a client can read the first chunk before the response ends
+    assert decode(first['body']) == b'first chunk ' * 10
+    assert decode(last['body']) == b'last chunk'
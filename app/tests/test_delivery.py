@@ -0,0 +1,51 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+from sqlalchemy import select
+
+import delivery
+from sql_app import crud, models
+from sql_app.database import SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_lease_outlives_a_flood_pause(client, monkeypatch):
+    sent = []
+
+    async def send_files(chat_id, text, files, file_ids=None):
+        sent.append(text)
+
+    monkeypatch.setattr(delivery, 'send_files', send_files)
+    async with SessionLocal() as db:
+        await crud.queue_message(db, 1, 'hello')
+        await db.commit()
+
+    paused = delivery.DeliveryWorker()
+    paused.lease = datetime.timedelta(seconds=0.3)
+    paused.paused_until = time.monotonic() + 1.5
+    task = asyncio.create_task(paused.drain())
+    await asyncio.sleep(1)
+    # the first lease has ended long ago, another worker must still keep its hands off
+    assert await delivery.DeliveryWorker().drain() == 0
+    assert await task == 1
+
+    assert sent == ['hello']
+    async with SessionLocal() as db:
+        message = await db.scalar(select(models.Outbox))
+    assert message.status == 'sent'
+    assert message.attempts == 1
+
+
+async def test_renewal_keeps_a_retry_time(client):
+    async with SessionLocal() as db:
+        await crud.queue_message(db, 1, 'hello')
+        await db.commit()
+        [message] = await crud.claim_outbox(db, 10, datetime.timedelta(minutes=5))
+        await crud.retry_outbox(db, message, 3600, 'failed')
+        lease = datetime.timedelta(minutes=5)
+        assert await crud.extend_outbox_lease(db, [message.id], message.next_attempt_at, lease) is None
+        retry_at = await crud.next_outbox_attempt(db)
+    assert retry_at - message.next_attempt_at > datetime.timedelta(minutes=30)
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from sqlalchemy import update
+
+import hashing
+from sql_app import cache, models
+from sql_app.cache import principals
+from sql_app.database import SessionLocal
+from tests.conftest import login
+
+pytestmark = pytest.mark.anyio
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_ttl_cache_expires_and_evicts(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    entries = cache.TTLCache(maxsize=2, ttl=10)
+    entries.set('a', 1)
+    entries.set('b', 2)
+    assert entries.get('a') == 1
+    # 'b' is now the least recently used
+    entries.set('c', 3)
+    assert entries.get('b') is None
+    clock.now = 10.5
+    assert entries.get('a') is None and entries.get('c') is None
+    assert entries.stats()['hits'] == 1 and entries.stats()['misses'] == 3
+
+
+async def _create_student(client, admin, username='student', password='password'):
+    response = await client.post('/users/create/', json={'username': username, 'password': password}, headers=admin)
+    assert response.status_code == 200, response.text
+    return response.json()['id'], await login(client, username, password)
+
+
+async def test_deactivated_user_is_rejected_again_within_ttl(client, admin, monkeypatch):
+    monkeypatch.setattr(principals, 'ttl', 0.5)
+    user_id, headers = await _create_student(client, admin)
+    assert (await client.get('/users/me/', headers=headers)).status_code == 200
+    # as another worker would, so this process's cache isn't told
+    async with SessionLocal() as db:
+        await db.execute(update(models.User).where(models.User.id == user_id).values(is_active=False))
+        await db.commit()
+    await asyncio.sleep(principals.ttl)
+    response = await client.get('/users/me/', headers=headers)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Inactive user'
+
+
+async def test_deleted_user_is_rejected_at_once(client, admin):
+    user_id, headers = await _create_student(client, admin)
+    assert (await client.get('/users/me/', headers=headers)).status_code == 200
+    response = await client.post('/users/delete/', json={'id': user_id}, headers=admin)
+    assert response.status_code == 200, response.text
+    assert (await client.get('/users/me/', headers=headers)).status_code == 401
+
+
+async def test_change_password_checks_the_stored_hash(client, admin):
+    user_id, headers = await _create_student(client, admin, password='first')
+    assert (await client.get('/users/me/', headers=headers)).status_code == 200
+    # the password changed through another worker while this one holds the cached user
+    async with SessionLocal() as db:
+        await db.execute(update(models.User).where(models.User.id == user_id)
+                         .values(hashed_password=await hashing.hash_password('second')))
+        await db.commit()
+    response = await client.post('/auth/changepassword', json={'old_password': 'first', 'new_password': 'third'},
+                                 headers=headers)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Old password mismatch'
+    response = await client.post('/auth/changepassword', json={'old_password': 'second', 'new_password': 'third'},
+                                 headers=headers)
+    assert response.status_code == 200, response.text
+    await login(client, 'student', 'third')
+
+
+async def test_settlement_shows_in_me_at_once(client, admin):
+    user_id, headers = await _create_student(client, admin)
+    response = await client.post('/users/update/', json={'id': user_id, 'lesson_price': '10', 'balance': '100'},
+                                 headers=admin)
+    assert response.status_code == 200, response.text
+    response = await client.post('/schedule/create/', json={'user_id': user_id, 'scheduled_at': '2026-01-05T10:00:00Z'},
+                                 headers=admin)
+    assert response.status_code == 200, response.text
+    assert float((await client.get('/users/me/', headers=headers)).json()['balance']) == 100
+    response = await client.post('/users/settle/', params={'dry_run': False}, headers=admin)
+    assert response.json()['lessons'] == 1
+    assert float((await client.get('/users/me/', headers=headers)).json()['balance']) == 90
@@ -0,0 +1,97 @@
+"""Queries per request of every list endpoint, which must not grow with the rows on the page
+
+Each request is measured with empty in-process caches, so the principal lookup and the
+response cache are counted along with the listing itself.
+"""
+import datetime
+
+import pytest
+
+from profiler import QueryCounter
+from response_cache import data_versions, listings
+from routers.token import create_access_token
+from sql_app import models, search
+from sql_app.cache import principals
+from sql_app.database import SessionLocal, engine
+from sql_app.pagination import NEXT_CURSOR_HEADER
+
+pytestmark = pytest.mark.anyio
+
+STUDENTS = 25
+ROWS = 25
+
+# path, query of a short page, query of a full page, whether an admin asks; user_id -1 lists everyone's
+ENDPOINTS = [
+    ('/users/get/', {'limit': 2}, {'limit': 20}, True),
+    ('/schedule/get/', {'offset': ROWS - 2}, {}, False),
+    ('/schedule/get/', {'offset': ROWS - 2, 'expand': 'user'}, {'expand': 'user'}, False),
+    ('/schedule/get/', {'user_id': -1, 'offset': STUDENTS * ROWS - 2, 'expand': 'user'},
+     {'user_id': -1, 'expand': 'user'}, True),
+    ('/homework/get/', {'offset': ROWS - 2}, {}, False),
+    ('/homework/get/', {'offset': ROWS - 2, 'expand': 'user'}, {'expand': 'user'}, False),
+    ('/homework/get/', {'user_id': -1, 'offset': STUDENTS * ROWS - 2, 'expand': 'user'},
+     {'user_id': -1, 'expand': 'user'}, True),
+    ('/homework/search/', {'q': 'homework', 'offset': ROWS - 2}, {'q': 'homework'}, False),
+    ('/homework/search/', {'q': 'homework', 'offset': ROWS - 2, 'expand': 'user'},
+     {'q': 'homework', 'expand': 'user'}, False),
+    ('/note/get/', {'offset': ROWS - 2}, {}, False),
+    ('/note/get/', {'offset': ROWS - 2, 'expand': 'user'}, {'expand': 'user'}, False),
+    ('/note/get/', {'user_id': -1, 'offset': STUDENTS * ROWS - 2, 'expand': 'user'},
+     {'user_id': -1, 'expand': 'user'}, True),
+    ('/note/search/', {'q': 'note', 'offset': ROWS - 2}, {'q': 'note'}, False),
+    ('/note/search/', {'q': 'note', 'offset': ROWS - 2, 'expand': 'user'}, {'q': 'note', 'expand': 'user'}, False),
+]
+
+
+@pytest.fixture
+async def student(client):
+    """Token of the first of STUDENTS students with ROWS lessons, homework, notes and ledger entries each"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    async with SessionLocal() as db:
+        users = [models.User(username=f'student-{i}', hashed_password='-', full_name=f'Student {i}', is_super=False)
+                 for i in range(STUDENTS)]
+        db.add_all(users)
+        await db.flush()
+        for user in users:
+            for j in range(ROWS):
+                moment = now - datetime.timedelta(days=j, minutes=user.id)
+                db.add(models.Schedule(user_id=user.id, scheduled_at=moment))
+                db.add(models.Homework(user_id=user.id, name=f'homework {j}', files=[], created_at=moment,
+                                       search_vector=search.document(f'homework {j}', [])))
+                db.add(models.Notes(user_id=user.id, name=f'note {j}', files=[], created_at=moment,
+                                    search_vector=search.document(f'note {j}', [])))
+                db.add(models.Ledger(user_id=user.id, amount=-500, balance_after=-500 * (j + 1), created_at=moment))
+        await db.commit()
+    return create_access_token({'sub': 'student-0'}, datetime.timedelta(minutes=5))
+
+
+async def _measure(client, counter, path, params, token) -> tuple[int, int]:
+    principals.clear()
+    listings.entries.clear()
+    data_versions.versions.clear()
+    counter.count = 0
+    response = await client.get(path, params=params, headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 200, response.text
+    return counter.count, len(response.json())
+
+
+@pytest.mark.parametrize('path, short, full, as_admin', ENDPOINTS,
+                         ids=[f"{path}{'&'.join(sorted(full))}{' admin' if as_admin else ''}"
+                              for path, _, full, as_admin in ENDPOINTS])
+async def test_queries_do_not_grow_with_the_page(client, admin, student, path, short, full, as_admin):
+    token = admin['Authorization'].removeprefix('Bearer ') if as_admin else student
+    counter = QueryCounter(engine)
+    short_queries, short_rows = await _measure(client, counter, path, short, token)
+    full_queries, full_rows = await _measure(client, counter, path, full, token)
+    assert short_rows == 2 and full_rows == 20
+    assert short_queries == full_queries
+
+
+async def test_ledger_queries_do_not_grow_with_the_page(client, student):
+    counter = QueryCounter(engine)
+    full_queries, full_rows = await _measure(client, counter, '/users/ledger/', {}, student)
+    response = await client.get('/users/ledger/', headers={'Authorization': f'Bearer {student}'})
+    cursor = response.headers[NEXT_CURSOR_HEADER]
+    short_queries, short_rows = await _measure(client, counter, '/users/ledger/', {'cursor': cursor}, student)
+    assert (short_rows, full_rows) == (ROWS - 20, 20)
+    assert short_queries == full_queries
@@ -0,0 +1,98 @@
+import datetime
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import config
+import recurrence
+from sql_app import schemas
+
+
+def _rule(**fields) -> schemas.ScheduleRecurrence:
+    return schemas.ScheduleRecurrence(**{'user_ids': [1], 'weekdays': [0, 2], 'time': datetime.time(10, 0),
+                                         'start_date': datetime.date(2026, 3, 2),
+                                         'end_date': datetime.date(2026, 3, 15), **fields})
+
+
+def test_expand_weekdays():
+    times = recurrence.expand(_rule())
+    assert [t.date() for t in times] == [datetime.date(2026, 3, d) for d in (2, 4, 9, 11)]
+    assert all(t.weekday() in (0, 2) for t in times)
+    assert all(t.strftime('%H:%M %Z') == '10:00 MSK' for t in times)
+
+
+def test_expand_skips_exceptions():
+    times = recurrence.expand(_rule(exceptions=[datetime.date(2026, 3, 4), datetime.date(2026, 3, 9)]))
+    assert [t.date() for t in times] == [datetime.date(2026, 3, 2), datetime.date(2026, 3, 11)]
+
+
+def test_expand_keeps_local_time_across_dst():
+    # Berlin moves to summer time on 2026-03-29
+    times = recurrence.expand(_rule(weekdays=[4], timezone='Europe/Berlin',
+                                    start_date=datetime.date(2026, 3, 20), end_date=datetime.date(2026, 4, 3)))
+    assert [t.strftime('%H:%M') for t in times] == ['10:00', '10:00', '10:00']
+    assert [t.astimezone(datetime.timezone.utc).hour for t in times] == [9, 9, 8]
+
+
+def test_expand_rejects_bad_rules():
+    with pytest.raises(HTTPException):
+        recurrence.expand(_rule(timezone='Mars/Olympus'))
+    with pytest.raises(HTTPException):
+        recurrence.expand(_rule(end_date=datetime.date(2026, 3, 1)))
+
+
+def test_expand_rejects_long_ranges_without_walking_them():
+    start = time.perf_counter()
+    with pytest.raises(HTTPException):
+        recurrence.expand(_rule(end_date=datetime.date(9999, 12, 31)))
+    with pytest.raises(HTTPException):
+        recurrence.expand(_rule(weekdays=[], end_date=datetime.date(9999, 12, 31)))
+    assert time.perf_counter() - start < 0.1
+
+
+def test_expand_stops_at_the_lesson_limit(monkeypatch):
+    monkeypatch.setattr(config, 'SCHEDULE_BULK_LIMIT', 10)
+    # two users, so the sixth date is already over the limit
+    rule = _rule(user_ids=[1, 2, 2], weekdays=list(range(7)))
+    with pytest.raises(HTTPException) as error:
+        recurrence.expand(rule)
+    assert error.value.detail == 'At most 10 lessons per request'
+    assert len(recurrence.expand(_rule(user_ids=[1, 2], weekdays=list(range(7)),
+                                       end_date=datetime.date(2026, 3, 6)))) == 5
+
+
+def test_rows_cross_users_with_times():
+    rows = recurrence.rows(schemas.ScheduleBulkCreate(recurrence=_rule(user_ids=[1, 2, 1], note='algebra')))
+    assert len(rows) == 8
+    assert {row['user_id'] for row in rows} == {1, 2}
+    assert all(row['note'] == 'algebra' for row in rows)
+
+
+def test_rows_make_naive_times_utc():
+    aware = datetime.datetime(2026, 3, 2, 10, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))
+    naive = datetime.datetime(2026, 3, 2, 10)
+    rows = recurrence.rows(schemas.ScheduleBulkCreate(schedules=[
+        {'user_id': 1, 'scheduled_at': aware}, {'user_id': 1, 'scheduled_at': naive}]))
+    assert rows[0]['scheduled_at'] == aware
+    assert rows[1]['scheduled_at'] == naive.replace(tzinfo=datetime.timezone.utc)
+    assert min(row['scheduled_at'] for row in rows) == aware
+
+
+def test_rows_need_exactly_one_source():
+    with pytest.raises(HTTPException):
+        recurrence.rows(schemas.ScheduleBulkCreate())
+    with pytest.raises(HTTPException):
+        recurrence.rows(schemas.ScheduleBulkCreate(schedules=[], recurrence=_rule()))
+
+
+@pytest.mark.anyio
+async def test_bulk_accepts_naive_and_aware_times(client, admin):
+    response = await client.post('/users/create/', json={'username': 'student', 'password': 'password'}, headers=admin)
+    user_id = response.json()['id']
+    response = await client.post('/schedule/bulk/', headers=admin, json={'schedules': [
+        {'user_id': user_id, 'scheduled_at': '2026-03-02T10:00:00+03:00'},
+        {'user_id': user_id, 'scheduled_at': '2026-03-03T10:00:00'},
+    ]})
+    assert response.status_code == 200, response.text
+    assert [s['scheduled_at'] for s in response.json()['schedules']] == ['2026-03-02T07:00:00Z', '2026-03-03T10:00:00Z']
@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+from response_cache import VersionTracker, data_versions
+from sql_app import crud, database
+
+
+def test_versions_are_bounded_and_only_grow():
+    tracker = VersionTracker(maxsize=2, ttl=60)
+    tracker._on_notify(None, 0, crud.DATA_VERSION_CHANNEL, '1:5,2:3')
+    tracker._observe(1, 4)
+    assert tracker.versions.get(1) == 5
+    tracker._on_notify(None, 0, crud.DATA_VERSION_CHANNEL, '3:1')
+    assert tracker.versions.stats()['size'] == 2
+    assert tracker.versions.get(2) is None
+
+
+@pytest.mark.anyio
+async def test_listener_stays_out_of_the_pool(client):
+    for _ in range(100):
+        if data_versions.listening:
+            break
+        await asyncio.sleep(0.05)
+    assert data_versions.listening
+    assert database.engine.pool.checkedout() == 0
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+import config
+import storage
+from sql_app import models
+from sql_app.database import SessionLocal
+
+pytestmark = pytest.mark.anyio
+
+
+def _stage(content: bytes) -> storage.StagedBlob:
+    os.makedirs('docs', exist_ok=True)
+    digest = hashlib.sha256(content).hexdigest()
+    tmp_path = f'docs/.upload-{digest[:8]}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    return storage.StagedBlob(tmp_path, digest, len(content), 'a.txt', 'text/plain')
+
+
+async def _blob_row(digest: str):
+    async with SessionLocal() as db:
+        return await db.scalar(select(models.Blob).filter(models.Blob.sha256 == digest))
+
+
+async def test_files_are_placed_on_commit(client):
+    staged = _stage(b'committed')
+    async with SessionLocal() as db:
+        await storage.add_blobs(db, [staged])
+        assert not os.path.exists(storage.blob_path(staged.sha256))
+        await db.commit()
+    assert os.path.exists(storage.blob_path(staged.sha256))
+    assert not os.path.exists(staged.tmp_path)
+    assert await _blob_row(staged.sha256) is not None
+
+
+@pytest.mark.parametrize('end', ['rollback', 'close'])
+async def test_files_of_a_rolled_back_upload_are_removed(client, end):
+    staged = _stage(b'rolled back')
+    async with SessionLocal() as db:
+        await storage.add_blobs(db, [staged])
+        if end == 'rollback':
+            await db.rollback()
+    assert not os.path.exists(staged.tmp_path)
+    assert not os.path.exists(storage.blob_path(staged.sha256))
+    assert await _blob_row(staged.sha256) is None
+
+
+async def test_released_blobs_are_collected_periodically(client, admin, monkeypatch):
+    monkeypatch.setattr(config, 'BLOB_GC_GRACE', 0)
+    monkeypatch.setattr(config, 'BLOB_GC_INTERVAL', 0.05)
+    response = await client.post('/users/create/', json={'username': 'student', 'password': 'password'}, headers=admin)
+    user_id = response.json()['id']
+    response = await client.post('/homework/create/', data={'name': 'hw', 'user_id': user_id},
+                                 files=[('files', ('a.txt', b'released'))], headers=admin)
+    assert response.status_code == 200, response.text
+    path = storage.blob_path(hashlib.sha256(b'released').hexdigest())
+    assert os.path.exists(path)
+    await client.get(f"/homework/delete/{response.json()['id']}", headers=admin)
+    collector = asyncio.create_task(storage.run_garbage_collection())
+    try:
+        for _ in range(100):
+            if not os.path.exists(path):
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        collector.cancel()
+    assert not os.path.exists(path)
+
+
+async def test_failed_delete_is_rolled_back_and_reported(client, admin, monkeypatch):
+    response = await client.post('/users/create/', json={'username': 'student', 'password': 'password'}, headers=admin)
+    response = await client.post('/homework/create/', data={'name': 'hw', 'user_id': response.json()['id']},
+                                 files=[('files', ('a.txt', b'kept'))], headers=admin)
+    homework_id = response.json()['id']
+
+    async def release(db, refs):
+        raise OperationalError('UPDATE blobs', {}, Exception('connection lost'))
+
+    monkeypatch.setattr(storage, 'release', release)
+    response = await client.get(f'/homework/delete/{homework_id}', headers=admin)
+    assert response.json()['detail'] == 'Error while deleting'
+    async with SessionLocal() as db:
+        assert await db.get(models.Homework, homework_id) is not None
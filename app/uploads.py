@@ -0,0 +1,93 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import uuid
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+import config
+import metrics
+import storage
+
+UPLOAD_DIR = 'docs'
+
+
+class _RequestBudget:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def consume(self, size: int):
+        self.used += size
+        if self.used > self.limit:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="Files are too large",
+            )
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _stage(file: UploadFile, semaphore: asyncio.Semaphore, budget: _RequestBudget) -> storage.StagedBlob:
+    filename = os.path.basename(file.filename or '') or 'file'
+    # Staged on the same filesystem as the store, so moving it in is an atomic rename
+    tmp_path = f'{UPLOAD_DIR}/.upload-{uuid.uuid4().hex}.part'
+    async with semaphore:
+        size = 0
+        digest = hashlib.sha256()
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as out_file:
+                while chunk := await file.read(config.UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > config.UPLOAD_MAX_FILE_SIZE:
+                        raise HTTPException(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"File {filename} is too large",
+                        )
+                    budget.consume(len(chunk))
+                    digest.update(chunk)
+                    await out_file.write(chunk)
+        except BaseException:
+            _remove(tmp_path)
+            raise
+    metrics.upload_files.inc()
+    metrics.upload_bytes.inc(amount=size)
+    content_type = mimetypes.guess_type(filename)[0] or file.content_type or 'application/octet-stream'
+    return storage.StagedBlob(tmp_path, digest.hexdigest(), size, filename, content_type)
+
+
+async def save_uploads(db: AsyncSession, files: list[UploadFile]) -> list[str]:
+    """Stream uploaded files into the blob store in fixed-size chunks and return their refs in order
+
+    The blob rows are written in the caller's transaction, the caller commits them together
+    with the rows that reference the files. The files reach the store on that commit.
+    """
+    budget = _RequestBudget(config.UPLOAD_MAX_REQUEST_SIZE)
+    semaphore = asyncio.Semaphore(config.UPLOAD_CONCURRENCY)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tasks = [asyncio.create_task(_stage(file, semaphore, budget)) for file in files]
+    try:
+        staged = list(await asyncio.gather(*tasks))
+    except BaseException:
+        # One file failed: stop the rest and don't leave half of the request on disk
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, storage.StagedBlob):
+                _remove(result.tmp_path)
+        raise
+    try:
+        return await storage.add_blobs(db, staged)
+    except BaseException:
+        for s in staged:
+            _remove(s.tmp_path)
+        raise